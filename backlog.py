@@ -0,0 +1,61 @@
+# Догрузка обновлений, накопившихся, пока бот был остановлен.
+# Очередь выбирается пачками без долгого опроса; пачка обрабатывается параллельно по пользователям,
+# а обновления одного пользователя - строго по порядку. Telegram подтверждает пачку только
+# следующим getUpdates со смещением, поэтому при сбое посреди догрузки необработанное придет снова.
+import asyncio
+import contextvars
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100  # максимум getUpdates
+PARALLEL_USERS = 32
+
+# Истина, пока обрабатывается накопленная очередь
+replaying = contextvars.ContextVar('replaying', default=False)
+
+def ordering_key(update):
+    user = update.effective_user
+    if user:
+        return 'user', user.id
+    chat = update.effective_chat
+    if chat:
+        return 'chat', chat.id
+    return 'update', update.update_id
+
+async def _process_batch(app, updates: list, semaphore: asyncio.Semaphore):
+    app.begin_updates(update.update_id for update in updates)
+    groups = {}
+    for update in updates:
+        groups.setdefault(ordering_key(update), []).append(update)
+
+    async def run(group):
+        async with semaphore:
+            for update in group:
+                await app.process_update(update)
+
+    await asyncio.gather(*(run(group) for group in groups.values()))
+
+# Возвращает (количество обновлений, секунды). on_batch() вызывается после каждой обработанной пачки.
+async def catch_up(app, on_batch=None) -> tuple:
+    # getUpdates недоступен, пока установлен webhook; накопленные обновления при снятии сохраняются
+    await app.bot.delete_webhook(drop_pending_updates=False)
+    semaphore = asyncio.Semaphore(PARALLEL_USERS)
+    started = time.perf_counter()
+    total = 0
+    offset = None
+    token = replaying.set(True)
+    try:
+        while True:
+            updates = await app.bot.get_updates(offset=offset, limit=BATCH_SIZE, timeout=0)
+            if not updates:
+                break
+            await _process_batch(app, updates, semaphore)
+            total += len(updates)
+            offset = updates[-1].update_id + 1
+            if on_batch:
+                await on_batch()
+    finally:
+        replaying.reset(token)
+    return total, time.perf_counter() - started
@@ -0,0 +1,102 @@
+# Микробенчмарк маршрутизации callback_data:
+# прежний путь (три регулярных выражения CallbackQueryHandler + startswith/split)
+# против подписанного кодека с таблицей обработчиков.
+# Запуск: python bench_callbacks.py [количество итераций]
+import os
+import re
+import sys
+import timeit
+
+os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_ID", "0")
+
+from callbacks import (
+    decode_callback,
+    encode_callback,
+    SHOW_WISHLIST,
+    REMOVE_FRIEND,
+    RESERVE,
+    CANCEL_RESERVE,
+    DELETE_TOGGLE,
+    FRIEND_REQUEST
+)
+
+USER_ID = 5_123_456_789
+FRIEND_ID = 6_987_654_321
+GIFT_ID = 123_456
+BOT_ID = 1_234_567_890
+
+LEGACY_PATTERNS = [
+    re.compile("^delete:"),
+    re.compile("^(show_wishlist|remove_friend|reserve|cancel_reserve):"),
+    re.compile("^friend_request:"),
+]
+
+LEGACY_DATA = [
+    f"show_wishlist:{FRIEND_ID}",
+    f"remove_friend:{FRIEND_ID}",
+    f"reserve:{GIFT_ID}",
+    f"cancel_reserve:{GIFT_ID}",
+    f"delete:{GIFT_ID}",
+    f"friend_request:accept:{FRIEND_ID}",
+]
+
+CODEC_DATA = [
+    encode_callback(SHOW_WISHLIST, FRIEND_ID, user_id=USER_ID, bot_id=BOT_ID),
+    encode_callback(REMOVE_FRIEND, FRIEND_ID, user_id=USER_ID, bot_id=BOT_ID),
+    encode_callback(RESERVE, GIFT_ID, user_id=USER_ID, bot_id=BOT_ID),
+    encode_callback(CANCEL_RESERVE, GIFT_ID, user_id=USER_ID, bot_id=BOT_ID),
+    encode_callback(DELETE_TOGGLE, GIFT_ID, 1, user_id=USER_ID, bot_id=BOT_ID),
+    encode_callback(FRIEND_REQUEST, FRIEND_ID, 1, user_id=USER_ID, bot_id=BOT_ID),
+]
+
+def _noop(*args):
+    return args
+
+ROUTES = {action: _noop for action in (SHOW_WISHLIST, REMOVE_FRIEND, RESERVE, CANCEL_RESERVE, DELETE_TOGGLE, FRIEND_REQUEST)}
+
+def legacy_route(data: str):
+    for index, pattern in enumerate(LEGACY_PATTERNS):
+        if pattern.match(data):
+            break
+    else:
+        return None
+
+    if index == 0:
+        return _noop(int(data.split("delete:")[1]))
+    if index == 2:
+        action, from_user_id = data.split(":")[1:]
+        return _noop(int(from_user_id), action)
+    for prefix in ("show_wishlist:", "reserve:", "cancel_reserve:", "remove_friend:"):
+        if data.startswith(prefix):
+            return _noop(int(data.split(":")[1]))
+    return None
+
+def codec_route(data: str):
+    decoded = decode_callback(data, USER_ID, BOT_ID)
+    if decoded is None:
+        return None
+    return ROUTES[decoded[0]](*decoded[1])
+
+def forged_route(data: str):
+    return decode_callback(data, USER_ID + 1, BOT_ID)
+
+def bench(name: str, func, payloads: list, number: int):
+    def run():
+        for data in payloads:
+            func(data)
+
+    best = min(timeit.repeat(run, number=number, repeat=5))
+    per_call = best / (number * len(payloads)) * 1e9
+    print(f"{name:<32} {per_call:8.0f} нс/вызов")
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"Максимальная длина callback_data: legacy {max(map(len, LEGACY_DATA))} B, "
+          f"codec {max(map(len, CODEC_DATA))} B (лимит 64 B)")
+    bench("regex + split (без проверки)", legacy_route, LEGACY_DATA, number)
+    bench("codec + таблица (HMAC)", codec_route, CODEC_DATA, number)
+    bench("codec, отклонение подделки", forged_route, CODEC_DATA, number)
+
+if __name__ == "__main__":
+    main()
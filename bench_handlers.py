@@ -0,0 +1,173 @@
+# Нагрузочный стенд обработчиков в одном процессе: без сети и без PostgreSQL.
+# Обновления подаются прямо в Application.process_update, хранилище - MemoryStorage,
+# запросы к Bot API отвечает поддельный API из loadtest.py через собственный BaseRequest.
+# Измеряется стоимость самих обработчиков (разбор обновления, маршрутизация, логика, клавиатуры).
+# Обновления одного пользователя идут по порядку, пользователи - параллельно.
+# Потолок - около 1100-1700 обновлений/с на одно ядро (100 пользователей, 3000 обновлений;
+# разброс между прогонами на общей машине большой, сравнивать лучше несколько прогонов).
+# По cProfile больше половины времени уходит на объекты PTB: Update.de_json входящих обновлений
+# и Message.de_json ответов на sendMessage/editMessageText. Эту цену платит и рабочий бот;
+# транспорт стенда (JSON поддельного API) отключен через LocalBotApi(encode=False).
+# Запуск: python bench_handlers.py [--users 500] [--updates 20000]
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import time
+
+os.environ.setdefault("DATABASE_URL", "postgres://unused")
+os.environ.setdefault("ADMIN_ID", "1")
+
+from loadtest import FAKE_TOKEN, SCENARIO_WEIGHTS, FakeBotApi, Stats, callback_update, message_update, percentile
+
+os.environ["TELEGRAM_TOKEN"] = FAKE_TOKEN
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import main
+from memory_storage import MemoryStorage
+from metrics import report as metrics_report
+from runtime_profile import encode_request_data, parse_json_payload
+from storage import use_storage
+
+# encode=True - запросы и ответы кодируются в JSON, как у HTTP-клиента (так bench_runtime.py сравнивает
+# JSON профилей). encode=False - параметры передаются поддельному API как есть, а его ответ отдается PTB
+# без json.dumps и повторного разбора: стенд обработчиков не меряет собственный транспорт.
+class LocalBotApi(BaseRequest):
+    def __init__(self, api: FakeBotApi, encode: bool = True):
+        self.api = api
+        self.encode = encode
+        self.responses = {}  # ключ ответа -> разобранный ответ (encode=False)
+        self.response_keys = itertools.count()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if not request_data:
+            params = {}
+        elif self.encode:
+            params = encode_request_data(request_data).json_parameters
+        else:
+            params = request_data.parameters
+        status, payload = await self.api.call(url.rsplit("/", 1)[-1], params)
+        if self.encode:
+            return status, json.dumps(payload).encode()
+        # Вместо тела - ключ: PTB проверит код ответа и передаст ключ в parse_json_payload
+        key = next(self.response_keys)
+        self.responses[key] = payload
+        return status, str(key).encode()
+
+    def parse_json_payload(self, payload: bytes) -> dict:
+        if self.encode:
+            return parse_json_payload(payload)
+        return self.responses.pop(int(payload))
+
+async def run_user(app, api: FakeBotApi, user_id: int, count: int, started_users: list, update_ids, latencies: list):
+    actions = list(SCENARIO_WEIGHTS)
+    weights = list(SCENARIO_WEIGHTS.values())
+    query_ids = itertools.count()
+
+    async def send(payload):
+        update = Update.de_json({"update_id": next(update_ids), **payload}, app.bot)
+        started = time.perf_counter()
+        await app.process_update(update)
+        latencies.append(time.perf_counter() - started)
+
+    for _ in range(count):
+        action = random.choices(actions, weights)[0]
+        if action == "tap_button" and not api.buttons.get(user_id):
+            action = "view_friends"
+        if action == "add_link":
+            await send(message_update(user_id, f"https://example.com/item/{random.randint(1, 10**9)}"))
+        elif action == "view_list":
+            await send(message_update(user_id, "🎁 Мой виш-лист"))
+        elif action == "view_friends":
+            await send(message_update(user_id, "📋 Друзья"))
+        elif action == "share_friend":
+            friend_id = random.choice(started_users)
+            if friend_id == user_id:
+                await send(message_update(user_id, "📋 Друзья"))
+            else:
+                await send(message_update(user_id, user_shared={"request_id": 1, "user_id": friend_id}))
+        else:
+            buttons = api.buttons[user_id]
+            preferred = [b for b in buttons if b[0].startswith(("✅ Принять", "🔒", "🎁 Показать"))]
+            text, data, message_id = random.choice(preferred or buttons)
+            buttons.remove((text, data, message_id))
+            await send(callback_update(user_id, f"{user_id}-{next(query_ids)}", data, message_id))
+
+# Возвращает результаты прогона для report()
+async def run(args) -> dict:
+    random.seed(args.seed)
+    use_storage(MemoryStorage())
+    main.register_callback_routes()
+    await main.startup()
+
+    api = FakeBotApi(Stats(), flood=False, per_chat_rate=1, global_rate=30)
+    request = LocalBotApi(api, encode=False)
+    app = main.build_application(FAKE_TOKEN, request, request, True, 0)
+    await app.initialize()
+    await app.post_init(app)
+
+    user_ids = [7_000_000_000 + index for index in range(args.users)]
+    update_ids = itertools.count(1)
+    latencies = []
+    per_user = max(1, args.updates // args.users)
+    try:
+        started = time.perf_counter()
+        # /start всех пользователей
+        await asyncio.gather(*(
+            app.process_update(Update.de_json({"update_id": next(update_ids), **message_update(user_id, "/start")}, app.bot))
+            for user_id in user_ids
+        ))
+        await asyncio.gather(*(
+            run_user(app, api, user_id, per_user, user_ids, update_ids, latencies) for user_id in user_ids
+        ))
+        elapsed = time.perf_counter() - started
+    finally:
+        await app.bot_data['owner_notifier'].flush_all()
+        await app.bot_data['reservation_scheduler'].stop()
+        await app.shutdown()
+        await main.shutdown()
+
+    latencies_ms = [value * 1000 for value in latencies]
+    return {
+        'users': args.users,
+        'updates': args.users + len(latencies),
+        'elapsed': elapsed,
+        'p50_ms': percentile(latencies_ms, 0.5),
+        'p99_ms': percentile(latencies_ms, 0.99),
+        'max_ms': max(latencies_ms, default=0),
+        'api_calls': dict(api.stats.api_calls),
+    }
+
+def report(result: dict):
+    print(f"Пользователей: {result['users']}, обновлений: {result['updates']}, время: {result['elapsed']:.2f} с")
+    print(f"Пропускная способность: {result['updates'] / result['elapsed']:.0f} обновлений/с")
+    print(f"Обработка, мс: p50 {result['p50_ms']:.2f} · p99 {result['p99_ms']:.2f} · max {result['max_ms']:.2f}")
+    print("Вызовы Bot API: " + ", ".join(f"{name} {count}" for name, count in sorted(result['api_calls'].items())))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд обработчиков в одном процессе")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--updates", type=int, default=20000, help="обновлений после /start, всего")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--metrics", action="store_true", help="вывести отчет /metrics после прогона")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_args()
+    report(asyncio.run(run(args)))
+    if args.metrics:
+        print()
+        print(metrics_report())
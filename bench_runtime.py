@@ -0,0 +1,129 @@
+# Сравнение профилей выполнения (runtime_profile.py): default против fast.
+# Каждый профиль измеряется в отдельном процессе, чтобы политика event loop и прогретые
+# кэши одного прогона не влияли на другой. Замеры:
+#   разбор обновлений - ответ getUpdates (байты) -> JSON -> Update.de_json;
+#   обработчики       - прогон bench_handlers.py (MemoryStorage, поддельный Bot API в процессе);
+#   отправка          - параллельные send_message с inline-клавиатурой через поддельный Bot API.
+# Запуск: python bench_runtime.py [--users 300] [--updates 10000] [--batches 200] [--sends 20000]
+import argparse
+import asyncio
+import json
+import logging
+import subprocess
+import sys
+import time
+
+PROFILES = ('default', 'fast')
+SEND_CONCURRENCY = 64
+
+def updates_payload(count: int) -> bytes:
+    from loadtest import callback_update, message_update
+    updates = []
+    for index in range(count):
+        user_id = 7_000_000_000 + index % 50
+        if index % 3 == 0:
+            payload = callback_update(user_id, str(index), "AQIDBAUGBwgJCgsMDQ4P", 1000 + index)
+        elif index % 3 == 1:
+            payload = message_update(user_id, f"https://example.com/item/{index}")
+        else:
+            payload = message_update(user_id, "🎁 Мой виш-лист")
+        updates.append({"update_id": index + 1, **payload})
+    return json.dumps({"ok": True, "result": updates}).encode()
+
+def bench_decoding(batches: int) -> float:
+    from telegram import Update
+    from runtime_profile import parse_json_payload
+
+    payload = updates_payload(100)
+    started = time.perf_counter()
+    for _ in range(batches):
+        for data in parse_json_payload(payload)["result"]:
+            Update.de_json(data, None)
+    return batches * 100 / (time.perf_counter() - started)
+
+async def bench_sends(count: int) -> float:
+    from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+    from bench_handlers import LocalBotApi
+    from loadtest import FAKE_TOKEN, FakeBotApi, Stats
+
+    request = LocalBotApi(FakeBotApi(Stats(), flood=False, per_chat_rate=1, global_rate=30))
+    bot = Bot(FAKE_TOKEN, request=request, get_updates_request=request)
+    await bot.initialize()
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"🎁 Подарок {row}", callback_data=f"AQIDBAUGBwgJCgsM{row:04d}")] for row in range(5)
+    ])
+    semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+
+    async def send(index):
+        async with semaphore:
+            await bot.send_message(
+                chat_id=7_000_000_000 + index % 500,
+                text=f"🎁 <b>Список желаний</b>\n\nhttps://example.com/item/{index}",
+                parse_mode="HTML",
+                reply_markup=keyboard
+            )
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(index) for index in range(count)))
+    elapsed = time.perf_counter() - started
+    await bot.shutdown()
+    return count / elapsed
+
+# Замеры одного профиля; выполняется в дочернем процессе
+def measure(args) -> dict:
+    import bench_handlers
+    from runtime_profile import apply
+
+    event_loop, json_codec = apply(args.child)
+    handlers = asyncio.run(bench_handlers.run(argparse.Namespace(
+        users=args.users, updates=args.updates, seed=1, metrics=False
+    )))
+    return {
+        'event_loop': event_loop,
+        'json': json_codec,
+        'decoding': bench_decoding(args.batches),
+        'handlers': handlers['updates'] / handlers['elapsed'],
+        'handlers_p99_ms': handlers['p99_ms'],
+        'sends': asyncio.run(bench_sends(args.sends)),
+    }
+
+def run_profile(profile: str, args) -> dict:
+    command = [
+        sys.executable, __file__, '--child', profile, '--users', str(args.users), '--updates', str(args.updates),
+        '--batches', str(args.batches), '--sends', str(args.sends)
+    ]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def report(results: dict):
+    rows = [
+        ("Разбор обновлений, обновлений/с", 'decoding', True),
+        ("Обработчики, обновлений/с", 'handlers', True),
+        ("Обработчики p99, мс", 'handlers_p99_ms', False),
+        ("Отправка сообщений, вызовов/с", 'sends', True),
+    ]
+    default, fast = results['default'], results['fast']
+    print(f"default: event loop {default['event_loop']}, JSON {default['json']}")
+    print(f"fast:    event loop {fast['event_loop']}, JSON {fast['json']}")
+    print()
+    print(f"{'':34} {'default':>10} {'fast':>10} {'выигрыш':>9}")
+    for title, key, higher_is_better in rows:
+        ratio = fast[key] / default[key] if higher_is_better else default[key] / fast[key]
+        print(f"{title:34} {default[key]:>10.1f} {fast[key]:>10.1f} {(ratio - 1) * 100:>+8.1f}%")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сравнение профилей выполнения default и fast")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--updates", type=int, default=10000, help="обновлений в прогоне обработчиков")
+    parser.add_argument("--batches", type=int, default=200, help="пачек getUpdates по 100 обновлений для разбора")
+    parser.add_argument("--sends", type=int, default=20000)
+    parser.add_argument("--child", choices=PROFILES, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    args = parse_args()
+    if args.child:
+        print(json.dumps(measure(args)))
+    else:
+        report({profile: run_profile(profile, args) for profile in PROFILES})
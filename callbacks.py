@@ -0,0 +1,117 @@
+# Компактные подписанные callback_data и единый диспетчер inline-кнопок.
+# Формат: base64url(код действия | аргументы в varint | HMAC-SHA256[:8]).
+# Подпись привязана к боту и пользователю, которому отправлена кнопка,
+# поэтому чужие, подделанные или выданные другим ботом данные отбрасываются до обращения к БД.
+import base64
+import hashlib
+import hmac
+import logging
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from backlog import replaying
+from config import CALLBACK_SECRET
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_DATA_LIMIT = 64  # ограничение Telegram на callback_data в байтах
+SIGNATURE_SIZE = 8
+
+# Коды действий
+SHOW_WISHLIST = 1
+REMOVE_FRIEND = 2
+RESERVE = 3
+CANCEL_RESERVE = 4
+FRIEND_REQUEST = 6  # аргументы: from_user_id, 1 - принять / 0 - отклонить
+DELETE_TOGGLE = 7  # аргументы: gift_id, 1 - выбран / 0 - нет
+DELETE_CONFIRM = 8
+DELETE_CANCEL = 9
+SEARCH_MORE = 10  # аргументы: номер поиска (search_history), id последнего показанного подарка
+OCCASION_DELETE = 11  # аргументы: id события
+
+_KEY = hashlib.sha256(CALLBACK_SECRET.encode()).digest()
+
+def _write_varint(value: int, out: bytearray):
+    if value < 0:
+        raise ValueError("callback arguments must be non-negative")
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+def _read_varints(data: bytes) -> tuple:
+    values, value, shift = [], 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            if shift > 63:
+                raise ValueError("varint is too long")
+        else:
+            values.append(value)
+            value, shift = 0, 0
+    if shift:
+        raise ValueError("truncated varint")
+    return tuple(values)
+
+def _sign(bot_id: int, user_id: int, body: bytes) -> bytes:
+    message = bot_id.to_bytes(8, "big", signed=True) + user_id.to_bytes(8, "big", signed=True) + body
+    return hmac.digest(_KEY, message, "sha256")[:SIGNATURE_SIZE]
+
+def encode_callback(action: int, *args: int, user_id: int, bot_id: int) -> str:
+    body = bytearray([action])
+    for arg in args:
+        _write_varint(int(arg), body)
+    body = bytes(body)
+    data = base64.urlsafe_b64encode(body + _sign(bot_id, user_id, body)).rstrip(b"=").decode()
+    if len(data) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback data is too long: {len(data)} bytes")
+    return data
+
+# Возвращает (action, args) или None, если данные повреждены, подделаны или выданы другому пользователю или боту
+def decode_callback(data: str, user_id: int, bot_id: int):
+    if not data or len(data) > CALLBACK_DATA_LIMIT:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    except (ValueError, TypeError):
+        return None
+    if len(raw) <= SIGNATURE_SIZE:
+        return None
+    body, signature = raw[:-SIGNATURE_SIZE], raw[-SIGNATURE_SIZE:]
+    if not hmac.compare_digest(signature, _sign(bot_id, user_id, body)):
+        return None
+    try:
+        return body[0], _read_varints(body[1:])
+    except ValueError:
+        return None
+
+class CallbackRouter:
+    def __init__(self):
+        self.routes = {}
+
+    def add(self, action: int, handler):
+        self.routes[action] = handler
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        # Нажатия из очереди, накопленной за время простоя, старше срока ответа на callback:
+        # answerCallbackQuery завершился бы ошибкой "query is too old", поэтому ответ пропускаем,
+        # а само действие выполняем
+        stale = replaying.get()
+        decoded = decode_callback(query.data, query.from_user.id, context.bot.id)
+        handler = self.routes.get(decoded[0]) if decoded else None
+        if handler is None:
+            logger.warning("Отклонен callback с неверной подписью или данными от пользователя %s", query.from_user.id)
+            if not stale:
+                await query.answer("Кнопка устарела. Откройте список заново 🙏", show_alert=True)
+            return
+
+        if not stale:
+            await query.answer()
+        await handler(update, context, *decoded[1])
@@ -2,5 +2,35 @@ import os
 from dotenv import load_dotenv
 
 load_dotenv()
-TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-ADMIN_ID = int(os.getenv('ADMIN_ID'))
\ No newline at end of file
+# Несколько ботов в одном процессе: TELEGRAM_TOKENS через запятую; иначе один TELEGRAM_TOKEN
+TELEGRAM_TOKENS = [token.strip() for token in os.getenv('TELEGRAM_TOKENS', '').split(',') if token.strip()] \
+    or [token.strip() for token in [os.getenv('TELEGRAM_TOKEN', '')] if token.strip()]
+if not TELEGRAM_TOKENS:
+    raise RuntimeError("TELEGRAM_TOKEN or TELEGRAM_TOKENS must be set")
+TELEGRAM_TOKEN = TELEGRAM_TOKENS[0]
+ADMIN_ID = int(os.getenv('ADMIN_ID'))
+# Ключ подписи callback_data. Для одного бота по умолчанию выводится из его токена; при нескольких
+# обязателен: иначе перестановка или замена токенов в TELEGRAM_TOKENS сделала бы недействительными
+# кнопки всех ботов
+CALLBACK_SECRET = os.getenv('CALLBACK_SECRET')
+if not CALLBACK_SECRET:
+    if len(TELEGRAM_TOKENS) > 1:
+        raise RuntimeError("CALLBACK_SECRET must be set when TELEGRAM_TOKENS lists several bots")
+    CALLBACK_SECRET = f"callbacks:{TELEGRAM_TOKEN}"
+
+# Хранилище: postgres (DATABASE_URL) или memory - данные в памяти процесса, без базы
+# (нагрузочный стенд loadtest.py); при остановке бота они теряются
+STORAGE = os.getenv('STORAGE') or 'postgres'
+if STORAGE not in ('postgres', 'memory'):
+    raise RuntimeError(f"Unknown STORAGE: {STORAGE}")
+
+# Адрес Bot API (например, локальный сервер или нагрузочный стенд loadtest.py)
+BOT_API_BASE_URL = os.getenv('BOT_API_BASE_URL', 'https://api.telegram.org/bot')
+# Режим webhook включается, если задан WEBHOOK_URL (нужен python-telegram-bot[webhooks]).
+# При нескольких ботах i-й бот слушает WEBHOOK_PORT + i по пути /<id бота>
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Профиль выполнения: default или fast (uvloop и orjson, если установлены), см. runtime_profile.py
+RUNTIME_PROFILE = os.getenv('RUNTIME_PROFILE', 'default')
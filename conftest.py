@@ -0,0 +1,55 @@
+# Общая настройка тестов: окружение для config.py и запуск сценариев на хранилище.
+# MemoryStorage проверяется всегда; PostgresStorage - если задан TEST_DATABASE_URL
+# (отдельная база: тесты создают данные под случайными id ботов и пользователей).
+# Запуск: python -m pytest
+import asyncio
+import os
+import random
+
+import pytest
+
+# test_db.py - ручная проверка подключения к базе (выполняется при импорте), не тест pytest
+collect_ignore = ["test_db.py"]
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+BACKENDS = ['memory'] + (['postgres'] if TEST_DATABASE_URL else [])
+
+_environment = pytest.MonkeyPatch()
+
+# config.py и db.py читают окружение при импорте, поэтому оно задается до сбора тестовых модулей,
+# одно на весь запуск. Значения заданы явно: load_dotenv() не подставит токены и базу из .env
+def pytest_configure(config):
+    _environment.setenv("DATABASE_URL", TEST_DATABASE_URL or "postgres://unused")
+    _environment.setenv("TELEGRAM_TOKENS", "0:test")
+    _environment.setenv("TELEGRAM_TOKEN", "0:test")
+    _environment.setenv("ADMIN_ID", "0")
+
+def pytest_unconfigure(config):
+    _environment.undo()
+
+def new_id() -> int:
+    return random.randrange(10 ** 11, 10 ** 12)
+
+# run(scenario): scenario(storage) выполняется в своем цикле событий на новом боте;
+# хранилище на это время становится текущим (store)
+@pytest.fixture(params=BACKENDS)
+def run(request):
+    # Модули бота импортируются после pytest_configure, когда окружение уже задано
+    from memory_storage import MemoryStorage
+    from storage import bind_bot, PostgresStorage, store, use_storage
+
+    def run(scenario):
+        async def main():
+            storage = MemoryStorage() if request.param == 'memory' else PostgresStorage()
+            bot_id = new_id()
+            bind_bot(bot_id)
+            await storage.init([bot_id])
+            previous = store.backend
+            use_storage(storage)
+            try:
+                await scenario(storage)
+            finally:
+                use_storage(previous)
+                await storage.close()
+        asyncio.run(main())
+    return run
@@ -1,27 +1,110 @@
 import asyncpg
+import contextlib
+import contextvars
+import hashlib
 import os
+import random
+import re
+import sys
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
 import logging
 import asyncio
+import time
+
+from metrics import register_gauge
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
+# Проверяется при подключении: хранилищу в памяти (STORAGE=memory) база не нужна
 DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    raise RuntimeError("DATABASE_URL is not set")
+
+# Необязательная реплика только для чтения
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+# Сколько секунд после записи чтения, затрагивающие пользователя, идут на основную базу
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", "5"))
+# Максимально допустимое отставание реплики в секундах
+MAX_REPLICA_LAG = float(os.getenv("MAX_REPLICA_LAG", "2"))
+# Сколько секунд ждать свободное соединение и ответ на запрос основной базы
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "3"))
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "10"))
+# Автомат защиты: после стольких сбоев подряд запросы отклоняются сразу на BREAKER_OPEN_SECONDS
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_OPEN_SECONDS = 15
+# Сколько записей (например, добавлений ссылок) можно отложить до восстановления базы
+MAX_QUEUED_WRITES = 1000
+# Сколько последних результатов чтения хранить для работы без базы
+MAX_SNAPSHOTS = 10000
+# Трассировка: запросы и ожидание соединения дольше порогов пишутся в лог,
+# для доли медленных запросов снимается план (не чаще раза в EXPLAIN_INTERVAL на запрос)
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "0.2"))
+SLOW_ACQUIRE_SECONDS = float(os.getenv("SLOW_ACQUIRE_SECONDS", "0.1"))
+EXPLAIN_SAMPLE_RATE = float(os.getenv("EXPLAIN_SAMPLE_RATE", "0.1"))
+EXPLAIN_INTERVAL = 300  # секунд
 
 pool = None
+replica_pool = None
+replica_healthy = False
+# ключ (id пользователя или ('gift', id)) -> время последней записи
+_recent_writes = {}
+
+RESERVATION_DAYS = 10
+
+# Статус доставки сообщений пользователю (users.delivery_status)
+DELIVERY_OK = 'ok'
+DELIVERY_BLOCKED = 'blocked'  # пользователь заблокировал бота
+DELIVERY_DEACTIVATED = 'deactivated'  # аккаунт удален
+DELIVERY_NOT_FOUND = 'not_found'  # чат не найден
+
+# Бот, от имени которого выполняется текущая задача. В одном процессе может работать
+# несколько ботов с общим пулом; их данные разделены столбцом bot_id.
+current_bot_id = contextvars.ContextVar('bot_id')
+
+# Таблицы, разделенные по ботам: таблица -> (новый первичный ключ, (уникальное ограничение, новые столбцы))
+_BOT_PARTITIONED = {
+    'wishlist': (None, None),
+    'friends': ('bot_id, user_id, friend_id', None),
+    'friend_requests': (None, ('friend_requests_from_user_id_to_user_id_key', 'bot_id, from_user_id, to_user_id')),
+    'feedback': (None, None),
+    'stats_counters': ('bot_id, metric', None),
+    'stats_daily': ('bot_id, day, metric', None),
+    'user_activity': ('bot_id, day, user_id', None),
+}
+
+def bind_bot(bot_id: int):
+    current_bot_id.set(bot_id)
+
+def _bot() -> int:
+    return current_bot_id.get()
 
-async def init_db():
+# Канал NOTIFY об изменении списка подарков владельца (payload - 'id бота:id владельца')
+WISHLIST_CHANNEL = 'wishlist_changed'
+# Локальные подписчики на изменения списков (например, кэш в этом же процессе)
+_wishlist_listeners = []
+
+# Миграции (построение индексов, перенос данных) могут идти дольше DB_QUERY_TIMEOUT
+@contextlib.asynccontextmanager
+async def _migration_connection():
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+# bot_ids - все боты процесса; данные, созданные до разделения по ботам, достаются первому
+async def init_db(bot_ids: list):
     global pool
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL is not set")
     for attempt in range(3):
         try:
-            logger.info(f"Попытка подключения к базе данных (попытка {attempt + 1}): {DATABASE_URL}")
-            pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+            logger.info("Попытка подключения к базе данных (попытка %s)", attempt + 1)
+            pool = await asyncpg.create_pool(
+                DATABASE_URL, min_size=1, max_size=10, command_timeout=DB_QUERY_TIMEOUT, init=_setup_connection
+            )
             logger.info("Подключение к базе данных успешно!")
-            async with pool.acquire() as conn:
+            async with _migration_connection() as conn:
                 await conn.execute('''
                     CREATE TABLE IF NOT EXISTS users (
                         id BIGINT PRIMARY KEY,
@@ -65,90 +148,933 @@ async def init_db():
                         reserved_at TIMESTAMP DEFAULT NOW(),
                         UNIQUE(gift_id, reserved_by)
                     );
+
+                    CREATE TABLE IF NOT EXISTS stats_counters (
+                        metric TEXT PRIMARY KEY,
+                        value BIGINT NOT NULL DEFAULT 0
+                    );
+
+                    CREATE TABLE IF NOT EXISTS stats_daily (
+                        day DATE NOT NULL,
+                        metric TEXT NOT NULL,
+                        value BIGINT NOT NULL DEFAULT 0,
+                        PRIMARY KEY (day, metric)
+                    );
+
+                    CREATE TABLE IF NOT EXISTS user_activity (
+                        day DATE NOT NULL,
+                        user_id BIGINT NOT NULL,
+                        PRIMARY KEY (day, user_id)
+                    );
+
+                    -- Очередь отзывов: недоставленные админу записи имеют delivered_at IS NULL.
+                    -- Существующие отзывы уже были пересланы, поэтому при миграции помечаются доставленными.
+                    ALTER TABLE feedback ADD COLUMN IF NOT EXISTS media_type TEXT;
+                    ALTER TABLE feedback ADD COLUMN IF NOT EXISTS file_id TEXT;
+                    ALTER TABLE feedback ADD COLUMN IF NOT EXISTS delivered_at TIMESTAMP DEFAULT NOW();
+                    ALTER TABLE feedback ALTER COLUMN delivered_at DROP DEFAULT;
+                    CREATE INDEX IF NOT EXISTS feedback_created_at_idx ON feedback (created_at);
+                    CREATE INDEX IF NOT EXISTS feedback_undelivered_idx ON feedback (id) WHERE delivered_at IS NULL;
+                    -- Аренда выборки: отзыв, взятый в дайджест, но не подтвержденный к сроку аренды
+                    -- (процесс упал или был остановлен до отправки), выбирается снова
+                    ALTER TABLE feedback ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP;
+
+                    -- Срок брони хранится явно, чтобы планировщик читал ближайшие истечения по индексу
+                    ALTER TABLE reservations ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP;
+                    ALTER TABLE reservations ADD COLUMN IF NOT EXISTS reminded BOOLEAN NOT NULL DEFAULT FALSE;
+                    CREATE INDEX IF NOT EXISTS reservations_expires_at_idx ON reservations (expires_at);
+
+                    -- Пользователи конкретного бота. Недоступные чаты отсекаются до отправки,
+                    -- поэтому индекс построен только по доступным пользователям
+                    CREATE TABLE IF NOT EXISTS bot_users (
+                        bot_id BIGINT NOT NULL,
+                        user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+                        delivery_status TEXT NOT NULL DEFAULT 'ok',
+                        PRIMARY KEY (bot_id, user_id)
+                    );
+                    CREATE INDEX IF NOT EXISTS bot_users_reachable_idx ON bot_users (bot_id, user_id) WHERE delivery_status = 'ok';
+
+                    -- Последнее полностью обработанное обновление каждого бота: после штатной остановки
+                    -- или сбоя посреди догрузки повторно доставленные обновления до него пропускаются
+                    CREATE TABLE IF NOT EXISTS bot_state (
+                        bot_id BIGINT PRIMARY KEY,
+                        last_update_id BIGINT NOT NULL,
+                        updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                    );
+
+                    -- События пользователей (дни рождения и т.п.). base_date - введенная дата
+                    -- (для ежегодных - в високосном 2000 году), next_date - ближайшее наступление.
+                    -- remind_at обнуляется после разового события; по нему выбираются наступившие напоминания.
+                    CREATE TABLE IF NOT EXISTS occasions (
+                        id SERIAL PRIMARY KEY,
+                        bot_id BIGINT NOT NULL,
+                        user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+                        title TEXT NOT NULL,
+                        base_date DATE NOT NULL,
+                        next_date DATE NOT NULL,
+                        yearly BOOLEAN NOT NULL,
+                        remind_at TIMESTAMP
+                    );
+                    CREATE INDEX IF NOT EXISTS occasions_user_idx ON occasions (bot_id, user_id);
+                    CREATE INDEX IF NOT EXISTS occasions_remind_idx ON occasions (bot_id, remind_at) WHERE remind_at IS NOT NULL;
+                    -- Аренда напоминания на время рассылки: если процесс упал до complete_occasions,
+                    -- напоминание выбирается снова по истечении аренды
+                    ALTER TABLE occasions ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP;
+
+                    -- Поиск по подстроке в ссылке и названии товара (если оно известно).
+                    -- Общий триграммный индекс не нужен: поиск идет по спискам пользователя и его друзей
+                    -- (индекс wishlist_bot_user_idx), а на частых подстроках вроде "http" индекс по всем
+                    -- спискам всех пользователей перебирал бы почти всю таблицу
+                    ALTER TABLE wishlist ADD COLUMN IF NOT EXISTS title TEXT;
+                    DROP INDEX IF EXISTS wishlist_search_trgm_idx;
                 ''')
-            return
+                await conn.execute('''
+                    UPDATE reservations
+                    SET expires_at = reserved_at + make_interval(days => $1)
+                    WHERE expires_at IS NULL
+                ''', RESERVATION_DAYS)
+                await _partition_by_bot(conn, bot_ids[0])
+                await conn.execute('''
+                    CREATE INDEX IF NOT EXISTS wishlist_bot_user_idx ON wishlist (bot_id, user_id);
+                    DROP INDEX IF EXISTS wishlist_user_id_idx;
+                ''')
+                # Первичное заполнение счетчиков: выполняется для каждого бота, пока у него нет счетчиков
+                await conn.execute('''
+                    INSERT INTO stats_counters (bot_id, metric, value)
+                    SELECT b.bot_id, initial.metric, initial.value
+                    FROM unnest($1::bigint[]) AS b(bot_id)
+                    CROSS JOIN LATERAL (
+                        SELECT 'users' AS metric, COUNT(*) AS value FROM bot_users WHERE bot_id = b.bot_id
+                        UNION ALL SELECT 'gifts', COUNT(*) FROM wishlist WHERE bot_id = b.bot_id
+                        UNION ALL SELECT 'reservations', COUNT(*) FROM reservations r
+                            JOIN wishlist w ON w.id = r.gift_id WHERE w.bot_id = b.bot_id
+                        UNION ALL SELECT 'pending_requests', COUNT(*) FROM friend_requests
+                            WHERE bot_id = b.bot_id AND status = 'pending'
+                        UNION ALL SELECT 'friendships', COUNT(*) / 2 FROM friends WHERE bot_id = b.bot_id
+                        UNION ALL SELECT 'feedback', COUNT(*) FROM feedback WHERE bot_id = b.bot_id
+                    ) AS initial
+                    WHERE NOT EXISTS (SELECT 1 FROM stats_counters c WHERE c.bot_id = b.bot_id)
+                    ON CONFLICT (bot_id, metric) DO NOTHING;
+                ''', bot_ids)
+            break
         except Exception as e:
-            logger.error(f"Ошибка подключения к базе данных: {e}")
+            logger.error("Ошибка подключения к базе данных: %s", e)
             if attempt == 2:
                 raise
             await asyncio.sleep(2 ** attempt)
 
+    await init_replica()
+
+# Однократная миграция к данным, разделенным по ботам: существующие строки
+# получают bot_id первого бота, ключи и уникальные ограничения расширяются bot_id.
+async def _partition_by_bot(conn, legacy_bot_id: int):
+    partitioned = {row['table_name'] for row in await conn.fetch('''
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND column_name = 'bot_id'
+    ''')}
+    for table, (primary_key, unique) in _BOT_PARTITIONED.items():
+        if table in partitioned:
+            continue
+        async with conn.transaction():
+            await conn.execute(f'ALTER TABLE {table} ADD COLUMN bot_id BIGINT')
+            await conn.execute(f'UPDATE {table} SET bot_id = $1', legacy_bot_id)
+            await conn.execute(f'ALTER TABLE {table} ALTER COLUMN bot_id SET NOT NULL')
+            if primary_key:
+                await conn.execute(f'ALTER TABLE {table} DROP CONSTRAINT {table}_pkey, ADD PRIMARY KEY ({primary_key})')
+            if unique:
+                constraint, columns = unique
+                await conn.execute(f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint}, ADD UNIQUE ({columns})')
+        logger.info("Таблица %s разделена по ботам", table)
+
+    # Пользователи, появившиеся до разделения, принадлежат первому боту вместе со статусом доставки
+    has_delivery_status = await conn.fetchval('''
+        SELECT EXISTS(
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'delivery_status'
+        )
+    ''')
+    async with conn.transaction():
+        if has_delivery_status:
+            await conn.execute('''
+                INSERT INTO bot_users (bot_id, user_id, delivery_status)
+                SELECT $1, id, delivery_status FROM users
+                ON CONFLICT (bot_id, user_id) DO NOTHING
+            ''', legacy_bot_id)
+            await conn.execute('ALTER TABLE users DROP COLUMN delivery_status')
+        else:
+            await conn.execute('''
+                INSERT INTO bot_users (bot_id, user_id)
+                SELECT $1, id FROM users
+                WHERE NOT EXISTS (SELECT 1 FROM bot_users)
+            ''', legacy_bot_id)
+
+async def init_replica():
+    global replica_pool
+    if not DATABASE_REPLICA_URL:
+        return
+    try:
+        replica_pool = await asyncpg.create_pool(DATABASE_REPLICA_URL, min_size=1, max_size=10, init=_setup_connection)
+        logger.info("Подключение к реплике успешно")
+        await check_replica()
+    except Exception as e:
+        # Без реплики бот продолжает работать только с основной базой
+        logger.error("Не удалось подключиться к реплике: %s", e)
+        replica_pool = None
+
+# Проверка отставания реплики; вызывается периодически из main.py
+async def check_replica():
+    global replica_healthy
+    if replica_pool is None:
+        return None
+    try:
+        async with replica_pool.acquire() as conn:
+            lag = await conn.fetchval('''
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                END::float8
+            ''')
+    except Exception as e:
+        if replica_healthy:
+            logger.warning("Реплика недоступна, чтение переключено на основную базу: %s", e)
+        replica_healthy = False
+        return None
+
+    healthy = lag <= MAX_REPLICA_LAG
+    if healthy != replica_healthy:
+        logger.warning("Реплика %s (отставание %.1f с)", "снова используется" if healthy else "отстает, чтение переключено на основную базу", lag)
+    replica_healthy = healthy
+    return lag
+
+async def close_db():
+    global pool, replica_pool
+    for current in (replica_pool, pool):
+        if current is not None:
+            await current.close()
+    pool = replica_pool = None
+
+# Трассировка запросов. Имя запроса стабильно: функция, взявшая соединение, и хэш текста SQL,
+# например db.get_friends:1a2b3c4d. Имя функции действует, пока соединение у нее.
+current_query_scope = contextvars.ContextVar('query_scope', default=None)
+
+_query_stats = {}  # имя запроса -> [количество, суммарно, максимум, ошибок, текст]
+_acquire_stats = {}  # функция -> [количество, суммарно, максимум]
+_statement_digests = {}  # текст SQL -> хэш
+_last_explain = {}  # имя запроса -> время последнего плана
+_pool_waiting = 0
+
+# Функции-посредники, за которые соединение берется от имени вызывающего
+_SCOPE_WRAPPERS = {'_read'}
+# Запросы с побочными эффектами вне транзакции или изменяющие данные: план без ANALYZE
+_NOT_READ_ONLY = re.compile(r'\b(INSERT|UPDATE|DELETE|SETVAL|NEXTVAL|PG_NOTIFY|PG_ADVISORY_LOCK|PG_ADVISORY_XACT_LOCK)\b', re.IGNORECASE)
+
+register_gauge('db_pool_size', lambda: pool.get_size() if pool else 0)
+register_gauge('db_pool_idle', lambda: pool.get_idle_size() if pool else 0)
+register_gauge('db_pool_waiting', lambda: _pool_waiting)
+
+def _caller_scope(depth: int) -> str:
+    frame = sys._getframe(depth + 1)
+    while frame.f_back is not None and frame.f_code.co_name in _SCOPE_WRAPPERS:
+        frame = frame.f_back
+    module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+    return f"{module}.{frame.f_code.co_name}"
+
+def _statement_name(scope, query: str) -> str:
+    digest = _statement_digests.get(query)
+    if digest is None:
+        digest = hashlib.blake2s(' '.join(query.split()).encode(), digest_size=4).hexdigest()
+        if len(_statement_digests) < MAX_SNAPSHOTS:
+            _statement_digests[query] = digest
+    return f"{scope or 'unscoped'}:{digest}"
+
+async def _setup_connection(conn):
+    conn.add_query_logger(_log_query)
+
+# Вызывается asyncpg после каждого запроса в контексте задачи, выполнившей запрос
+def _log_query(record):
+    scope = current_query_scope.get()
+    if scope is None:
+        # Служебные запросы пула (сброс соединения при возврате) и снятие планов
+        return
+    name = _statement_name(scope, record.query)
+    stats = _query_stats.get(name)
+    if stats is None:
+        stats = _query_stats[name] = [0, 0.0, 0.0, 0, record.query]
+    stats[0] += 1
+    stats[1] += record.elapsed
+    stats[2] = max(stats[2], record.elapsed)
+    if record.exception is not None:
+        stats[3] += 1
+        return
+
+    if record.elapsed < SLOW_QUERY_SECONDS:
+        return
+    logger.warning("Медленный запрос %s: %.0f мс: %s", name, record.elapsed * 1000, ' '.join(record.query.split())[:300])
+    now = time.monotonic()
+    if random.random() < EXPLAIN_SAMPLE_RATE and now - _last_explain.get(name, -EXPLAIN_INTERVAL) >= EXPLAIN_INTERVAL:
+        _last_explain[name] = now
+        asyncio.get_running_loop().create_task(_explain(name, record.query, record.args))
+
+# План снимается на отдельном соединении в транзакции, которая откатывается
+async def _explain(name: str, query: str, args):
+    # Задача унаследовала имя запроса; сам EXPLAIN в статистику не попадает
+    current_query_scope.set(None)
+    if pool is None or breaker.state != BREAKER_CLOSED or ';' in query.strip().rstrip(';'):
+        return
+    analyze = not _NOT_READ_ONLY.search(query)
+    options = 'ANALYZE, BUFFERS' if analyze else 'COSTS'
+    try:
+        async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                rows = await conn.fetch(f'EXPLAIN ({options}) {query}', *args)
+            finally:
+                await transaction.rollback()
+    except Exception as e:
+        logger.warning("Не удалось получить план запроса %s: %s", name, e)
+        return
+    plan = '\n'.join(row[0] for row in rows)
+    logger.warning("План запроса %s (%s):\n%s", name, options, plan)
+
+def _record_acquire(scope: str, waited: float):
+    stats = _acquire_stats.get(scope)
+    if stats is None:
+        stats = _acquire_stats[scope] = [0, 0.0, 0.0]
+    stats[0] += 1
+    stats[1] += waited
+    stats[2] = max(stats[2], waited)
+    if waited >= SLOW_ACQUIRE_SECONDS:
+        logger.warning(
+            "Ожидание соединения для %s: %.0f мс (в пуле %s из %s, свободно %s, ждут %s)",
+            scope, waited * 1000, pool.get_size(), pool.get_max_size(), pool.get_idle_size(), _pool_waiting
+        )
+
+# Долгое ожидание соединения при быстрых запросах - нехватка пула; медленные запросы при
+# коротком ожидании - плохой план (см. планы в логе)
+def query_report(top: int = 15) -> str:
+    lines = [f"Ожидание соединения (топ {top}; раз, среднее, максимум):"]
+    for scope, (count, total, longest) in sorted(_acquire_stats.items(), key=lambda item: item[1][1], reverse=True)[:top]:
+        lines.append(f"  {count:6}  {total / count * 1000:7.1f} мс  {longest * 1000:7.0f} мс  {scope}")
+    lines.append("")
+    lines.append(f"Запросы по суммарному времени (топ {top}; раз, среднее, максимум, ошибок):")
+    for name, (count, total, longest, errors, _) in sorted(_query_stats.items(), key=lambda item: item[1][1], reverse=True)[:top]:
+        lines.append(f"  {count:6}  {total / count * 1000:7.1f} мс  {longest * 1000:7.0f} мс  {errors:4}  {name}")
+    return '\n'.join(lines)
+
+# База недоступна или автомат защиты разомкнут; обработчики отвечают пользователю сразу
+class DatabaseUnavailable(Exception):
+    pass
+
+# Ошибки, означающие недоступность базы, а не ошибку конкретного запроса
+_UNAVAILABLE_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.OperatorInterventionError,
+    asyncpg.InsufficientResourcesError,
+)
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+# Автомат защиты основной базы. Разомкнут - запросы отклоняются без ожидания пула;
+# по истечении BREAKER_OPEN_SECONDS пропускается один пробный запрос, его успех замыкает автомат.
+class CircuitBreaker:
+    def __init__(self):
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.opens = 0
+        self.rejected = 0
+
+    def before_request(self):
+        if self.state == BREAKER_OPEN and time.monotonic() - self.opened_at >= BREAKER_OPEN_SECONDS:
+            self.state = BREAKER_HALF_OPEN
+        if self.state == BREAKER_OPEN or (self.state == BREAKER_HALF_OPEN and self.probing):
+            self.rejected += 1
+            raise DatabaseUnavailable("Автомат защиты базы разомкнут")
+        if self.state == BREAKER_HALF_OPEN:
+            self.probing = True
+
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+        if self.state != BREAKER_CLOSED:
+            self.state = BREAKER_CLOSED
+            logger.warning("База снова доступна, автомат защиты замкнут")
+        if _queued_writes:
+            _schedule_replay()
+
+    def record_failure(self, error: Exception):
+        self.failures += 1
+        self.probing = False
+        if self.state == BREAKER_HALF_OPEN or (self.state == BREAKER_CLOSED and self.failures >= BREAKER_FAILURE_THRESHOLD):
+            if self.state == BREAKER_CLOSED:
+                logger.error("База недоступна (%s сбоев подряд), автомат защиты разомкнут: %r", self.failures, error)
+            self.state = BREAKER_OPEN
+            self.opened_at = time.monotonic()
+            self.opens += 1
+
+    # Прерванный запрос (отмена задачи) ничего не говорит о базе
+    def record_cancel(self):
+        self.probing = False
+
+breaker = CircuitBreaker()
+register_gauge('db_breaker_state', lambda: breaker.state)
+register_gauge('db_breaker_opens', lambda: breaker.opens)
+register_gauge('db_breaker_rejected', lambda: breaker.rejected)
+
+class _GuardedAcquire:
+    def __init__(self, raw_pool, scope: str):
+        self.pool = raw_pool
+        self.scope = scope
+        self.conn = None
+        self.token = None
+
+    async def __aenter__(self):
+        global _pool_waiting
+        breaker.before_request()
+        started = time.perf_counter()
+        _pool_waiting += 1
+        try:
+            self.conn = await self.pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+        except asyncio.CancelledError:
+            breaker.record_cancel()
+            raise
+        except _UNAVAILABLE_ERRORS as e:
+            breaker.record_failure(e)
+            raise DatabaseUnavailable(str(e) or type(e).__name__) from e
+        finally:
+            _pool_waiting -= 1
+            _record_acquire(self.scope, time.perf_counter() - started)
+        self.token = current_query_scope.set(self.scope)
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Сброс соединения при возврате в пул не относится к запросам функции
+        current_query_scope.reset(self.token)
+        try:
+            await self.pool.release(self.conn)
+        finally:
+            if exc_type is not None and issubclass(exc_type, asyncio.CancelledError):
+                breaker.record_cancel()
+            elif exc_type is not None and issubclass(exc_type, _UNAVAILABLE_ERRORS):
+                breaker.record_failure(exc)
+                raise DatabaseUnavailable(str(exc) or exc_type.__name__) from exc
+            else:
+                # Ошибки вроде нарушения уникальности тоже означают, что база ответила
+                breaker.record_success()
+        return False
+
+# Пул основной базы, у которого acquire() проходит через автомат защиты
+class GuardedPool:
+    def __init__(self, raw_pool):
+        self._pool = raw_pool
+
+    # scope - имя для трассировки; по умолчанию функция, вызвавшая acquire()
+    def acquire(self, scope: str = None):
+        return _GuardedAcquire(self._pool, scope or _caller_scope(1))
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
 def get_pool():
     if pool is None:
         raise RuntimeError("Database pool has not been initialized")
-    return pool
+    return GuardedPool(pool)
+
+# Последние успешно прочитанные данные: при недоступной базе возвращается снимок
+_snapshots = OrderedDict()  # (функция, бот, аргументы) -> результат
+
+def _keep_snapshot(func):
+    async def wrapper(*args):
+        key = (func.__name__, _bot(), *args)
+        try:
+            result = await func(*args)
+        except DatabaseUnavailable:
+            if key in _snapshots:
+                return _snapshots[key]
+            raise
+        _snapshots[key] = result
+        _snapshots.move_to_end(key)
+        while len(_snapshots) > MAX_SNAPSHOTS:
+            _snapshots.popitem(last=False)
+        return result
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+# Записи, отложенные до восстановления базы: (бот, фабрика корутины)
+_queued_writes = deque()
+_replay_task = None
+register_gauge('db_queued_writes', lambda: len(_queued_writes))
+
+# Возвращает False, если очередь переполнена
+def queue_write(write) -> bool:
+    if len(_queued_writes) >= MAX_QUEUED_WRITES:
+        return False
+    _queued_writes.append((_bot(), write))
+    return True
+
+def _schedule_replay():
+    global _replay_task
+    if _replay_task is None or _replay_task.done():
+        _replay_task = asyncio.get_running_loop().create_task(_replay_writes())
+
+async def _replay_writes():
+    replayed = 0
+    while _queued_writes:
+        bot_id, write = _queued_writes[0]
+        bind_bot(bot_id)
+        try:
+            await write()
+        except DatabaseUnavailable:
+            logger.warning("База снова недоступна, повтор отложенных записей прерван (осталось %s)", len(_queued_writes))
+            return
+        except Exception as e:
+            logger.error("Ошибка при повторе отложенной записи: %s", e)
+        _queued_writes.popleft()
+        replayed += 1
+    logger.info("Повторено отложенных записей: %s", replayed)
+
+def _mark_write(*keys):
+    now = time.monotonic()
+    for key in keys:
+        _recent_writes[key] = now
+    if len(_recent_writes) > 10000:
+        for key, written_at in list(_recent_writes.items()):
+            if now - written_at > READ_YOUR_WRITES_WINDOW:
+                del _recent_writes[key]
+
+def _use_replica(keys) -> bool:
+    if replica_pool is None or not replica_healthy:
+        return False
+    now = time.monotonic()
+    return all(now - _recent_writes.get(key, -READ_YOUR_WRITES_WINDOW) >= READ_YOUR_WRITES_WINDOW for key in keys)
+
+# Чтение без побочных эффектов: реплика, если она в порядке и пользователи из keys
+# недавно ничего не записывали, иначе (или при ошибке реплики) - основная база
+async def _read(keys, method: str, query: str, *args):
+    global replica_healthy
+    if _use_replica(keys):
+        try:
+            async with replica_pool.acquire() as conn:
+                token = current_query_scope.set(_caller_scope(1) + '@replica')
+                try:
+                    return await getattr(conn, method)(query, *args)
+                finally:
+                    current_query_scope.reset(token)
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+            logger.warning("Ошибка чтения с реплики, повтор на основной базе: %s", e)
+            replica_healthy = False
+
+    async with get_pool().acquire(_caller_scope(1)) as conn:
+        return await getattr(conn, method)(query, *args)
+
+# Отдельное соединение с основной базой для LISTEN (не из пула): callback(bot_id, owner_id)
+# вызывается на изменения списков, сделанные любым экземпляром бота
+async def connect_listener(callback):
+    def on_notify(connection, pid, channel, payload):
+        try:
+            bot_id, owner_id = payload.split(':')
+            callback(int(bot_id), int(owner_id))
+        except ValueError:
+            logger.warning("Некорректное уведомление %s: %s", channel, payload)
+
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await conn.add_listener(WISHLIST_CHANNEL, on_notify)
+    except BaseException:
+        conn.terminate()
+        raise
+    return conn
+
+def add_wishlist_listener(callback):
+    _wishlist_listeners.append(callback)
+
+# Сообщает всем экземплярам бота, что списки владельцев изменились.
+# NOTIFY доставляется после фиксации транзакции; локальные подписчики вызываются сразу.
+async def _notify_wishlist_changed(conn, *owner_ids):
+    owner_ids = [owner_id for owner_id in set(owner_ids) if owner_id is not None]
+    if not owner_ids:
+        return
+    bot_id = _bot()
+    await conn.execute(
+        "SELECT pg_notify($1, $2::bigint::text || ':' || owner_id::text) FROM unnest($3::bigint[]) AS owner_id",
+        WISHLIST_CHANNEL, bot_id, owner_ids
+    )
+    for owner_id in owner_ids:
+        for callback in _wishlist_listeners:
+            callback(bot_id, owner_id)
+
+# Инкрементальное обновление счетчиков /stats в том же соединении, что и сама запись.
+# totals - итоговые значения (могут уменьшаться), daily - события за текущий день.
+async def _bump_stats(conn, totals: dict, daily: dict = None):
+    totals = {metric: delta for metric, delta in totals.items() if delta}
+    daily = {metric: delta for metric, delta in (daily or {}).items() if delta}
+    if not totals and not daily:
+        return
+    await conn.execute('''
+        WITH totals AS (
+            INSERT INTO stats_counters (bot_id, metric, value)
+            SELECT $1, * FROM unnest($2::text[], $3::bigint[])
+            ON CONFLICT (bot_id, metric) DO UPDATE SET value = stats_counters.value + EXCLUDED.value
+        )
+        INSERT INTO stats_daily (bot_id, day, metric, value)
+        SELECT $1, CURRENT_DATE, * FROM unnest($4::text[], $5::bigint[])
+        ON CONFLICT (bot_id, day, metric) DO UPDATE SET value = stats_daily.value + EXCLUDED.value
+    ''', _bot(), list(totals), list(totals.values()), list(daily), list(daily.values()))
 
 async def register_user(user):
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute('''
+                INSERT INTO users (id, username, first_name)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (id) DO NOTHING;
+            ''', user.id, user.username, user.first_name)
+            # Пользователь, написавший боту, снова доступен для рассылок
+            is_new = await conn.fetchval('''
+                INSERT INTO bot_users (bot_id, user_id)
+                VALUES ($1, $2)
+                ON CONFLICT (bot_id, user_id) DO UPDATE SET delivery_status = 'ok'
+                WHERE bot_users.delivery_status <> 'ok'
+                RETURNING xmax = 0;
+            ''', _bot(), user.id)
+            if is_new:
+                await _bump_stats(conn, {'users': 1}, {'new_users': 1})
+        if is_new:
+            _mark_write(user.id)
+
+async def record_user_activity(user_id: int):
     pool = get_pool()
     async with pool.acquire() as conn:
         await conn.execute('''
-            INSERT INTO users (id, username, first_name)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (id) DO NOTHING;
-        ''', user.id, user.username, user.first_name)
+            WITH seen AS (
+                INSERT INTO user_activity (bot_id, day, user_id)
+                VALUES ($1, CURRENT_DATE, $2)
+                ON CONFLICT DO NOTHING
+                RETURNING 1
+            )
+            INSERT INTO stats_daily (bot_id, day, metric, value)
+            SELECT $1, CURRENT_DATE, 'active_users', 1 FROM seen
+            ON CONFLICT (bot_id, day, metric) DO UPDATE SET value = stats_daily.value + 1
+        ''', _bot(), user_id)
 
 async def add_link_to_wishlist(user_id, link):
     pool = get_pool()
     async with pool.acquire() as conn:
-        record = await conn.fetchrow('''
-            INSERT INTO wishlist (user_id, link)
-            VALUES ($1, $2)
-            RETURNING id;
-        ''', user_id, link)
+        async with conn.transaction():
+            record = await conn.fetchrow('''
+                INSERT INTO wishlist (bot_id, user_id, link)
+                VALUES ($1, $2, $3)
+                RETURNING id;
+            ''', _bot(), user_id, link)
+            await _bump_stats(conn, {'gifts': 1}, {'new_gifts': 1})
+            await _notify_wishlist_changed(conn, user_id)
+        _mark_write(user_id)
         return record['id']
 
+# Добавляет ссылки пачкой одной транзакцией: уже имеющиеся в списке пропускаются, сверх limit не добавляются.
+# Возвращает (добавленные строки id, link по порядку ссылок; дубликаты; не поместившиеся в лимит).
+# Блокировка на (бот, пользователь) не дает параллельным пачкам вместе превысить лимит.
+async def add_links_to_wishlist(user_id: int, links: list, limit: int):
+    links = list(dict.fromkeys(links))
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                "SELECT pg_advisory_xact_lock(hashtextextended('wishlist:' || $1::bigint::text || ':' || $2::bigint::text, 0))",
+                _bot(), user_id
+            )
+            existing = await conn.fetch('SELECT link FROM wishlist WHERE bot_id = $1 AND user_id = $2', _bot(), user_id)
+            known = {row['link'] for row in existing}
+            duplicates = [link for link in links if link in known]
+            fresh = [link for link in links if link not in known]
+            room = max(limit - len(existing), 0)
+            added = []
+            if fresh[:room]:
+                added = await conn.fetch('''
+                    INSERT INTO wishlist (bot_id, user_id, link)
+                    SELECT $1, $2, link FROM unnest($3::text[]) WITH ORDINALITY AS batch(link, position)
+                    ORDER BY position
+                    RETURNING id, link
+                ''', _bot(), user_id, fresh[:room])
+                added = sorted(added, key=lambda row: row['id'])
+                await _bump_stats(conn, {'gifts': len(added)}, {'new_gifts': len(added)})
+                await _notify_wishlist_changed(conn, user_id)
+        if added:
+            _mark_write(user_id)
+        return added, duplicates, fresh[room:]
+
+async def count_user_gifts(user_id: int) -> int:
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval('SELECT COUNT(*) FROM wishlist WHERE bot_id = $1 AND user_id = $2', _bot(), user_id)
+
+# Выравнивает последовательность id подарков после ручного переноса данных
+async def sync_wishlist_sequence():
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT setval('wishlist_id_seq', (SELECT MAX(id) FROM wishlist))")
+
 async def get_user_wishlist(user_id):
+    return await _read((user_id,), 'fetch', '''
+        SELECT id, link 
+        FROM wishlist 
+        WHERE bot_id = $1 AND user_id = $2
+        ORDER BY id
+    ''', _bot(), user_id)
+
+# Подарки владельца вместе с тем, кем они забронированы, одним запросом
+# Снимок для кэша списков (wishlist_cache.py) - только с основной базы: после NOTIFY от другого
+# экземпляра реплика может еще не содержать изменение, а загруженное хранится до CACHE_TTL
+async def get_wishlist_snapshot(owner_id: int):
     pool = get_pool()
     async with pool.acquire() as conn:
         return await conn.fetch('''
-            SELECT id, link 
-            FROM wishlist 
-            WHERE user_id = $1
-            ORDER BY id
-        ''', user_id)
+            SELECT w.id, w.link, r.reserved_by
+            FROM wishlist w
+            LEFT JOIN reservations r ON r.gift_id = w.id
+            WHERE w.bot_id = $1 AND w.user_id = $2
+            ORDER BY w.id
+        ''', _bot(), owner_id)
 
-async def delete_gift_by_id(gift_id: int):
+# Удаляет выбранные подарки владельца одним запросом. Возвращает удаленные подарки
+# и тех, кто их бронировал (брони видны из снимка до каскадного удаления).
+async def delete_gifts(user_id: int, gift_ids: list):
     pool = get_pool()
     async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM wishlist WHERE id = $1", gift_id)
+        async with conn.transaction():
+            deleted = await conn.fetch('''
+                WITH deleted AS (
+                    DELETE FROM wishlist
+                    WHERE id = ANY($1::int[]) AND bot_id = $2 AND user_id = $3
+                    RETURNING id, link
+                )
+                SELECT d.id, d.link, r.reserved_by
+                FROM deleted d
+                LEFT JOIN reservations r ON r.gift_id = d.id
+            ''', gift_ids, _bot(), user_id)
+            reserved = sum(1 for row in deleted if row['reserved_by'])
+            await _bump_stats(conn, {'gifts': -len(deleted), 'reservations': -reserved})
+            if deleted:
+                await _notify_wishlist_changed(conn, user_id)
+        _mark_write(user_id, *(('gift', row['id']) for row in deleted))
+        return deleted
 
-async def get_user_by_id(user_id: int):
+# Возвращает True, если статус изменился. bot_id передается явно из запросов к Bot API,
+# которые могут выполняться вне задачи с привязанным ботом.
+async def set_delivery_status(user_id: int, status: str, bot_id: int = None) -> bool:
     pool = get_pool()
     async with pool.acquire() as conn:
-        return await conn.fetchrow('SELECT * FROM users WHERE id = $1', user_id)
+        result = await conn.execute(
+            'UPDATE bot_users SET delivery_status = $3 WHERE bot_id = $1 AND user_id = $2 AND delivery_status <> $3',
+            bot_id or _bot(), user_id, status
+        )
+        return result != 'UPDATE 0'
 
-async def get_friends(user_id: int):
+async def get_last_update_id() -> int:
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval('SELECT last_update_id FROM bot_state WHERE bot_id = $1', _bot()) or 0
+
+# Смещение только растет: сохранение из периодической задачи не должно перезаписать более позднее
+async def save_last_update_id(update_id: int):
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO bot_state (bot_id, last_update_id) VALUES ($1, $2)
+            ON CONFLICT (bot_id) DO UPDATE
+            SET last_update_id = GREATEST(bot_state.last_update_id, EXCLUDED.last_update_id), updated_at = NOW()
+        ''', _bot(), update_id)
+
+# Напоминание о событии приходит за days_before дней в remind_hour часов (время сервера БД)
+async def add_occasion(user_id: int, title: str, base_date, next_date, yearly: bool,
+                       days_before: int, remind_hour: int) -> int:
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        occasion_id = await conn.fetchval('''
+            INSERT INTO occasions (bot_id, user_id, title, base_date, next_date, yearly, remind_at)
+            VALUES ($1, $2, $3, $4, $5, $6, ($5::date - $7::int) + make_interval(hours => $8))
+            RETURNING id
+        ''', _bot(), user_id, title, base_date, next_date, yearly, days_before, remind_hour)
+        _mark_write(user_id)
+        return occasion_id
+
+async def get_user_occasions(user_id: int):
+    return await _read((user_id,), 'fetch', '''
+        SELECT id, title, next_date, yearly FROM occasions
+        WHERE bot_id = $1 AND user_id = $2 AND (yearly OR next_date >= CURRENT_DATE)
+        ORDER BY next_date, id
+    ''', _bot(), user_id)
+
+async def delete_occasion(user_id: int, occasion_id: int) -> bool:
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        result = await conn.execute(
+            'DELETE FROM occasions WHERE id = $1 AND bot_id = $2 AND user_id = $3',
+            occasion_id, _bot(), user_id
+        )
+        _mark_write(user_id)
+        return result != 'DELETE 0'
+
+# Берет до limit наступивших напоминаний в аренду на lease_seconds, поэтому параллельные
+# экземпляры бота не возьмут одно событие дважды. На следующее наступление напоминания
+# переводит complete_occasions после рассылки; не завершенные к сроку аренды выбираются снова.
+async def claim_due_occasions(limit: int, lease_seconds: int = 3600):
     pool = get_pool()
     async with pool.acquire() as conn:
         return await conn.fetch('''
-            SELECT u.id, u.username, u.first_name 
-            FROM friends f 
-            JOIN users u ON f.friend_id = u.id 
-            WHERE f.user_id = $1
-        ''', user_id)
+            WITH due AS (
+                SELECT id
+                FROM occasions
+                WHERE bot_id = $1 AND remind_at <= NOW()
+                  AND (claimed_at IS NULL OR claimed_at <= NOW() - make_interval(secs => $3))
+                ORDER BY remind_at
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            ), claimed AS (
+                UPDATE occasions o SET claimed_at = NOW()
+                FROM due
+                WHERE o.id = due.id
+                RETURNING o.id, o.user_id, o.title, o.next_date AS occasion_date
+            )
+            SELECT c.*, u.first_name, u.username
+            FROM claimed c
+            JOIN users u ON u.id = c.user_id
+        ''', _bot(), limit, lease_seconds)
+
+# Переводит разосланные напоминания на следующее наступление (разовые - снимает).
+# Следующая дата считается от base_date, чтобы 29 февраля возвращалось в високосные годы.
+# Уже завершенные (аренда истекла и событие взял другой экземпляр) повторно не сдвигаются.
+async def complete_occasions(occasion_ids: list, days_before: int, remind_hour: int):
+    if not occasion_ids:
+        return
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute('''
+            UPDATE occasions o SET
+                next_date = COALESCE(n.following_date, o.next_date),
+                remind_at = (n.following_date - $3::int) + make_interval(hours => $4),
+                claimed_at = NULL
+            FROM (
+                SELECT id, CASE WHEN yearly THEN (base_date + make_interval(
+                           years => EXTRACT(YEAR FROM next_date)::int + 1 - EXTRACT(YEAR FROM base_date)::int
+                       ))::date END AS following_date
+                FROM occasions
+                WHERE bot_id = $1 AND id = ANY($2::int[]) AND claimed_at IS NOT NULL
+            ) n
+            WHERE o.id = n.id
+        ''', _bot(), occasion_ids, days_before, remind_hour)
+
+# Друзья сразу многих пользователей одним запросом; только те, кому можно писать
+async def get_friends_of_users(user_ids: list):
+    return await _read((), 'fetch', '''
+        SELECT f.user_id, f.friend_id
+        FROM friends f
+        JOIN bot_users b ON b.bot_id = f.bot_id AND b.user_id = f.friend_id
+        WHERE f.bot_id = $1 AND f.user_id = ANY($2::bigint[]) AND b.delivery_status = 'ok'
+    ''', _bot(), user_ids)
+
+async def get_reachable_user_ids():
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("SELECT user_id FROM bot_users WHERE bot_id = $1 AND delivery_status = 'ok'", _bot())
+        return [row['user_id'] for row in rows]
+
+async def filter_reachable(user_ids) -> set:
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT user_id FROM bot_users WHERE bot_id = $1 AND user_id = ANY($2::bigint[]) AND delivery_status = 'ok'",
+            _bot(), list(user_ids)
+        )
+        return {row['user_id'] for row in rows}
+
+def _like_pattern(text: str) -> str:
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+# Поиск подарков в своем списке и списках друзей; страницы идут по возрастанию id (после after_id).
+# Триграммного индекса нет намеренно: подарки выбираются по владельцам (пользователь и его друзья)
+# по индексу wishlist_bot_user_idx - не больше лимита списка на владельца, - и только затем
+# фильтруются по подстроке, так что работа не зависит от размера таблицы. План на PostgreSQL 16
+# (300 друзей, 300 тыс. подарков у бота): Index Scan по wishlist_bot_user_idx, 4.5 тыс. строк, ~6 мс
+async def search_gifts(user_id: int, text: str, after_id: int = 0, limit: int = 5):
+    return await _read((user_id,), 'fetch', '''
+        SELECT w.id, w.link, w.title, w.user_id AS owner_id, u.first_name AS owner_name, r.reserved_by
+        FROM wishlist w
+        JOIN users u ON u.id = w.user_id
+        LEFT JOIN reservations r ON r.gift_id = w.id
+        WHERE w.bot_id = $1
+          AND w.user_id = ANY($2::bigint || ARRAY(SELECT friend_id FROM friends WHERE bot_id = $1 AND user_id = $2))
+          AND (w.link || ' ' || COALESCE(w.title, '')) ILIKE $3
+          AND w.id > $4
+        ORDER BY w.id
+        LIMIT $5
+    ''', _bot(), user_id, _like_pattern(text), after_id, limit)
+
+# Пользователь этого бота (None, если он не запускал бота)
+@_keep_snapshot
+async def get_user_by_id(user_id: int):
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchrow('''
+            SELECT u.*, b.delivery_status
+            FROM bot_users b
+            JOIN users u ON u.id = b.user_id
+            WHERE b.bot_id = $1 AND b.user_id = $2
+        ''', _bot(), user_id)
+
+@_keep_snapshot
+async def get_friends(user_id: int):
+    return await _read((user_id,), 'fetch', '''
+        SELECT u.id, u.username, u.first_name 
+        FROM friends f 
+        JOIN users u ON f.friend_id = u.id 
+        WHERE f.bot_id = $1 AND f.user_id = $2
+    ''', _bot(), user_id)
 
 async def remove_friend(user_id: int, friend_id: int):
     pool = get_pool()
     async with pool.acquire() as conn:
         async with conn.transaction():
-            await conn.execute('''
-                DELETE FROM friends 
-                WHERE (user_id = $1 AND friend_id = $2) 
-                OR (user_id = $2 AND friend_id = $1)
-            ''', user_id, friend_id)
-            await conn.execute('''
-                DELETE FROM friend_requests 
-                WHERE (from_user_id = $1 AND to_user_id = $2) 
-                OR (from_user_id = $2 AND to_user_id = $1)
-            ''', user_id, friend_id)
+            friends_deleted = await conn.fetchval('''
+                WITH deleted AS (
+                    DELETE FROM friends 
+                    WHERE bot_id = $1 AND ((user_id = $2 AND friend_id = $3) 
+                    OR (user_id = $3 AND friend_id = $2))
+                    RETURNING 1
+                )
+                SELECT COUNT(*) FROM deleted
+            ''', _bot(), user_id, friend_id)
+            pending_deleted = await conn.fetchval('''
+                WITH deleted AS (
+                    DELETE FROM friend_requests 
+                    WHERE bot_id = $1 AND ((from_user_id = $2 AND to_user_id = $3) 
+                    OR (from_user_id = $3 AND to_user_id = $2))
+                    RETURNING status
+                )
+                SELECT COUNT(*) FROM deleted WHERE status = 'pending'
+            ''', _bot(), user_id, friend_id)
+            await _bump_stats(conn, {'friendships': -(friends_deleted // 2), 'pending_requests': -pending_deleted})
+        _mark_write(user_id, friend_id)
 
-async def add_feedback(user_id: int, username: str, text: str):
+async def add_feedback(user_id: int, username: str, text: str, media_type: str = None, file_id: str = None):
     pool = get_pool()
     async with pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO feedback (user_id, username, text)
-            VALUES ($1, $2, $3);
-        ''', user_id, username, text)
+        async with conn.transaction():
+            await conn.execute('''
+                INSERT INTO feedback (bot_id, user_id, username, text, media_type, file_id)
+                VALUES ($1, $2, $3, $4, $5, $6);
+            ''', _bot(), user_id, username, text, media_type, file_id)
+            await _bump_stats(conn, {'feedback': 1}, {'feedback': 1})
 
 async def create_friend_request(from_user_id: int, to_user_id: int) -> bool:
     pool = get_pool()
@@ -156,22 +1082,25 @@ async def create_friend_request(from_user_id: int, to_user_id: int) -> bool:
         exists = await conn.fetchval('''
             SELECT EXISTS(
                 SELECT 1 FROM friend_requests 
-                WHERE (from_user_id = $1 AND to_user_id = $2)
-                   OR (from_user_id = $2 AND to_user_id = $1)
+                WHERE bot_id = $1 AND ((from_user_id = $2 AND to_user_id = $3)
+                   OR (from_user_id = $3 AND to_user_id = $2))
             ) OR EXISTS(
                 SELECT 1 FROM friends 
-                WHERE (user_id = $1 AND friend_id = $2)
-                   OR (user_id = $2 AND friend_id = $1)
+                WHERE bot_id = $1 AND ((user_id = $2 AND friend_id = $3)
+                   OR (user_id = $3 AND friend_id = $2))
             )
-        ''', from_user_id, to_user_id)
+        ''', _bot(), from_user_id, to_user_id)
 
         if exists:
             return False
 
-        await conn.execute('''
-            INSERT INTO friend_requests (from_user_id, to_user_id)
-            VALUES ($1, $2)
-        ''', from_user_id, to_user_id)
+        async with conn.transaction():
+            await conn.execute('''
+                INSERT INTO friend_requests (bot_id, from_user_id, to_user_id)
+                VALUES ($1, $2, $3)
+            ''', _bot(), from_user_id, to_user_id)
+            await _bump_stats(conn, {'pending_requests': 1}, {'friend_requests': 1})
+        _mark_write(from_user_id, to_user_id)
         return True
 
 async def update_friend_request(from_user_id: int, to_user_id: int, status: str) -> bool:
@@ -180,53 +1109,54 @@ async def update_friend_request(from_user_id: int, to_user_id: int, status: str)
         async with conn.transaction():
             request = await conn.fetchrow('''
                 SELECT * FROM friend_requests 
-                WHERE from_user_id = $1 AND to_user_id = $2 AND status = 'pending'
+                WHERE bot_id = $1 AND from_user_id = $2 AND to_user_id = $3 AND status = 'pending'
                 LIMIT 1
                 FOR UPDATE
-            ''', from_user_id, to_user_id)
+            ''', _bot(), from_user_id, to_user_id)
 
             if not request:
                 return False
 
+            accepted = 0
             if status == 'accept':
-                await conn.execute('''
-                    INSERT INTO friends (user_id, friend_id) 
-                    VALUES ($1, $2), ($2, $1)
+                result = await conn.execute('''
+                    INSERT INTO friends (bot_id, user_id, friend_id) 
+                    VALUES ($1, $2, $3), ($1, $3, $2)
                     ON CONFLICT DO NOTHING
-                ''', from_user_id, to_user_id)
+                ''', _bot(), from_user_id, to_user_id)
+                accepted = 1 if result == 'INSERT 0 2' else 0
 
             await conn.execute('''
                 DELETE FROM friend_requests 
                 WHERE id = $1
             ''', request['id'])
+            await _bump_stats(conn, {'pending_requests': -1, 'friendships': accepted}, {'new_friendships': accepted})
 
-            return True
+        _mark_write(from_user_id, to_user_id)
+        return True
 
+@_keep_snapshot
 async def get_pending_requests(to_user_id: int):
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        return await conn.fetch('''
-            SELECT fr.from_user_id, u.username, u.first_name
-            FROM friend_requests fr
-            JOIN users u ON fr.from_user_id = u.id
-            WHERE fr.to_user_id = $1 AND fr.status = 'pending'
-        ''', to_user_id)
+    return await _read((to_user_id,), 'fetch', '''
+        SELECT fr.from_user_id, u.username, u.first_name
+        FROM friend_requests fr
+        JOIN users u ON fr.from_user_id = u.id
+        WHERE fr.bot_id = $1 AND fr.to_user_id = $2 AND fr.status = 'pending'
+    ''', _bot(), to_user_id)
 
 async def check_friendship(user_id1: int, user_id2: int) -> bool:
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        return await conn.fetchval('''
-            SELECT EXISTS(
-                SELECT 1 FROM friends 
-                WHERE (user_id = $1 AND friend_id = $2)
-                   OR (user_id = $2 AND friend_id = $1)
-            )
-        ''', user_id1, user_id2)
+    return await _read((user_id1, user_id2), 'fetchval', '''
+        SELECT EXISTS(
+            SELECT 1 FROM friends 
+            WHERE bot_id = $1 AND ((user_id = $2 AND friend_id = $3)
+               OR (user_id = $3 AND friend_id = $2))
+        )
+    ''', _bot(), user_id1, user_id2)
 
 async def reserve_gift(gift_id: int, user_id: int):
     pool = get_pool()
     async with pool.acquire() as conn:
-        gift = await conn.fetchrow('SELECT user_id FROM wishlist WHERE id = $1', gift_id)
+        gift = await conn.fetchrow('SELECT user_id FROM wishlist WHERE id = $1 AND bot_id = $2', gift_id, _bot())
         if not gift:
             return False
 
@@ -240,43 +1170,244 @@ async def reserve_gift(gift_id: int, user_id: int):
         if existing:
             return False
 
-        await conn.execute(
-            'INSERT INTO reservations (gift_id, reserved_by) VALUES ($1, $2)',
-            gift_id, user_id
-        )
+        async with conn.transaction():
+            await conn.execute(
+                'INSERT INTO reservations (gift_id, reserved_by, expires_at) '
+                'VALUES ($1, $2, NOW() + make_interval(days => $3))',
+                gift_id, user_id, RESERVATION_DAYS
+            )
+            await _bump_stats(conn, {'reservations': 1}, {'new_reservations': 1})
+            await _notify_wishlist_changed(conn, gift['user_id'])
+        _mark_write(user_id, gift['user_id'], ('gift', gift_id))
         return True
 
 async def cancel_reservation(gift_id: int, user_id: int):
     pool = get_pool()
     async with pool.acquire() as conn:
-        result = await conn.execute(
-            'DELETE FROM reservations WHERE gift_id = $1 AND reserved_by = $2',
-            gift_id, user_id
-        )
-        return result != 'DELETE 0'
+        async with conn.transaction():
+            owner_id = await conn.fetchval('''
+                DELETE FROM reservations r
+                USING wishlist w
+                WHERE r.gift_id = $1 AND r.reserved_by = $2 AND w.id = r.gift_id AND w.bot_id = $3
+                RETURNING w.user_id
+            ''', gift_id, user_id, _bot())
+            cancelled = owner_id is not None
+            if cancelled:
+                await _bump_stats(conn, {'reservations': -1})
+                await _notify_wishlist_changed(conn, owner_id)
+        if cancelled:
+            _mark_write(user_id, owner_id, ('gift', gift_id))
+        return cancelled
+
+async def get_gift_info(gift_id: int):
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchrow('''
+            SELECT w.link, w.user_id AS owner_id, u.first_name, b.delivery_status = 'ok' AS owner_reachable
+            FROM wishlist w
+            JOIN users u ON w.user_id = u.id
+            JOIN bot_users b ON b.bot_id = w.bot_id AND b.user_id = w.user_id
+            WHERE w.id = $1 AND w.bot_id = $2
+        ''', gift_id, _bot())
+
+# Подарки владельца, забронированные указанным пользователем
+async def get_reserved_gifts(owner_id: int, reserver_id: int):
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetch('''
+            SELECT w.id, w.link FROM wishlist w
+            JOIN reservations r ON w.id = r.gift_id
+            WHERE w.bot_id = $1 AND w.user_id = $2 AND r.reserved_by = $3
+            ORDER BY w.id
+        ''', _bot(), owner_id, reserver_id)
 
 async def get_reservation_info(gift_id: int):
+    return await _read(
+        (('gift', gift_id),), 'fetchrow',
+        'SELECT r.*, u.first_name, u.username FROM reservations r '
+        'JOIN users u ON r.reserved_by = u.id '
+        'WHERE r.gift_id = $1',
+        gift_id
+    )
+
+# Страховочная очистка броней, которые планировщик не успел обработать
+async def check_old_reservations(grace_seconds: int = 3600):
     pool = get_pool()
     async with pool.acquire() as conn:
-        return await conn.fetchrow(
-            'SELECT r.*, u.first_name, u.username FROM reservations r '
-            'JOIN users u ON r.reserved_by = u.id '
-            'WHERE r.gift_id = $1',
-            gift_id
-        )
+        async with conn.transaction():
+            owners = await conn.fetch('''
+                DELETE FROM reservations r
+                USING wishlist w
+                WHERE r.expires_at <= NOW() - make_interval(secs => $1) AND w.id = r.gift_id AND w.bot_id = $2
+                RETURNING w.user_id
+            ''', grace_seconds, _bot())
+            expired = len(owners)
+            await _bump_stats(conn, {'reservations': -expired}, {'expired_reservations': expired})
+            await _notify_wishlist_changed(conn, *(row['user_id'] for row in owners))
+        return expired
 
-async def check_old_reservations():
+async def get_db_time():
     pool = get_pool()
     async with pool.acquire() as conn:
-        old_reservations = await conn.fetch(
-            'SELECT r.id FROM reservations r '
-            'WHERE r.reserved_at < NOW() - INTERVAL \'10 days\''
+        return await conn.fetchval('SELECT NOW()::timestamp')
+
+# Брони, истекающие в интервале (after, until]; after = None - с начала времен
+async def get_expiring_reservations(after, until):
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetch('''
+            SELECT r.id, r.gift_id, r.reserved_by, r.expires_at, r.reminded,
+                   w.link, w.user_id AS owner_id,
+                   COALESCE(b.delivery_status = 'ok', FALSE) AS reserver_reachable
+            FROM reservations r
+            JOIN wishlist w ON w.id = r.gift_id
+            LEFT JOIN bot_users b ON b.bot_id = w.bot_id AND b.user_id = r.reserved_by
+            WHERE r.expires_at > COALESCE($1, '-infinity'::timestamp)
+              AND r.expires_at <= $2
+              AND w.bot_id = $3
+            ORDER BY r.expires_at
+        ''', after, until, _bot())
+
+# Возвращает True только одному из экземпляров бота, чтобы напоминание не ушло дважды
+async def mark_reservation_reminded(reservation_id: int) -> bool:
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        result = await conn.execute(
+            'UPDATE reservations SET reminded = TRUE WHERE id = $1 AND NOT reminded',
+            reservation_id
         )
+        return result == 'UPDATE 1'
+
+async def expire_reservation(reservation_id: int) -> bool:
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            owner_id = await conn.fetchval('''
+                DELETE FROM reservations r
+                USING wishlist w
+                WHERE r.id = $1 AND r.expires_at <= NOW() AND w.id = r.gift_id
+                RETURNING w.user_id
+            ''', reservation_id)
+            expired = owner_id is not None
+            if expired:
+                await _bump_stats(conn, {'reservations': -1}, {'expired_reservations': 1})
+                await _notify_wishlist_changed(conn, owner_id)
+        return expired
+
+async def has_pending_request(from_user_id: int, to_user_id: int) -> bool:
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval('''
+            SELECT EXISTS(
+                SELECT 1 FROM friend_requests
+                WHERE bot_id = $1 AND from_user_id = $2 AND to_user_id = $3 AND status = 'pending'
+            )
+        ''', _bot(), from_user_id, to_user_id)
+
+async def delete_pending_request(from_user_id: int, to_user_id: int):
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            result = await conn.execute(
+                'DELETE FROM friend_requests WHERE bot_id = $1 AND from_user_id = $2 AND to_user_id = $3 AND status = $4',
+                _bot(), from_user_id, to_user_id, 'pending'
+            )
+            if result != 'DELETE 0':
+                await _bump_stats(conn, {'pending_requests': -1})
+        _mark_write(from_user_id, to_user_id)
+
+async def get_stats(days: int = 7):
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        totals = await conn.fetch('SELECT metric, value FROM stats_counters WHERE bot_id = $1', _bot())
+        series = await conn.fetch('''
+            SELECT day, metric, value
+            FROM stats_daily
+            WHERE bot_id = $1 AND day > CURRENT_DATE - $2::int
+            ORDER BY day
+        ''', _bot(), days)
+    daily = {}
+    for row in series:
+        daily.setdefault(row['day'], {})[row['metric']] = row['value']
+    return {row['metric']: row['value'] for row in totals}, daily
 
-        for reservation in old_reservations:
+# Сверка счетчиков с таблицами (страховка от рассинхронизации) и очистка старой активности.
+# Запускается фоновой задачей раз в сутки, на чтение /stats не влияет.
+async def refresh_stats(keep_activity_days: int = 30):
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute('''
+                INSERT INTO stats_counters (bot_id, metric, value)
+                SELECT $1, 'users', COUNT(*) FROM bot_users WHERE bot_id = $1
+                UNION ALL SELECT $1, 'gifts', COUNT(*) FROM wishlist WHERE bot_id = $1
+                UNION ALL SELECT $1, 'reservations', COUNT(*) FROM reservations r
+                    JOIN wishlist w ON w.id = r.gift_id WHERE w.bot_id = $1
+                UNION ALL SELECT $1, 'pending_requests', COUNT(*) FROM friend_requests
+                    WHERE bot_id = $1 AND status = 'pending'
+                UNION ALL SELECT $1, 'friendships', COUNT(*) / 2 FROM friends WHERE bot_id = $1
+                UNION ALL SELECT $1, 'feedback', COUNT(*) FROM feedback WHERE bot_id = $1
+                ON CONFLICT (bot_id, metric) DO UPDATE SET value = EXCLUDED.value
+            ''', _bot())
             await conn.execute(
-                'DELETE FROM reservations WHERE id = $1',
-                reservation['id']
+                'DELETE FROM user_activity WHERE bot_id = $1 AND day < CURRENT_DATE - $2::int',
+                _bot(), keep_activity_days
             )
 
-        return len(old_reservations)
\ No newline at end of file
+# Берет пачку недоставленных отзывов в аренду на lease_seconds (claimed_at); SKIP LOCKED
+# позволяет нескольким экземплярам бота разбирать очередь без дублей. После отправки
+# отзывы помечает доставленными mark_feedback_delivered, неотправленные возвращает в очередь
+# release_feedback; если экземпляр упал, не сделав ни того ни другого, по истечении аренды
+# отзывы выбираются снова.
+async def claim_feedback_batch(limit: int, lease_seconds: int = 900):
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch('''
+            UPDATE feedback SET claimed_at = NOW()
+            WHERE id IN (
+                SELECT id FROM feedback
+                WHERE delivered_at IS NULL AND bot_id = $1
+                  AND (claimed_at IS NULL OR claimed_at <= NOW() - make_interval(secs => $3))
+                ORDER BY id
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, user_id, username, text, media_type, file_id, created_at
+        ''', _bot(), limit, lease_seconds)
+    return sorted(rows, key=lambda row: row['id'])
+
+async def mark_feedback_delivered(feedback_ids: list):
+    if not feedback_ids:
+        return
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute(
+            'UPDATE feedback SET delivered_at = NOW(), claimed_at = NULL WHERE id = ANY($1::int[])',
+            feedback_ids
+        )
+
+# Возвращает отзывы в очередь до истечения аренды, если доставить их не удалось
+async def release_feedback(feedback_ids: list):
+    if not feedback_ids:
+        return
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute(
+            'UPDATE feedback SET claimed_at = NULL WHERE id = ANY($1::int[]) AND delivered_at IS NULL',
+            feedback_ids
+        )
+
+# Отзывы за [start, end) страницами по (created_at, id); after - (created_at, id)
+# последнего отзыва предыдущей страницы
+async def get_feedback_between(start, end, after: tuple = None, limit: int = 50):
+    after_created_at, after_id = after or (start, 0)
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetch('''
+            SELECT id, user_id, username, text, media_type, created_at
+            FROM feedback
+            WHERE bot_id = $1 AND created_at >= $2 AND created_at < $3
+              AND (created_at, id) > ($4, $5)
+            ORDER BY created_at, id
+            LIMIT $6
+        ''', _bot(), start, end, after_created_at, after_id, limit)
@@ -0,0 +1,70 @@
+# Учет недоступных чатов. Любая отправка, завершившаяся Forbidden или
+# "chat not found", помечает пользователя в bot_users.delivery_status, чтобы
+# рассылки и уведомления отсекали его до HTTP-запроса.
+import logging
+import re
+import time
+
+from telegram.error import BadRequest, Forbidden
+from telegram.request import HTTPXRequest
+
+from metrics import record_api_call
+from runtime_profile import encode_request_data, parse_json_payload
+from storage import (
+    store,
+    DELIVERY_BLOCKED,
+    DELIVERY_DEACTIVATED,
+    DELIVERY_NOT_FOUND
+)
+
+logger = logging.getLogger(__name__)
+
+# URL запроса к Bot API: .../bot<id>:<секрет>/<метод>
+BOT_ID_IN_URL = re.compile(r"/bot(\d+):")
+
+def bot_id_from_url(url: str):
+    match = BOT_ID_IN_URL.search(url)
+    return int(match.group(1)) if match else None
+
+def delivery_status_for(error: Exception):
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        return DELIVERY_DEACTIVATED if 'deactivated' in message else DELIVERY_BLOCKED
+    if isinstance(error, BadRequest) and 'chat not found' in message:
+        return DELIVERY_NOT_FOUND
+    return None
+
+async def mark_unreachable(bot_id: int, chat_id: int, status: str):
+    try:
+        if await store.set_delivery_status(chat_id, status, bot_id=bot_id):
+            logger.info("Пользователь %s помечен как недоступный для бота %s: %s", chat_id, bot_id, status)
+    except Exception as e:
+        logger.error("Не удалось обновить статус доставки пользователя %s: %s", chat_id, e)
+
+# Один экземпляр может обслуживать несколько ботов, поэтому бот определяется по URL запроса
+class TrackingRequest(HTTPXRequest):
+    async def post(self, url, request_data=None, *args, **kwargs):
+        bot_id = bot_id_from_url(url)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await super().post(url, request_data, *args, **kwargs)
+            failed = False
+            return result
+        except (Forbidden, BadRequest) as e:
+            chat_id = request_data.parameters.get('chat_id') if request_data else None
+            status = delivery_status_for(e)
+            # Личные чаты имеют положительный id, совпадающий с id пользователя
+            if status and bot_id and isinstance(chat_id, int) and chat_id > 0:
+                await mark_unreachable(bot_id, chat_id, status)
+            raise
+        finally:
+            # Долгий опрос getUpdates занимает до timeout секунд и исказил бы среднее время вызова
+            if bot_id and not url.endswith('/getUpdates'):
+                record_api_call(bot_id, time.perf_counter() - started, failed)
+
+    # Кодирование параметров и разбор ответов - по профилю выполнения (runtime_profile.py)
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        return await super().do_request(url, method, encode_request_data(request_data), *args, **kwargs)
+
+    parse_json_payload = staticmethod(parse_json_payload)
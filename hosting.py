@@ -0,0 +1,125 @@
+# Несколько ботов в одном процессе: общий пул HTTP-соединений к Bot API,
+# метрики по каждому боту и ручной жизненный цикл приложений в одном event loop.
+import asyncio
+import logging
+import signal
+import time
+
+from telegram.ext import Application
+
+from delivery import TrackingRequest
+from metrics import record_update
+
+logger = logging.getLogger(__name__)
+
+def bot_id_from_token(token: str) -> int:
+    return int(token.split(':', 1)[0])
+
+# Один клиент на все боты: каждый Bot вызывает initialize/shutdown у своих запросов,
+# поэтому клиент закрывается только после остановки последнего бота
+class SharedRequest(TrackingRequest):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.users = 0
+
+    async def initialize(self):
+        if self.users == 0:
+            await super().initialize()
+        self.users += 1
+
+    async def shutdown(self):
+        if self.users == 0:
+            return
+        self.users -= 1
+        if self.users == 0:
+            await super().shutdown()
+
+# Помимо метрик отслеживает, до какого update_id включительно все обновления обработаны:
+# при параллельной обработке это граница перед самым ранним незавершенным обновлением.
+# Граница учитывает только обработчики. Работа, которую они отложили в памяти (ссылки альбомов
+# в LinkCollector, уведомления владельцам в OwnerNotifier), доводится до конца лишь при штатной
+# остановке (post_stop). При падении процесса она теряется: Telegram считает обновления
+# подтвержденными со следующим getUpdates, и придержанная граница их бы не вернула.
+class MeteredApplication(Application):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._in_flight = set()
+        self._highest_started = 0
+        self._resume_after = 0
+
+    @property
+    def processed_update_id(self) -> int:
+        if self._in_flight:
+            return min(self._in_flight) - 1
+        return self._highest_started
+
+    # Граница, сохраненная при прошлой остановке: повторно доставленные обновления до нее пропускаются
+    def resume_after(self, update_id: int):
+        self._resume_after = update_id
+        self._highest_started = max(self._highest_started, update_id)
+
+    # Пачка, обрабатываемая не по порядку update_id, заранее отмечается незавершенной,
+    # чтобы граница не перескочила еще не начатые обновления
+    def begin_updates(self, update_ids):
+        for update_id in update_ids:
+            if update_id > self._resume_after:
+                self._in_flight.add(update_id)
+                self._highest_started = max(self._highest_started, update_id)
+
+    async def process_update(self, update):
+        update_id = getattr(update, 'update_id', None)
+        if update_id is not None:
+            if update_id <= self._resume_after:
+                logger.info("Пропущено повторно доставленное обновление %s", update_id)
+                return
+            self._in_flight.add(update_id)
+            self._highest_started = max(self._highest_started, update_id)
+        started = time.perf_counter()
+        try:
+            await super().process_update(update)
+        finally:
+            self._in_flight.discard(update_id)
+            record_update(self.bot.id, time.perf_counter() - started)
+
+# Аналог Application.run_polling для нескольких приложений.
+# startup/shutdown - общая для процесса инициализация (БД, кэш), start_updates(app, index)
+# запускает получение обновлений конкретного бота. Приложение стартует раньше получения обновлений,
+# чтобы start_updates мог обработать накопленную очередь. При остановке сначала останавливается
+# получение, затем app.stop() дожидается всех выбранных и выполняющихся обработчиков.
+async def run_bots(applications: list, start_updates, startup, shutdown):
+    loop = asyncio.get_running_loop()
+    stop_requested = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_requested.set)
+        except NotImplementedError:
+            pass
+
+    initialized = []
+    try:
+        await startup()
+        for index, app in enumerate(applications):
+            await app.initialize()
+            initialized.append(app)
+            if app.post_init:
+                await app.post_init(app)
+            await app.start()
+            await start_updates(app, index)
+            logger.info("Бот @%s запущен", app.bot.username)
+        await stop_requested.wait()
+        logger.info("Получен сигнал остановки")
+    finally:
+        for app in reversed(initialized):
+            try:
+                if app.updater.running:
+                    await app.updater.stop()
+                if app.running:
+                    await app.stop()
+                if app.post_stop:
+                    await app.post_stop(app)
+                await app.shutdown()
+                if app.post_shutdown:
+                    await app.post_shutdown(app)
+            except Exception as e:
+                logger.error("Ошибка при остановке бота %s: %s", app.bot.id, e)
+        await shutdown()
@@ -0,0 +1,102 @@
+# Добавление подарков пачкой: все ссылки сообщения (текст или подпись к медиа) за одну
+# транзакцию с одним ответом-сводкой. Альбомы и пересланные сообщения приходят отдельными
+# обновлениями подряд, поэтому их ссылки копятся по пользователю: окно продлевается каждым
+# новым сообщением на BATCH_WINDOW_SECONDS, но не дольше MAX_BATCH_DELAY_SECONDS от первого.
+# Накопленное сохраняется при штатной остановке (post_stop); при падении процесса теряется.
+import asyncio
+import logging
+
+from telegram import MessageEntity
+
+from storage import bind_bot
+
+logger = logging.getLogger(__name__)
+
+GIFT_LIMIT = 15
+BATCH_WINDOW_SECONDS = 1.5
+MAX_BATCH_DELAY_SECONDS = 10
+
+ENTITY_TYPES = [MessageEntity.URL, MessageEntity.TEXT_LINK]
+
+def _normalize(link: str):
+    link = link.strip()
+    if '://' not in link:
+        link = f"https://{link}"  # Telegram размечает и ссылки без схемы: example.com/item
+    return link if link.lower().startswith(("http://", "https://")) else None
+
+# Ссылки сообщения по порядку, без повторов. Без разметки (например, обновления нагрузочного
+# стенда) - слова текста, начинающиеся с http:// или https://.
+def extract_links(message) -> list:
+    text = message.text or message.caption or ""
+    if message.text:
+        entities = message.parse_entities(ENTITY_TYPES)
+    else:
+        entities = message.parse_caption_entities(ENTITY_TYPES)
+    if entities:
+        found = [entity.url if entity.type == MessageEntity.TEXT_LINK else value for entity, value in entities.items()]
+    else:
+        found = [word for word in text.split() if word.lower().startswith(("http://", "https://"))]
+    links = (_normalize(link) for link in found)
+    return list(dict.fromkeys(link for link in links if link))
+
+# Часть альбома или пересланной пачки: ждем остальные сообщения
+def is_batch_part(message) -> bool:
+    return message.media_group_id is not None or message.forward_date is not None
+
+def format_link_summary(added: list, duplicates: list, over_limit: list) -> str:
+    if len(added) == 1 and not duplicates and not over_limit:
+        return "Подарок добавлен в твой список! 👍"
+    if not added and not duplicates:
+        return f"🚫 Вы достигли лимита в {GIFT_LIMIT} подарков в вашем списке!"
+    lines = []
+    if added:
+        lines.append(f"Добавлено подарков: {len(added)} 👍")
+    if duplicates:
+        lines.append(f"Уже были в списке: {len(duplicates)}")
+    if over_limit:
+        lines.append(f"🚫 Не добавлено из-за лимита в {GIFT_LIMIT} подарков: {len(over_limit)}")
+    return "\n".join(lines)
+
+class LinkCollector:
+    def __init__(self, bot, on_batch):
+        self.bot = bot
+        self.on_batch = on_batch  # on_batch(bot, user_id, links)
+        self.pending = {}  # user_id -> {ссылка: None} в порядке поступления
+        self.window_started = {}  # user_id -> время первого сообщения окна
+        self.timers = {}  # user_id -> TimerHandle
+        self.tasks = set()
+
+    def add(self, user_id: int, links: list):
+        self.pending.setdefault(user_id, {}).update(dict.fromkeys(links))
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        started = self.window_started.setdefault(user_id, now)
+        timer = self.timers.pop(user_id, None)
+        if timer:
+            timer.cancel()
+        delay = max(0.0, min(BATCH_WINDOW_SECONDS, started + MAX_BATCH_DELAY_SECONDS - now))
+        self.timers[user_id] = loop.call_later(delay, self._start_flush, user_id)
+
+    def _start_flush(self, user_id: int):
+        self.timers.pop(user_id, None)
+        task = asyncio.get_running_loop().create_task(self._flush(user_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _flush(self, user_id: int):
+        self.window_started.pop(user_id, None)
+        links = list(self.pending.pop(user_id, {}))
+        if not links:
+            return
+        bind_bot(self.bot.id)
+        try:
+            await self.on_batch(self.bot, user_id, links)
+        except Exception as e:
+            logger.error("Ошибка при добавлении пачки ссылок пользователя %s: %s", user_id, e)
+
+    # При остановке бота накопленные ссылки добавляются сразу
+    async def flush_all(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        await asyncio.gather(*(self._flush(user_id) for user_id in list(self.pending)), *self.tasks)
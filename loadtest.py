@@ -0,0 +1,515 @@
+# Нагрузочный стенд: локальный поддельный Bot API и генератор синтетических пользователей.
+#
+# Сервер отдает getUpdates (polling) или отправляет обновления на webhook бота,
+# принимает sendMessage/editMessageText/answerCallbackQuery и т.д., при включенном
+# --flood эмулирует ограничения Telegram ответами 429.
+# Каждый синтетический пользователь шлет следующее обновление только после ответа бота
+# на предыдущее, поэтому порядок обновлений одного пользователя сохраняется.
+# Задержка считается до первого ответа бота в чат (или answerCallbackQuery для кнопок);
+# перед следующим обновлением пользователь ждет, пока бот перестанет писать в чат.
+#
+# Пример (бот запускается самим стендом с хранилищем в памяти; с --database-url - с PostgreSQL):
+#   python loadtest.py --spawn --mode polling --users 200 --duration 60
+#   python loadtest.py --spawn --mode webhook --users 200 --duration 60 --flood
+#   python loadtest.py --spawn --database-url postgresql://localhost/wishlist_loadtest
+# Без --spawn бот запускается вручную с BOT_API_BASE_URL=http://127.0.0.1:8081/bot
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import defaultdict, deque
+from urllib.parse import parse_qsl, urlsplit
+
+import httpx
+
+FAKE_TOKEN = "123456789:LOADTESTLOADTESTLOADTESTLOADTEST000"
+BOT_ID = 123456789
+USER_ID_BASE = 7_000_000_000
+
+# Доли действий синтетического пользователя
+SCENARIO_WEIGHTS = {
+    "add_link": 30,
+    "view_list": 25,
+    "view_friends": 15,
+    "share_friend": 10,
+    "tap_button": 20,
+}
+
+SETTLE_TIME = 0.15  # секунд тишины в чате перед следующим обновлением
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests"}
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # Возвращает 0, если запрос разрешен, иначе время ожидания в секундах
+    def take(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.sent = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.flood_limited = 0
+        self.api_calls = defaultdict(int)
+        self.api_errors = 0
+        self.webhook_errors = 0
+        self.started = None
+        self.finished = None
+
+class FakeBotApi:
+    def __init__(self, stats: Stats, flood: bool, per_chat_rate: float, global_rate: float):
+        self.stats = stats
+        self.flood = flood
+        self.per_chat_rate = per_chat_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.updates = deque()
+        self.updates_available = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_ready = asyncio.Event()
+        # chat_id -> очередь ожидающих ответа обновлений (время отправки, future)
+        self.waiting = defaultdict(deque)
+        # callback_query_id -> (chat_id, время отправки, future)
+        self.waiting_callbacks = {}
+        # chat_id -> последние inline-кнопки, которые видел пользователь: [(text, data, message_id)]
+        self.buttons = defaultdict(list)
+        # chat_id -> время последнего сообщения бота в чат
+        self.last_reply = {}
+
+    # --- отправка обновлений боту ---
+
+    def push_update(self, chat_id: int, payload: dict, callback_id: str = None) -> asyncio.Future:
+        update = {"update_id": next(self.update_ids), **payload}
+        future = asyncio.get_running_loop().create_future()
+        sent_at = time.perf_counter()
+        if callback_id:
+            self.waiting_callbacks[callback_id] = (chat_id, sent_at, future)
+        else:
+            self.waiting[chat_id].append((sent_at, future))
+        self.stats.sent += 1
+        self.updates.append(update)
+        self.updates_available.set()
+        return future
+
+    def _resolve(self, chat_id: int, callback_id: str = None):
+        if callback_id and callback_id in self.waiting_callbacks:
+            _, sent_at, future = self.waiting_callbacks.pop(callback_id)
+        elif self.waiting.get(chat_id):
+            sent_at, future = self.waiting[chat_id].popleft()
+        else:
+            return
+        if not future.done():
+            self.stats.latencies.append(time.perf_counter() - sent_at)
+            self.stats.completed += 1
+            future.set_result(True)
+
+    def forget(self, future: asyncio.Future):
+        for queue in self.waiting.values():
+            for item in list(queue):
+                if item[1] is future:
+                    queue.remove(item)
+        for key, item in list(self.waiting_callbacks.items()):
+            if item[2] is future:
+                del self.waiting_callbacks[key]
+
+    # --- методы Bot API ---
+
+    def _message(self, chat_id, text=None) -> dict:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"},
+            "text": text or "",
+        }
+
+    def _remember_buttons(self, chat_id, reply_markup, message_id):
+        if isinstance(reply_markup, str):
+            try:
+                reply_markup = json.loads(reply_markup)
+            except ValueError:
+                return
+        if not isinstance(reply_markup, dict):
+            return
+        rows = reply_markup.get("inline_keyboard") or []
+        found = [
+            (button.get("text", ""), button["callback_data"], message_id)
+            for row in rows for button in row if "callback_data" in button
+        ]
+        if found:
+            self.buttons[chat_id] = (self.buttons[chat_id] + found)[-30:]
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout > 0:
+            self.updates_available.clear()
+            try:
+                await asyncio.wait_for(self.updates_available.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.popleft()
+        return list(itertools.islice(self.updates, 0, limit))
+
+    def _flood_check(self, chat_id) -> float:
+        if not self.flood:
+            return 0.0
+        wait = self.global_bucket.take()
+        if chat_id is not None and not wait:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, 3)
+            wait = bucket.take()
+        return wait
+
+    async def call(self, method: str, params: dict):
+        self.stats.api_calls[method] += 1
+        lower = method.lower()
+
+        if lower == "getme":
+            return 200, {"ok": True, "result": {
+                "id": BOT_ID, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False,
+            }}
+        if lower == "getupdates":
+            return 200, {"ok": True, "result": await self._get_updates(params)}
+        if lower == "setwebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_secret = params.get("secret_token")
+            self.webhook_ready.set()
+            return 200, {"ok": True, "result": True}
+        if lower in ("deletewebhook", "setmycommands", "deletemycommands"):
+            return 200, {"ok": True, "result": True}
+        if lower == "getwebhookinfo":
+            return 200, {"ok": True, "result": {"url": self.webhook_url or "", "has_custom_certificate": False,
+                                                "pending_update_count": len(self.updates)}}
+
+        chat_id = params.get("chat_id")
+        chat_id = int(chat_id) if chat_id not in (None, "") else None
+        if lower != "answercallbackquery":
+            wait = self._flood_check(chat_id)
+            if wait:
+                self.stats.flood_limited += 1
+                retry_after = max(1, math.ceil(wait))
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {retry_after}",
+                             "parameters": {"retry_after": retry_after}}
+
+        if lower == "answercallbackquery":
+            query_id = params.get("callback_query_id")
+            if query_id in self.waiting_callbacks:
+                self._resolve(self.waiting_callbacks[query_id][0], query_id)
+            return 200, {"ok": True, "result": True}
+
+        if lower in ("sendmessage", "sendphoto", "senddocument", "editmessagetext", "editmessagereplymarkup"):
+            message = self._message(chat_id, params.get("text"))
+            if params.get("message_id"):
+                message["message_id"] = int(params["message_id"])
+            if chat_id is not None:
+                self.last_reply[chat_id] = time.monotonic()
+                self._remember_buttons(chat_id, params.get("reply_markup"), message["message_id"])
+                self._resolve(chat_id)
+            return 200, {"ok": True, "result": message}
+        if lower == "sendmediagroup":
+            return 200, {"ok": True, "result": [self._message(chat_id)]}
+
+        self.stats.api_errors += 1
+        return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: method {method} is not emulated"}
+
+    # --- HTTP ---
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+
+                status, payload = await self.route(target, headers.get("content-type", ""), body)
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, target: str, content_type: str, body: bytes):
+        url = urlsplit(target)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+
+        params = dict(parse_qsl(url.query))
+        if body and "application/json" in content_type:
+            params.update(json.loads(body))
+        elif body and "application/x-www-form-urlencoded" in content_type:
+            # PTB передает сложные параметры строками JSON
+            params.update(parse_qsl(body.decode()))
+        return await self.call(parts[1], params)
+
+# --- синтетические пользователи ---
+
+def user_payload(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+def message_update(user_id: int, text: str = None, **extra) -> dict:
+    message = {
+        "message_id": random.randint(1, 2**31),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+        "from": user_payload(user_id),
+        **extra,
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": message}
+
+def callback_update(user_id: int, query_id: str, data: str, message_id: int) -> dict:
+    return {"callback_query": {
+        "id": query_id,
+        "from": user_payload(user_id),
+        "chat_instance": str(user_id),
+        "data": data,
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "LoadTestBot"},
+            "text": "…",
+        },
+    }}
+
+async def run_user(api: FakeBotApi, user_id: int, started_users: list, deadline: float, args):
+    query_ids = itertools.count()
+    actions = list(SCENARIO_WEIGHTS)
+    weights = list(SCENARIO_WEIGHTS.values())
+
+    async def send(payload, callback_id=None):
+        future = api.push_update(user_id, payload, callback_id)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), args.reply_timeout)
+        except asyncio.TimeoutError:
+            api.stats.timeouts += 1
+            api.forget(future)
+            return
+        while time.monotonic() - api.last_reply.get(user_id, 0) < SETTLE_TIME:
+            await asyncio.sleep(SETTLE_TIME)
+
+    await send(message_update(user_id, "/start"))
+    started_users.append(user_id)
+
+    while time.monotonic() < deadline:
+        if args.think_time:
+            await asyncio.sleep(random.expovariate(1 / args.think_time))
+        action = random.choices(actions, weights)[0]
+        if action == "tap_button" and not api.buttons.get(user_id):
+            action = "view_friends"
+
+        if action == "add_link":
+            await send(message_update(user_id, f"https://example.com/item/{random.randint(1, 10**9)}"))
+        elif action == "view_list":
+            await send(message_update(user_id, "🎁 Мой виш-лист"))
+        elif action == "view_friends":
+            await send(message_update(user_id, "📋 Друзья"))
+        elif action == "share_friend":
+            friend_id = random.choice(started_users)
+            if friend_id == user_id:
+                await send(message_update(user_id, "📋 Друзья"))
+            else:
+                await send(message_update(user_id, user_shared={"request_id": 1, "user_id": friend_id}))
+        elif action == "tap_button":
+            buttons = api.buttons[user_id]
+            # Принимаем запросы в друзья и бронируем чаще, чем нажимаем остальное
+            preferred = [b for b in buttons if b[0].startswith(("✅ Принять", "🔒", "🎁 Показать"))]
+            text, data, message_id = random.choice(preferred or buttons)
+            buttons.remove((text, data, message_id))
+            query_id = f"{user_id}-{next(query_ids)}"
+            await send(callback_update(user_id, query_id, data, message_id), callback_id=query_id)
+
+async def push_webhook_updates(api: FakeBotApi, client: httpx.AsyncClient):
+    headers = {}
+    if api.webhook_secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = api.webhook_secret
+
+    async def post(update):
+        try:
+            response = await client.post(api.webhook_url, json=update, headers=headers)
+            if response.status_code != 200:
+                api.stats.webhook_errors += 1
+        except httpx.HTTPError:
+            api.stats.webhook_errors += 1
+
+    while True:
+        await api.updates_available.wait()
+        api.updates_available.clear()
+        while api.updates:
+            asyncio.create_task(post(api.updates.popleft()))
+
+# Бот не подключился к поддельному Bot API или завершился при запуске
+class StartupError(Exception):
+    pass
+
+# Все, что определяет, куда ходит бот, задается явно: load_dotenv() бота не переопределяет
+# заданные переменные, поэтому .env разработчика не подставит настоящие токены, рабочую базу
+# или webhook (пустая строка - "не задано")
+async def spawn_bot(args) -> asyncio.subprocess.Process:
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_TOKENS": FAKE_TOKEN,
+        "TELEGRAM_TOKEN": FAKE_TOKEN,
+        "CALLBACK_SECRET": "",
+        "BOT_API_BASE_URL": f"http://127.0.0.1:{args.port}/bot",
+        "STORAGE": "postgres" if args.database_url else "memory",
+        "DATABASE_URL": args.database_url or "",
+        "DATABASE_REPLICA_URL": "",
+        "WEBHOOK_URL": "",
+    })
+    env.setdefault("ADMIN_ID", "1")
+    if args.mode == "webhook":
+        env["WEBHOOK_URL"] = f"http://127.0.0.1:{args.webhook_port}/"
+        env["WEBHOOK_LISTEN"] = "127.0.0.1"
+        env["WEBHOOK_PORT"] = str(args.webhook_port)
+    return await asyncio.create_subprocess_exec(
+        sys.executable, args.bot_script, env=env,
+        stdout=asyncio.subprocess.DEVNULL if not args.bot_output else None,
+        stderr=asyncio.subprocess.DEVNULL if not args.bot_output else None
+    )
+
+def report(stats: Stats, args):
+    duration = (stats.finished or time.monotonic()) - stats.started
+    latencies_ms = [value * 1000 for value in stats.latencies]
+    print()
+    print(f"Режим: {args.mode}, пользователей: {args.users}, длительность: {duration:.1f} с, 429: {'да' if args.flood else 'нет'}")
+    print(f"Отправлено обновлений:  {stats.sent}")
+    print(f"Получено ответов:       {stats.completed}")
+    print(f"Пропускная способность: {stats.completed / duration:.1f} обновлений/с")
+    print(f"Задержка, мс: p50 {percentile(latencies_ms, 0.5):.1f} · p90 {percentile(latencies_ms, 0.9):.1f} · "
+          f"p99 {percentile(latencies_ms, 0.99):.1f} · max {max(latencies_ms, default=0):.1f}")
+    errors = stats.timeouts + stats.flood_limited + stats.api_errors + stats.webhook_errors
+    print(f"Ошибки: без ответа {stats.timeouts}, 429 {stats.flood_limited}, "
+          f"неизвестные методы {stats.api_errors}, webhook {stats.webhook_errors} "
+          f"({errors / max(stats.sent, 1) * 100:.2f}% от отправленных)")
+    print("Вызовы Bot API: " + ", ".join(f"{name} {count}" for name, count in sorted(stats.api_calls.items())))
+
+async def run(args):
+    stats = Stats()
+    api = FakeBotApi(stats, args.flood, args.per_chat_rate, args.global_rate)
+    server = await asyncio.start_server(api.handle_connection, "127.0.0.1", args.port)
+    print(f"Поддельный Bot API: http://127.0.0.1:{args.port}/bot<token>/")
+
+    bot = await spawn_bot(args) if args.spawn else None
+    client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=200))
+    pusher = None
+    try:
+        if args.mode == "webhook":
+            print("Ожидание setWebhook от бота...")
+            try:
+                await asyncio.wait_for(api.webhook_ready.wait(), args.startup_timeout)
+            except asyncio.TimeoutError:
+                raise StartupError(f"бот не вызвал setWebhook за {args.startup_timeout:.0f} с") from None
+            pusher = asyncio.create_task(push_webhook_updates(api, client))
+        else:
+            # Бот должен успеть инициализироваться и начать опрос
+            startup_deadline = time.monotonic() + args.startup_timeout
+            while not stats.api_calls.get("getUpdates"):
+                if bot and bot.returncode is not None:
+                    raise StartupError("бот завершился при запуске")
+                if time.monotonic() > startup_deadline:
+                    hint = "" if bot else (
+                        f"; запустите его с BOT_API_BASE_URL=http://127.0.0.1:{args.port}/bot или используйте --spawn"
+                    )
+                    raise StartupError(f"бот не начал опрос getUpdates за {args.startup_timeout:.0f} с{hint}")
+                await asyncio.sleep(0.2)
+
+        stats.started = time.monotonic()
+        deadline = stats.started + args.duration
+        started_users = []
+        users = [
+            asyncio.create_task(run_user(api, USER_ID_BASE + index, started_users, deadline, args))
+            for index in range(args.users)
+        ]
+        await asyncio.gather(*users)
+        stats.finished = time.monotonic()
+        report(stats, args)
+    finally:
+        if pusher:
+            pusher.cancel()
+        await client.aclose()
+        if bot and bot.returncode is None:
+            bot.terminate()
+            await bot.wait()
+        server.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота через локальный Bot API")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30, help="секунд")
+    parser.add_argument("--think-time", type=float, default=0.5, help="средняя пауза пользователя, с (0 - без пауз)")
+    parser.add_argument("--reply-timeout", type=float, default=10, help="после скольких секунд обновление считается без ответа")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--webhook-port", type=int, default=8443)
+    parser.add_argument("--flood", action="store_true", help="эмулировать 429 Too Many Requests")
+    parser.add_argument("--per-chat-rate", type=float, default=1.0, help="сообщений в секунду на чат")
+    parser.add_argument("--global-rate", type=float, default=30.0, help="сообщений в секунду всего")
+    parser.add_argument("--spawn", action="store_true", help="запустить main.py с нужными переменными окружения")
+    parser.add_argument("--bot-script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+                        help="скрипт бота для --spawn")
+    parser.add_argument("--database-url", help="PostgreSQL для запущенного бота (отдельная база!); без него - хранилище в памяти")
+    parser.add_argument("--bot-output", action="store_true", help="не скрывать вывод запущенного бота")
+    parser.add_argument("--startup-timeout", type=float, default=60, help="сколько секунд ждать подключения бота")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run(parse_args()))
+    except StartupError as e:
+        sys.exit(f"Ошибка: {e}")
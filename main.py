@@ -2,53 +2,87 @@ from telegram import (
     Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    InputMediaPhoto,
+    InputMediaDocument,
     ReplyKeyboardMarkup,
     KeyboardButton,
-    KeyboardButtonRequestUser
+    KeyboardButtonRequestUser,
+    ChatMember
 )
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
+    TypeHandler,
     ContextTypes,
     filters
 )
 from telegram.constants import ParseMode
+from telegram.helpers import escape_markdown
 from telegram.error import TimedOut, Forbidden, Conflict
-from telegram.request import HTTPXRequest
-from db import (
-    init_db,
-    register_user,
-    get_user_wishlist,
-    add_link_to_wishlist,
-    create_friend_request,
-    update_friend_request,
-    get_pool,
-    check_friendship,
-    get_pending_requests,
-    delete_gift_by_id,
-    get_friends,
-    remove_friend,
-    get_user_by_id,
-    add_feedback,
-    reserve_gift,
-    cancel_reservation,
-    get_reservation_info,
-    check_old_reservations
+from storage import (
+    store,
+    bind_bot,
+    DatabaseUnavailable,
+    DELIVERY_OK,
+    DELIVERY_BLOCKED,
+    use_storage
+)
+from memory_storage import MemoryStorage
+from config import (
+    TELEGRAM_TOKENS,
+    ADMIN_ID,
+    BOT_API_BASE_URL,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    RUNTIME_PROFILE,
+    STORAGE
+)
+from log_setup import setup_logging, bind_update
+from hosting import SharedRequest, MeteredApplication, bot_id_from_token, run_bots
+from metrics import register_bot, record_update_error, record_catch_up, report as metrics_report
+from backlog import catch_up
+from occasions import (
+    deliver_due_occasions,
+    parse_occasion_date,
+    format_date,
+    REMIND_DAYS_BEFORE,
+    REMIND_HOUR,
+    TITLE_LIMIT
+)
+from link_ingest import LinkCollector, GIFT_LIMIT, extract_links, is_batch_part, format_link_summary
+from owner_notifications import OwnerNotifier, RESERVED, CANCELLED, EXPIRED, UNFRIENDED
+from profiler import Profiler
+from runtime_profile import apply as apply_runtime_profile
+from reservation_scheduler import ReservationScheduler
+from wishlist_cache import WishlistCache
+from callbacks import (
+    CallbackRouter,
+    encode_callback,
+    SHOW_WISHLIST,
+    REMOVE_FRIEND,
+    RESERVE,
+    CANCEL_RESERVE,
+    FRIEND_REQUEST,
+    DELETE_TOGGLE,
+    DELETE_CONFIRM,
+    DELETE_CANCEL,
+    SEARCH_MORE,
+    OCCASION_DELETE,
+    decode_callback
 )
-from config import TELEGRAM_TOKEN, ADMIN_ID
 import asyncio
 import logging
 import asyncpg
 import os
 import time
+from functools import partial
+from datetime import date, datetime, timedelta
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 # Счетчик попыток перезапуска и таймер для уведомлений
@@ -57,10 +91,53 @@ MAX_RESTART_ATTEMPTS = 3
 LAST_NOTIFICATION_TIME = 0
 NOTIFICATION_COOLDOWN = 300  # 5 минут в секундах
 
+# Пары (бот, пользователь), активность которых уже записана сегодня (чтобы не ходить в БД на каждое обновление)
+ACTIVE_TODAY = {'day': None, 'users': set()}
+
+# Таблица маршрутизации inline-кнопок: код действия -> обработчик
+callback_router = CallbackRouter()
+
+# Списки подарков по владельцу; сбрасываются по NOTIFY от всех экземпляров бота
+async def load_wishlist(owner_id: int):
+    return await store.get_wishlist_snapshot(owner_id)
+
+wishlist_cache = WishlistCache(load_wishlist)
+
+# Доставка отзывов админу пачками
+FEEDBACK_DIGEST_INTERVAL = 300  # 5 минут в секундах
+FEEDBACK_BATCH_SIZE = 100
+FEEDBACK_LEASE_SECONDS = 900  # не отправленные за это время отзывы (сбой, перезапуск) выбираются снова
+FEEDBACK_REPORT_PAGE_SIZE = 50  # отзывов за запрос в /feedback
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
+
+REPLICA_CHECK_INTERVAL = 10  # секунд
+
+# Как часто сохранять границу обработанных обновлений; при остановке она сохраняется всегда
+UPDATE_OFFSET_SAVE_INTERVAL = 30  # секунд
+
+# Профилирование по команде /profile; вне сеанса ничего не установлено
+profiler = Profiler()
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 120
+
+# Ответ, пока база недоступна (автомат защиты в db.py разомкнут)
+DB_UNAVAILABLE_TEXT = "База данных временно недоступна 😔 Попробуйте через минуту."
+
+# Поиск подарков по подстроке от 3 символов
+SEARCH_MIN_LENGTH = 3
+SEARCH_PAGE_SIZE = 5
+SEARCH_HISTORY_SIZE = 20  # сколько последних запросов пользователя можно листать кнопкой «Показать ещё»
+
+# События (дни рождения и т.п.) и напоминания о них друзьям
+OCCASION_LIMIT = 10
+OCCASION_CHECK_INTERVAL = 300  # секунд
+
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    await register_user(user)
+    await store.register_user(user)
 
     await update.message.reply_text(
         """Надоело ломать голову над подарками? 🎁
@@ -119,7 +196,7 @@ def main_keyboard():
 
 async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message.text
-    logger.info(f"Received button press: {message} from user {update.effective_user.id}")
+    logger.info("Received button press: %s from user %s", message, update.effective_user.id, extra={'sample': True})
 
     if message == '🎁 Мой виш-лист':
         await show_user_wishlist(update, context)
@@ -132,15 +209,60 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif message == '📝 Отзыв':
         await request_feedback(update, context)
 
-async def check_gift_limit(user_id: int) -> bool:
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        count = await conn.fetchval('SELECT COUNT(*) FROM wishlist WHERE user_id = $1', user_id)
-        return count >= 15
+# Повтор добавления ссылок, отложенного до восстановления базы
+async def add_queued_links(bot, user_id: int, links: list):
+    added, duplicates, over_limit = await store.add_links_to_wishlist(user_id, links, GIFT_LIMIT)
+    logger.info("Added %s queued gifts for user %s", len(added), user_id)
+    text = format_link_summary(added, duplicates, over_limit)
+    if len(links) == 1:
+        text = f"{text}\n{links[0]}"
+    try:
+        await bot.send_message(chat_id=user_id, text=text, disable_web_page_preview=True)
+    except Exception as e:
+        logger.error("Не удалось сообщить пользователю %s о добавлении отложенных ссылок: %s", user_id, e)
+
+# Все ссылки пачки - одной транзакцией, ответ - одной сводкой
+async def add_links_and_reply(bot, user_id: int, links: list):
+    reply_markup = None
+    try:
+        try:
+            added, duplicates, over_limit = await store.add_links_to_wishlist(user_id, links, GIFT_LIMIT)
+        except asyncpg.UniqueViolationError as e:
+            logger.error("UniqueViolationError while adding links to wishlist: %s", e)
+            await store.sync_wishlist_sequence()
+            logger.info("Synchronized wishlist_id_seq")
+            added, duplicates, over_limit = await store.add_links_to_wishlist(user_id, links, GIFT_LIMIT)
+        logger.info("Added %s of %s gifts for user %s", len(added), len(links), user_id, extra={'sample': True})
+        text = format_link_summary(added, duplicates, over_limit)
+        if not added:
+            reply_markup = main_keyboard()
+    except DatabaseUnavailable:
+        reply_markup = main_keyboard()
+        if not store.queue_write(partial(add_queued_links, bot, user_id, links)):
+            text = DB_UNAVAILABLE_TEXT
+        elif len(links) == 1:
+            text = "База данных временно недоступна 😔 Ссылка добавится автоматически, как только она заработает."
+        else:
+            text = "База данных временно недоступна 😔 Ссылки добавятся автоматически, как только она заработает."
+    except Exception as e:
+        logger.error("Error while adding links to wishlist: %s", e)
+        text = "Произошла ошибка при добавлении подарка. Попробуйте позже."
+        reply_markup = main_keyboard()
+    try:
+        await bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error("Не удалось ответить пользователю %s о добавлении ссылок: %s", user_id, e)
+
+# Части альбома и пересланные сообщения копятся в LinkCollector и добавляются вместе
+async def ingest_links(update: Update, context: ContextTypes.DEFAULT_TYPE, links: list):
+    if is_batch_part(update.message):
+        context.bot_data['link_collector'].add(update.effective_user.id, links)
+    else:
+        await add_links_and_reply(context.bot, update.effective_user.id, links)
 
 async def show_user_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE, is_own_list=True):
     user_id = update.effective_user.id
-    wishlist = await get_user_wishlist(user_id)
+    wishlist = await wishlist_cache.get(user_id)
 
     if not wishlist:
         await update.message.reply_text("Твой список подарков пока пуст 😊 Давай добавим что-нибудь!")
@@ -151,8 +273,7 @@ async def show_user_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE,
         message_text = f"🎁 [Ссылка на товар]({gift_link})"
 
         if is_own_list:
-            reservation = await get_reservation_info(gift['id'])
-            if reservation:
+            if gift['reserved_by']:
                 message_text += "\n\n🛑 *ЗАБРОНИРОВАНО*"
 
             await update.message.reply_text(
@@ -161,19 +282,18 @@ async def show_user_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 disable_web_page_preview=False
             )
         else:
-            reservation = await get_reservation_info(gift['id'])
-            if reservation:
-                if reservation['reserved_by'] == user_id:
+            if gift['reserved_by']:
+                if gift['reserved_by'] == user_id:
                     message_text += "\n\n✅ *Вы забронировали этот подарок*"
                     keyboard = InlineKeyboardMarkup([
-                        [InlineKeyboardButton("❌ Отменить бронь", callback_data=f"cancel_reserve:{gift['id']}")]
+                        [InlineKeyboardButton("❌ Отменить бронь", callback_data=encode_callback(CANCEL_RESERVE, gift['id'], user_id=user_id, bot_id=context.bot.id))]
                     ])
                 else:
                     message_text += "\n\n🛑 *Уже забронировано*"
                     keyboard = None
             else:
                 keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔒 Забронировать", callback_data=f"reserve:{gift['id']}")]
+                    [InlineKeyboardButton("🔒 Забронировать", callback_data=encode_callback(RESERVE, gift['id'], user_id=user_id, bot_id=context.bot.id))]
                 ])
 
             await update.message.reply_text(
@@ -183,26 +303,50 @@ async def show_user_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 disable_web_page_preview=False
             )
 
+def delete_keyboard(gifts: list, user_id: int, bot_id: int) -> InlineKeyboardMarkup:
+    # gifts: [(gift_id, подпись, выбран)]
+    rows = [
+        [InlineKeyboardButton(
+            f"{'✅' if selected else '⬜'} {label}",
+            callback_data=encode_callback(DELETE_TOGGLE, gift_id, int(selected), user_id=user_id, bot_id=bot_id)
+        )]
+        for gift_id, label, selected in gifts
+    ]
+    selected_count = sum(1 for _, _, selected in gifts if selected)
+    rows.append([
+        InlineKeyboardButton(f"🗑 Удалить выбранные ({selected_count})", callback_data=encode_callback(DELETE_CONFIRM, user_id=user_id, bot_id=bot_id)),
+        InlineKeyboardButton("↩️ Отмена", callback_data=encode_callback(DELETE_CANCEL, user_id=user_id, bot_id=bot_id))
+    ])
+    return InlineKeyboardMarkup(rows)
+
+# Состояние выбора хранится в самой клавиатуре сообщения: подписанные кнопки несут gift_id и флаг
+def selected_gifts_from_markup(markup: InlineKeyboardMarkup, user_id: int, bot_id: int) -> list:
+    gifts = []
+    for row in markup.inline_keyboard:
+        for button in row:
+            decoded = decode_callback(button.callback_data, user_id, bot_id)
+            if decoded and decoded[0] == DELETE_TOGGLE:
+                gift_id, selected = decoded[1]
+                gifts.append((gift_id, button.text[2:], bool(selected)))
+    return gifts
+
 async def show_gifts_to_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    wishlist = await get_user_wishlist(update.effective_user.id)
+    user_id = update.effective_user.id
+    wishlist = await store.get_user_wishlist(user_id)
     if not wishlist:
         await update.message.reply_text("Пока нечего удалять - список пуст 😉")
         return
 
+    gifts = []
     for gift in wishlist:
-        link = gift["link"]
-        gift_id = gift["id"]
-        short_text = (link[:50] + '...') if len(link) > 50 else link
+        label = gift["link"].removeprefix("https://").removeprefix("http://").removeprefix("www.")
+        label = (label[:40] + '…') if len(label) > 40 else label
+        gifts.append((gift["id"], label, False))
 
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("❌ Удалить", callback_data=f"delete:{gift_id}")]
-        ])
-
-        await update.message.reply_text(
-            f"[{short_text}]({link})",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
-        )
+    await update.message.reply_text(
+        "Отметьте подарки, которые нужно удалить, и нажмите «Удалить выбранные»:",
+        reply_markup=delete_keyboard(gifts, user_id, context.bot.id)
+    )
 
 async def add_friend_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = ReplyKeyboardMarkup([
@@ -220,7 +364,7 @@ async def add_friend_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
 
 async def handle_user_shared(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"Received user_shared from user {update.effective_user.id}")
+    logger.info("Received user_shared from user %s", update.effective_user.id, extra={'sample': True})
     user_shared = update.message.user_shared
     selected_user_id = user_shared.user_id
 
@@ -231,9 +375,7 @@ async def handle_user_shared(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
 
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        friend = await conn.fetchrow('SELECT * FROM users WHERE id = $1', selected_user_id)
+    friend = await store.get_user_by_id(selected_user_id)
 
     if not friend:
         invite_keyboard = InlineKeyboardMarkup([
@@ -249,27 +391,28 @@ async def handle_user_shared(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
 
-    if await check_friendship(update.effective_user.id, selected_user_id):
+    if friend['delivery_status'] != DELIVERY_OK:
+        await update.message.reply_text(
+            "Не удалось отправить запрос. Пользователь, возможно, заблокировал бота.",
+            reply_markup=main_keyboard()
+        )
+        return
+
+    if await store.check_friendship(update.effective_user.id, selected_user_id):
         await update.message.reply_text(
             "Вы уже друзья с этим пользователем!",
             reply_markup=main_keyboard()
         )
         return
 
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        existing_request = await conn.fetchrow(
-            'SELECT * FROM friend_requests WHERE from_user_id = $1 AND to_user_id = $2 AND status = $3',
-            update.effective_user.id, selected_user_id, 'pending'
+    if await store.has_pending_request(update.effective_user.id, selected_user_id):
+        await update.message.reply_text(
+            "Вы уже отправили запрос этому пользователю 😊",
+            reply_markup=main_keyboard()
         )
-        if existing_request:
-            await update.message.reply_text(
-                "Вы уже отправили запрос этому пользователю 😊",
-                reply_markup=main_keyboard()
-            )
-            return
+        return
 
-    success = await create_friend_request(update.effective_user.id, selected_user_id)
+    success = await store.create_friend_request(update.effective_user.id, selected_user_id)
     if not success:
         await update.message.reply_text(
             "Не удалось создать запрос в друзья. Возможно, запрос уже существует.",
@@ -279,8 +422,8 @@ async def handle_user_shared(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     request_keyboard = InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("✅ Принять", callback_data=f"friend_request:accept:{update.effective_user.id}"),
-            InlineKeyboardButton("❌ Отклонить", callback_data=f"friend_request:reject:{update.effective_user.id}")
+            InlineKeyboardButton("✅ Принять", callback_data=encode_callback(FRIEND_REQUEST, update.effective_user.id, 1, user_id=selected_user_id, bot_id=context.bot.id)),
+            InlineKeyboardButton("❌ Отклонить", callback_data=encode_callback(FRIEND_REQUEST, update.effective_user.id, 0, user_id=selected_user_id, bot_id=context.bot.id))
         ]
     ])
 
@@ -295,30 +438,22 @@ async def handle_user_shared(update: Update, context: ContextTypes.DEFAULT_TYPE)
             reply_markup=main_keyboard()
         )
     except Forbidden as e:
-        logger.error(f"Ошибка: пользователь {selected_user_id} заблокировал бота: {e}")
-        async with pool.acquire() as conn:
-            await conn.execute(
-                'DELETE FROM friend_requests WHERE from_user_id = $1 AND to_user_id = $2 AND status = $3',
-                update.effective_user.id, selected_user_id, 'pending'
-            )
+        logger.error("Ошибка: пользователь %s заблокировал бота: %s", selected_user_id, e)
+        await store.delete_pending_request(update.effective_user.id, selected_user_id)
         await update.message.reply_text(
             "Не удалось отправить запрос. Пользователь, возможно, заблокировал бота.",
             reply_markup=main_keyboard()
         )
     except Exception as e:
-        logger.error(f"Ошибка при отправке запроса в друзья пользователю {selected_user_id}: {e}")
-        async with pool.acquire() as conn:
-            await conn.execute(
-                'DELETE FROM friend_requests WHERE from_user_id = $1 AND to_user_id = $2 AND status = $3',
-                update.effective_user.id, selected_user_id, 'pending'
-            )
+        logger.error("Ошибка при отправке запроса в друзья пользователю %s: %s", selected_user_id, e)
+        await store.delete_pending_request(update.effective_user.id, selected_user_id)
         await update.message.reply_text(
             "Произошла ошибка при отправке запроса. Попробуйте позже.",
             reply_markup=main_keyboard()
         )
 
 async def show_friends_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    friends = await get_friends(update.effective_user.id)
+    friends = await store.get_friends(update.effective_user.id)
     if not friends:
         await update.message.reply_text(
             "У тебя пока нет друзей 😉 Добавь кого-нибудь, чтобы видеть их списки!",
@@ -329,8 +464,8 @@ async def show_friends_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for friend in friends:
         keyboard = InlineKeyboardMarkup([
             [
-                InlineKeyboardButton("🎁 Показать вишлист", callback_data=f"show_wishlist:{friend['id']}"),
-                InlineKeyboardButton("❌ Удалить", callback_data=f"remove_friend:{friend['id']}")
+                InlineKeyboardButton("🎁 Показать вишлист", callback_data=encode_callback(SHOW_WISHLIST, friend['id'], user_id=update.effective_user.id, bot_id=context.bot.id)),
+                InlineKeyboardButton("❌ Удалить", callback_data=encode_callback(REMOVE_FRIEND, friend['id'], user_id=update.effective_user.id, bot_id=context.bot.id))
             ]
         ])
 
@@ -339,15 +474,15 @@ async def show_friends_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=keyboard
         )
 
-    pending_requests = await get_pending_requests(update.effective_user.id)
+    pending_requests = await store.get_pending_requests(update.effective_user.id)
     if pending_requests:
         await update.message.reply_text("📥 Входящие запросы в друзья:")
         for request in pending_requests:
             keyboard = InlineKeyboardMarkup([
                 [
-                    InlineKeyboardButton("✅ Принять", callback_data=f"friend_request:accept:{request['from_user_id']}"),
+                    InlineKeyboardButton("✅ Принять", callback_data=encode_callback(FRIEND_REQUEST, request['from_user_id'], 1, user_id=update.effective_user.id, bot_id=context.bot.id)),
                     InlineKeyboardButton("❌ Отклонить",
-                                        callback_data=f"friend_request:reject:{request['from_user_id']}")
+                                        callback_data=encode_callback(FRIEND_REQUEST, request['from_user_id'], 0, user_id=update.effective_user.id, bot_id=context.bot.id))
                 ]
             ])
 
@@ -356,256 +491,603 @@ async def show_friends_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=keyboard
             )
 
-async def handle_friend_request_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_friend_request_response(update: Update, context: ContextTypes.DEFAULT_TYPE, from_user_id: int, accept: int):
     query = update.callback_query
-    await query.answer()
-    logger.info(f"Received friend request response: {query.data} from user {query.from_user.id}")
-
-    action, from_user_id = query.data.split(":")[1:]
-    from_user_id = int(from_user_id)
+    action = 'accept' if accept else 'reject'
     to_user_id = query.from_user.id
 
-    success = await update_friend_request(from_user_id, to_user_id, action)
+    success = await store.update_friend_request(from_user_id, to_user_id, action)
     if not success:
         await query.edit_message_text("Не удалось найти активный запрос в друзья.")
         return
 
-    from_user = await get_user_by_id(from_user_id)
-    to_user = await get_user_by_id(to_user_id)
+    from_user = await store.get_user_by_id(from_user_id)
+    to_user = await store.get_user_by_id(to_user_id)
+    notify_sender = from_user['delivery_status'] == DELIVERY_OK
 
     if action == 'accept':
         await query.edit_message_text(
             f"✅ Вы приняли запрос в друзья от {from_user['first_name']} (@{from_user['username']})!"
         )
+        if not notify_sender:
+            return
         try:
             await context.bot.send_message(
                 chat_id=from_user_id,
                 text=f"🎉 Пользователь {to_user['first_name']} (@{to_user['username']}) принял ваш запрос в друзья!"
             )
         except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления о принятии дружбы пользователю {from_user_id}: {e}")
+            logger.error("Ошибка при отправке уведомления о принятии дружбы пользователю %s: %s", from_user_id, e)
     else:
         await query.edit_message_text(
             f"❌ Вы отклонили запрос в друзья от {from_user['first_name']} (@{from_user['username']})"
         )
+        if not notify_sender:
+            return
         try:
             await context.bot.send_message(
                 chat_id=from_user_id,
                 text=f"😢 Пользователь {to_user['first_name']} (@{to_user['username']}) отклонил ваш запрос в друзья."
             )
         except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления об отклонении дружбы пользователю {from_user_id}: {e}")
+            logger.error("Ошибка при отправке уведомления об отклонении дружбы пользователю %s: %s", from_user_id, e)
+
+# Блокировка и разблокировка бота пользователем приходят как my_chat_member в личном чате
+async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.my_chat_member
+    if member_update.chat.type != "private":
+        return
+
+    status = member_update.new_chat_member.status
+    if status == ChatMember.BANNED:
+        delivery_status = DELIVERY_BLOCKED
+    elif status == ChatMember.MEMBER:
+        delivery_status = DELIVERY_OK
+    else:
+        return
+
+    if await store.set_delivery_status(member_update.chat.id, delivery_status):
+        logger.info("Статус доставки пользователя %s: %s", member_update.chat.id, delivery_status)
+
+async def bind_log_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    bind_update(update.update_id, user.id if user else None)
+    bind_bot(context.bot.id)
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user:
+        return
+
+    today = date.today()
+    if ACTIVE_TODAY['day'] != today:
+        ACTIVE_TODAY['day'] = today
+        ACTIVE_TODAY['users'] = set()
+    key = (context.bot.id, user.id)
+    if key in ACTIVE_TODAY['users']:
+        return
+
+    try:
+        await store.record_user_activity(user.id)
+        ACTIVE_TODAY['users'].add(key)
+    except Exception as e:
+        logger.error("Ошибка при записи активности пользователя %s: %s", user.id, e)
+
+async def refresh_stats_periodically(context: ContextTypes.DEFAULT_TYPE):
+    bind_bot(context.bot.id)
+    try:
+        await store.refresh_stats()
+        logger.info("Счетчики статистики сверены")
+    except Exception as e:
+        logger.error("Ошибка при сверке статистики: %s", e)
+
+def format_feedback(item) -> str:
+    icon = {'photo': '📷', 'document': '📄'}.get(item['media_type'], '📝')
+    return f"{icon} @{item['username']} (id: {item['user_id']}), {item['created_at']:%d.%m %H:%M}:\n{item['text']}"
+
+def chunk_texts(texts: list, limit: int = MESSAGE_LIMIT) -> list:
+    chunks, current = [], ""
+    for text in texts:
+        text = text[:limit]
+        if current and len(current) + len(text) + 2 > limit:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{text}" if current else text
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def send_feedback_media(bot, items: list):
+    media_class = InputMediaPhoto if items[0]['media_type'] == 'photo' else InputMediaDocument
+    for start in range(0, len(items), MEDIA_GROUP_LIMIT):
+        group = items[start:start + MEDIA_GROUP_LIMIT]
+        if len(group) == 1:
+            item = group[0]
+            send = bot.send_photo if item['media_type'] == 'photo' else bot.send_document
+            await send(ADMIN_ID, item['file_id'], caption=format_feedback(item)[:CAPTION_LIMIT])
+            continue
+        await bot.send_media_group(
+            chat_id=ADMIN_ID,
+            media=[media_class(item['file_id'], caption=format_feedback(item)[:CAPTION_LIMIT]) for item in group]
+        )
+
+async def deliver_feedback_digest(context: ContextTypes.DEFAULT_TYPE):
+    bind_bot(context.bot.id)
+    try:
+        items = await store.claim_feedback_batch(FEEDBACK_BATCH_SIZE, FEEDBACK_LEASE_SECONDS)
+    except Exception as e:
+        logger.error("Ошибка при чтении очереди отзывов: %s", e)
+        return
+    if not items:
+        return
+
+    texts = [item for item in items if not item['file_id']]
+    photos = [item for item in items if item['media_type'] == 'photo' and item['file_id']]
+    documents = [item for item in items if item['media_type'] == 'document' and item['file_id']]
+
+    failed = []
+    if texts:
+        header = f"📬 Новые отзывы ({len(texts)} шт.)"
+        try:
+            for chunk in chunk_texts([header] + [format_feedback(item) for item in texts]):
+                await context.bot.send_message(chat_id=ADMIN_ID, text=chunk)
+        except Exception as e:
+            logger.error("Ошибка при отправке дайджеста отзывов админу: %s", e)
+            failed += texts
+
+    for media_items in (photos, documents):
+        if not media_items:
+            continue
+        try:
+            await send_feedback_media(context.bot, media_items)
+        except Exception as e:
+            logger.error("Ошибка при отправке медиа-отзывов админу: %s", e)
+            failed += media_items
+
+    # Доставленными отзывы становятся только после отправки; если отметить не удалось,
+    # они повторятся по истечении аренды - возможен повтор, но не потеря
+    failed_ids = {item['id'] for item in failed}
+    try:
+        await store.mark_feedback_delivered([item['id'] for item in items if item['id'] not in failed_ids])
+        await store.release_feedback(list(failed_ids))
+    except Exception as e:
+        logger.error("Ошибка при подтверждении доставки отзывов: %s", e)
+    logger.info("Доставлено отзывов админу: %s, возвращено в очередь: %s", len(items) - len(failed), len(failed))
+
+async def feedback_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+
+    try:
+        if len(context.args) >= 2:
+            start = datetime.fromisoformat(context.args[0])
+            end = datetime.fromisoformat(context.args[1]) + timedelta(days=1)
+        else:
+            end = datetime.combine(date.today(), datetime.min.time()) + timedelta(days=1)
+            start = end - timedelta(days=7)
+    except ValueError:
+        await update.message.reply_text("Формат: /feedback ГГГГ-ММ-ДД ГГГГ-ММ-ДД")
+        return
+
+    # Весь период, страницами по (created_at, id)
+    after = None
+    total = 0
+    while True:
+        items = await store.get_feedback_between(start, end, after, FEEDBACK_REPORT_PAGE_SIZE)
+        for chunk in chunk_texts([format_feedback(item) for item in items]):
+            await update.message.reply_text(chunk)
+        total += len(items)
+        if len(items) < FEEDBACK_REPORT_PAGE_SIZE:
+            break
+        after = (items[-1]['created_at'], items[-1]['id'])
+
+    if not total:
+        await update.message.reply_text("Отзывов за этот период нет.")
+    elif total > FEEDBACK_REPORT_PAGE_SIZE:
+        await update.message.reply_text(f"Всего отзывов за период: {total}")
+
+def plural(n: int, one: str, few: str, many: str) -> str:
+    if n % 10 == 1 and n % 100 != 11:
+        return f"{n} {one}"
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return f"{n} {few}"
+    return f"{n} {many}"
+
+# "через 1 день и 12 часов"; напоминание может прийти позже срока (например, после перезапуска)
+def format_time_left(left: timedelta) -> str:
+    hours = round(left.total_seconds() / 3600)
+    if hours < 1:
+        return "менее чем через час"
+    days, hours = divmod(hours, 24)
+    parts = []
+    if days:
+        parts.append(plural(days, "день", "дня", "дней"))
+    if hours:
+        parts.append(plural(hours, "час", "часа", "часов"))
+    return "через " + " и ".join(parts)
+
+async def send_reservation_reminder(bot, reservation):
+    if not await store.mark_reservation_reminded(reservation['id']) or not reservation['reserver_reachable']:
+        return
+
+    # expires_at - время БД, поэтому и остаток считается от часов БД, как в планировщике
+    time_left = format_time_left(reservation['expires_at'] - await store.get_db_time())
+    message_text = f"⏰ <b>Напоминание: бронь подарка истекает {time_left}</b>\n\n"
+    message_text += f"🔗 <a href=\"{reservation['link']}\">Ссылка на товар</a>\n\n"
+    message_text += "Если подарок ещё актуален, не забудьте его подарить!"
+    await bot.send_message(
+        chat_id=reservation['reserved_by'],
+        text=message_text,
+        parse_mode=ParseMode.HTML,
+        disable_web_page_preview=False
+    )
+
+async def handle_reservation_expiry(bot, notifier, reservation):
+    if not await store.expire_reservation(reservation['id']):
+        return
+    notifier.add(reservation['owner_id'], reservation['gift_id'], reservation['link'], EXPIRED)
+    if not reservation['reserver_reachable']:
+        return
+
+    message_text = "⌛ <b>Бронь подарка истекла</b>\n\n"
+    message_text += f"🔗 <a href=\"{reservation['link']}\">Ссылка на товар</a>\n\n"
+    message_text += "Теперь его снова могут забронировать другие."
+    await bot.send_message(
+        chat_id=reservation['reserved_by'],
+        text=message_text,
+        parse_mode=ParseMode.HTML,
+        disable_web_page_preview=False
+    )
+
+async def check_replica_periodically(context: ContextTypes.DEFAULT_TYPE):
+    await store.check_replica()
+
+async def save_update_offset(application):
+    update_id = application.processed_update_id
+    if update_id > application.bot_data.get('saved_update_id', 0):
+        await store.save_last_update_id(update_id)
+        application.bot_data['saved_update_id'] = update_id
+
+async def save_update_offset_periodically(context: ContextTypes.DEFAULT_TYPE):
+    bind_bot(context.bot.id)
+    try:
+        await save_update_offset(context.application)
+    except Exception as e:
+        logger.error("Не удалось сохранить смещение обновлений: %s", e)
 
 async def check_reservations_periodically(context: ContextTypes.DEFAULT_TYPE):
+    bind_bot(context.bot.id)
     try:
-        count = await check_old_reservations()
+        count = await store.check_old_reservations()
         if count > 0:
-            logger.info(f"Автоматически отменено {count} старых бронирований")
+            logger.info("Автоматически отменено %s старых бронирований", count)
     except Exception as e:
-        logger.error(f"Ошибка при проверке бронирований: {e}")
+        logger.error("Ошибка при проверке бронирований: %s", e)
 
-async def handle_friend_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    logger.info(f"Received callback: {query.data} from user {query.from_user.id}")
+    logger.info("Received callback from user %s", query.from_user.id, extra={'sample': True})
 
     try:
-        if query.data.startswith("show_wishlist:"):
-            friend_id = int(query.data.split(":")[1])
-            friend = await get_user_by_id(friend_id)
-            wishlist = await get_user_wishlist(friend_id)
+        await callback_router.dispatch(update, context)
+    except DatabaseUnavailable:
+        await query.message.reply_text(DB_UNAVAILABLE_TEXT)
+    except Exception as e:
+        logger.error("Ошибка при обработке callback: %s", e)
+        await query.edit_message_text("Произошла ошибка 😢 Попробуйте позже.")
 
-            if not wishlist:
-                await query.edit_message_text(f"🎁 У {friend['first_name']} пока нет подарков в списке 😢")
-                return
+# Текст и кнопки брони для подарка друга
+def gift_card(gift, current_user_id: int, bot_id: int, header: str = "🎁 ") -> tuple:
+    message_text = f"{header}[Ссылка на товар]({gift['link']})"
 
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=f"🎁 Список подарков {friend['first_name']}:"
-            )
+    if gift['reserved_by']:
+        if gift['reserved_by'] == current_user_id:
+            message_text += "\n\n✅ *Вы забронировали этот подарок*"
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Отменить бронь", callback_data=encode_callback(CANCEL_RESERVE, gift['id'], user_id=current_user_id, bot_id=bot_id))]
+            ])
+        else:
+            message_text += "\n\n🛑 *Уже забронировано*"
+            keyboard = None
+    else:
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔒 Забронировать", callback_data=encode_callback(RESERVE, gift['id'], user_id=current_user_id, bot_id=bot_id))]
+        ])
+    return message_text, keyboard
 
-            current_user_id = query.from_user.id
-            for gift in wishlist:
-                gift_link = gift['link']
-                message_text = f"🎁 [Ссылка на товар]({gift_link})"
-
-                reservation = await get_reservation_info(gift['id'])
-                if reservation:
-                    if reservation['reserved_by'] == current_user_id:
-                        message_text += "\n\n✅ *Вы забронировали этот подарок*"
-                        keyboard = InlineKeyboardMarkup([
-                            [InlineKeyboardButton("❌ Отменить бронь", callback_data=f"cancel_reserve:{gift['id']}")]
-                        ])
-                    else:
-                        message_text += "\n\n🛑 *Уже забронировано*"
-                        keyboard = None
-                else:
-                    keyboard = InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔒 Забронировать", callback_data=f"reserve:{gift['id']}")]
-                    ])
+async def show_friend_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE, friend_id: int):
+    query = update.callback_query
+    friend = await store.get_user_by_id(friend_id)
+    wishlist = await wishlist_cache.get(friend_id)
 
-                await context.bot.send_message(
-                    chat_id=query.message.chat_id,
-                    text=message_text,
-                    reply_markup=keyboard,
-                    parse_mode=ParseMode.MARKDOWN,
-                    disable_web_page_preview=False
-                )
-
-        elif query.data.startswith("reserve:"):
-            gift_id = int(query.data.split(":")[1])
-            user_id = query.from_user.id
-
-            pool = get_pool()
-            async with pool.acquire() as conn:
-                gift_info = await conn.fetchrow(
-                    'SELECT w.link, w.user_id as owner_id, u.first_name '
-                    'FROM wishlist w '
-                    'JOIN users u ON w.user_id = u.id '
-                    'WHERE w.id = $1',
-                    gift_id
-                )
-
-            if not gift_info:
-                await query.edit_message_text("Подарок не найден.")
-                return
-
-            gift_link = gift_info['link']
-
-            if gift_info['owner_id'] == user_id:
-                await query.edit_message_text("Нельзя забронировать свой собственный подарок 😊")
-                return
-
-            if await reserve_gift(gift_id, user_id):
-                try:
-                    message_text = f"🎉 <b>Кто-то хочет подарить вам этот подарок!</b>\n\n"
-                    message_text += f"🔗 <a href=\"{gift_link}\">Ссылка на товар</a>\n\n"
-                    message_text += "Теперь другие не смогут его забронировать!"
-
-                    await context.bot.send_message(
-                        chat_id=gift_info['owner_id'],
-                        text=message_text,
-                        parse_mode=ParseMode.HTML,
-                        disable_web_page_preview=False
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка при уведомлении владельца: {e}")
-
-                message_text = f"✅ <b>Вы забронировали этот подарок!</b>\n\n"
-                message_text += f"🔗 <a href=\"{gift_link}\">Ссылка на товар</a>\n\n"
-                message_text += "Теперь другие не смогут его выбрать. Не забудьте подарить его в течение 10 дней!"
-
-                await query.edit_message_text(
-                    text=message_text,
-                    parse_mode=ParseMode.HTML,
-                    disable_web_page_preview=False,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("❌ Отменить бронь", callback_data=f"cancel_reserve:{gift_id}")]
-                    ])
-                )
-            else:
-                await query.edit_message_text(
-                    "Не удалось забронировать подарок. Возможно, он уже забронирован.",
-                    parse_mode=ParseMode.HTML
-                )
-
-        elif query.data.startswith("cancel_reserve:"):
-            gift_id = int(query.data.split(":")[1])
-            user_id = query.from_user.id
-
-            pool = get_pool()
-            async with pool.acquire() as conn:
-                gift_info = await conn.fetchrow(
-                    'SELECT w.link, w.user_id as owner_id, u.first_name '
-                    'FROM wishlist w '
-                    'JOIN users u ON w.user_id = u.id '
-                    'WHERE w.id = $1',
-                    gift_id
-                )
-
-            if not gift_info:
-                await query.edit_message_text("Подарок не найден.")
-                return
-
-            gift_link = gift_info['link']
-
-            if await cancel_reservation(gift_id, user_id):
-                try:
-                    message_text = f"😢 <b>Кто-то передумал дарить вам этот подарок</b>\n\n"
-                    message_text += f"🔗 <a href=\"{gift_link}\">Ссылка на товар</a>\n\n"
-                    message_text += "Теперь его снова можно забронировать!"
-
-                    await context.bot.send_message(
-                        chat_id=gift_info['owner_id'],
-                        text=message_text,
-                        parse_mode=ParseMode.HTML,
-                        disable_web_page_preview=False
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка при уведомлении владельца: {e}")
-
-                message_text = f"❌ <b>Вы отменили бронирование подарка</b>\n\n"
-                message_text += f"🔗 <a href=\"{gift_link}\">Ссылка на товар</a>"
-
-                await query.edit_message_text(
-                    text=message_text,
-                    parse_mode=ParseMode.HTML,
-                    disable_web_page_preview=False,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔒 Забронировать снова", callback_data=f"reserve:{gift_id}")]
-                    ])
-                )
-            else:
-                await query.edit_message_text(
-                    "Не удалось отменить бронь. Возможно, она уже была отменена.",
-                    parse_mode=ParseMode.HTML
-                )
-
-        elif query.data.startswith("remove_friend:"):
-            friend_id = int(query.data.split(":")[1])
-            user_id = query.from_user.id
-            await remove_friend(user_id, friend_id)
-
-            pool = get_pool()
-            async with pool.acquire() as conn:
-                await conn.execute(
-                    'DELETE FROM friend_requests WHERE (from_user_id = $1 AND to_user_id = $2) OR (from_user_id = $2 AND to_user_id = $1)',
-                    user_id, friend_id
-                )
-                gifts = await conn.fetch(
-                    'SELECT w.id FROM wishlist w '
-                    'JOIN reservations r ON w.id = r.gift_id '
-                    'WHERE w.user_id = $1 AND r.reserved_by = $2',
-                    user_id, friend_id
-                )
-                friend_gifts = await conn.fetch(
-                    'SELECT w.id FROM wishlist w '
-                    'JOIN reservations r ON w.id = r.gift_id '
-                    'WHERE w.user_id = $1 AND r.reserved_by = $2',
-                    friend_id, user_id
-                )
-
-                for gift in gifts + friend_gifts:
-                    await cancel_reservation(gift['id'], friend_id if gift in gifts else user_id)
-
-            await query.edit_message_text("Друг удалён из списка 💔")
+    if not wishlist:
+        await query.edit_message_text(f"🎁 У {friend['first_name']} пока нет подарков в списке 😢")
+        return
+
+    await context.bot.send_message(
+        chat_id=query.message.chat_id,
+        text=f"🎁 Список подарков {friend['first_name']}:"
+    )
+
+    current_user_id = query.from_user.id
+    for gift in wishlist:
+        message_text, keyboard = gift_card(gift, current_user_id, context.bot.id)
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=message_text,
+            reply_markup=keyboard,
+            parse_mode=ParseMode.MARKDOWN,
+            disable_web_page_preview=False
+        )
+
+# Текст запроса не помещается в callback_data: кнопка несет номер поиска, а тексты
+# последних SEARCH_HISTORY_SIZE запросов хранятся в user_data
+def remember_search(user_data: dict, text: str) -> int:
+    history = user_data.setdefault('search_history', {})
+    search_id = user_data.get('last_search_id', 0) + 1
+    user_data['last_search_id'] = search_id
+    history[search_id] = text
+    for old_id in sorted(history)[:-SEARCH_HISTORY_SIZE]:
+        del history[old_id]
+    return search_id
+
+async def send_search_page(bot, chat_id: int, user_id: int, text: str, search_id: int, after_id: int = 0):
+    # Берем на одну запись больше, чтобы понять, есть ли следующая страница
+    results = await store.search_gifts(user_id, text, after_id, SEARCH_PAGE_SIZE + 1)
+    if not results:
+        await bot.send_message(
+            chat_id=chat_id,
+            text="Ничего не найдено 🤷" if not after_id else "Больше ничего не найдено."
+        )
+        return
+
+    for gift in results[:SEARCH_PAGE_SIZE]:
+        if gift['owner_id'] == user_id:
+            message_text, keyboard = f"🎁 Ваш список: [Ссылка на товар]({gift['link']})", None
+        else:
+            message_text, keyboard = gift_card(gift, user_id, bot.id, header=f"🎁 {escape_markdown(gift['owner_name'] or '')}: ")
+        if gift['title']:
+            message_text += f"\n{escape_markdown(gift['title'])}"
+        await bot.send_message(
+            chat_id=chat_id,
+            text=message_text,
+            reply_markup=keyboard,
+            parse_mode=ParseMode.MARKDOWN,
+            disable_web_page_preview=True
+        )
+
+    if len(results) > SEARCH_PAGE_SIZE:
+        last_id = results[SEARCH_PAGE_SIZE - 1]['id']
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"Есть ещё результаты по запросу «{text}»",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("▶️ Показать ещё", callback_data=encode_callback(SEARCH_MORE, search_id, last_id, user_id=user_id, bot_id=bot.id))]
+            ])
+        )
 
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = " ".join(context.args).strip()
+    if len(text) < SEARCH_MIN_LENGTH:
+        await update.message.reply_text(
+            f"Использование: /search <текст>, не короче {SEARCH_MIN_LENGTH} символов.\n"
+            "Ищу в вашем списке и списках друзей."
+        )
+        return
+
+    search_id = remember_search(context.user_data, text)
+    await send_search_page(context.bot, update.effective_chat.id, update.effective_user.id, text, search_id)
+
+async def search_more_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, search_id: int, after_id: int):
+    query = update.callback_query
+    text = context.user_data.get('search_history', {}).get(search_id)
+    if not text:
+        await query.edit_message_text("Поиск устарел. Повторите /search 🙏")
+        return
+
+    await query.edit_message_reply_markup(reply_markup=None)
+    await send_search_page(context.bot, query.message.chat_id, query.from_user.id, text, search_id, after_id)
+
+async def add_occasion_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    usage = (
+        "Использование: /occasion ДД.ММ Название - ежегодное событие (например, день рождения)\n"
+        "или /occasion ДД.ММ.ГГГГ Название - разовое.\n"
+        f"Друзья получат напоминание за {REMIND_DAYS_BEFORE} дн. со ссылкой на ваш список желаний."
+    )
+    if len(context.args) < 2:
+        await update.message.reply_text(usage)
+        return
+
+    parsed = parse_occasion_date(context.args[0], date.today())
+    title = " ".join(context.args[1:]).strip()[:TITLE_LIMIT]
+    if parsed is None:
+        await update.message.reply_text("Не понял дату или она уже прошла 🙏\n\n" + usage)
+        return
+    if len(await store.get_user_occasions(user_id)) >= OCCASION_LIMIT:
+        await update.message.reply_text(f"🚫 Можно добавить не больше {OCCASION_LIMIT} событий. Удалите лишние в /occasions.")
+        return
+
+    base_date, next_date, yearly = parsed
+    await store.add_occasion(user_id, title, base_date, next_date, yearly, REMIND_DAYS_BEFORE, REMIND_HOUR)
+    await update.message.reply_text(
+        f"📅 Событие «{title}» добавлено: {format_date(next_date)}{' (каждый год)' if yearly else ''}.\n"
+        "Друзья получат напоминание заранее 🎁",
+        reply_markup=main_keyboard()
+    )
+
+async def list_occasions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    occasions = await store.get_user_occasions(user_id)
+    if not occasions:
+        await update.message.reply_text("У вас пока нет событий. Добавьте: /occasion ДД.ММ Название")
+        return
+
+    for occasion in occasions:
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(
+            "❌ Удалить", callback_data=encode_callback(OCCASION_DELETE, occasion['id'], user_id=user_id, bot_id=context.bot.id)
+        )]])
+        await update.message.reply_text(
+            f"📅 {occasion['title']}: {format_date(occasion['next_date'])}{' (каждый год)' if occasion['yearly'] else ''}",
+            reply_markup=keyboard
+        )
+
+async def delete_occasion_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, occasion_id: int):
+    query = update.callback_query
+    if await store.delete_occasion(query.from_user.id, occasion_id):
+        await query.edit_message_text("Событие удалено ✅")
+    else:
+        await query.edit_message_text("Событие не найдено. Возможно, оно уже удалено.")
+
+async def deliver_occasions_periodically(context: ContextTypes.DEFAULT_TYPE):
+    bind_bot(context.bot.id)
+    try:
+        occasions, sent = await deliver_due_occasions(context.bot)
+        if occasions:
+            logger.info("Разосланы напоминания о событиях: %s событий, %s сообщений", occasions, sent)
     except Exception as e:
-        logger.error(f"Ошибка в handle_friend_callback: {e}")
-        await query.edit_message_text("Произошла ошибка 😢 Попробуйте позже.")
+        logger.error("Ошибка при рассылке напоминаний о событиях: %s", e)
 
-async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def reserve_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, gift_id: int):
     query = update.callback_query
-    await query.answer()
-    logger.info(f"Received delete callback: {query.data} from user {query.from_user.id}")
+    user_id = query.from_user.id
+
+    gift_info = await store.get_gift_info(gift_id)
+    if not gift_info:
+        await query.edit_message_text("Подарок не найден.")
+        return
+
+    gift_link = gift_info['link']
+
+    if gift_info['owner_id'] == user_id:
+        await query.edit_message_text("Нельзя забронировать свой собственный подарок 😊")
+        return
+
+    if await store.reserve_gift(gift_id, user_id):
+        if gift_info['owner_reachable']:
+            context.bot_data['owner_notifier'].add(gift_info['owner_id'], gift_id, gift_link, RESERVED)
+
+        message_text = f"✅ <b>Вы забронировали этот подарок!</b>\n\n"
+        message_text += f"🔗 <a href=\"{gift_link}\">Ссылка на товар</a>\n\n"
+        message_text += "Теперь другие не смогут его выбрать. Не забудьте подарить его в течение 10 дней!"
+
+        await query.edit_message_text(
+            text=message_text,
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=False,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Отменить бронь", callback_data=encode_callback(CANCEL_RESERVE, gift_id, user_id=user_id, bot_id=context.bot.id))]
+            ])
+        )
+    else:
+        await query.edit_message_text(
+            "Не удалось забронировать подарок. Возможно, он уже забронирован.",
+            parse_mode=ParseMode.HTML
+        )
+
+async def cancel_reserve_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, gift_id: int):
+    query = update.callback_query
+    user_id = query.from_user.id
+
+    gift_info = await store.get_gift_info(gift_id)
+    if not gift_info:
+        await query.edit_message_text("Подарок не найден.")
+        return
+
+    gift_link = gift_info['link']
+
+    if await store.cancel_reservation(gift_id, user_id):
+        if gift_info['owner_reachable']:
+            context.bot_data['owner_notifier'].add(gift_info['owner_id'], gift_id, gift_link, CANCELLED)
+
+        message_text = f"❌ <b>Вы отменили бронирование подарка</b>\n\n"
+        message_text += f"🔗 <a href=\"{gift_link}\">Ссылка на товар</a>"
+
+        await query.edit_message_text(
+            text=message_text,
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=False,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔒 Забронировать снова", callback_data=encode_callback(RESERVE, gift_id, user_id=user_id, bot_id=context.bot.id))]
+            ])
+        )
+    else:
+        await query.edit_message_text(
+            "Не удалось отменить бронь. Возможно, она уже была отменена.",
+            parse_mode=ParseMode.HTML
+        )
+
+async def remove_friend_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, friend_id: int):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await store.remove_friend(user_id, friend_id)
+
+    notifier = context.bot_data['owner_notifier']
+    for owner_id, reserver_id in ((user_id, friend_id), (friend_id, user_id)):
+        for gift in await store.get_reserved_gifts(owner_id, reserver_id):
+            if await store.cancel_reservation(gift['id'], reserver_id):
+                notifier.add(owner_id, gift['id'], gift['link'], UNFRIENDED)
+
+    await query.edit_message_text("Друг удалён из списка 💔")
+
+async def toggle_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, gift_id: int, selected: int):
+    query = update.callback_query
+    user_id = query.from_user.id
+    gifts = [
+        (current_id, label, not current_selected if current_id == gift_id else current_selected)
+        for current_id, label, current_selected in selected_gifts_from_markup(query.message.reply_markup, user_id, context.bot.id)
+    ]
+    await query.edit_message_reply_markup(reply_markup=delete_keyboard(gifts, user_id, context.bot.id))
+
+async def confirm_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    gift_ids = [
+        gift_id for gift_id, _, selected in selected_gifts_from_markup(query.message.reply_markup, user_id, context.bot.id)
+        if selected
+    ]
+    if not gift_ids:
+        return
+
+    deleted = await store.delete_gifts(user_id, gift_ids)
+    await query.edit_message_text(f"Удалено подарков: {len(deleted)} ✅")
+
+    # Одно уведомление на каждого, чья бронь пропала вместе с подарком
+    links_by_reserver = {}
+    for gift in deleted:
+        if gift['reserved_by']:
+            links_by_reserver.setdefault(gift['reserved_by'], []).append(gift['link'])
+    reachable = await store.filter_reachable(links_by_reserver) if links_by_reserver else set()
+    links_by_reserver = {
+        reserver_id: links for reserver_id, links in links_by_reserver.items() if reserver_id in reachable
+    }
+    if not links_by_reserver:
+        return
+
+    async def notify_reserver(reserver_id, links):
+        message_text = "😢 <b>Владелец удалил из списка подарки, которые вы забронировали:</b>\n\n"
+        message_text += "\n".join(f"🔗 <a href=\"{link}\">Ссылка на товар</a>" for link in links)
+        await context.bot.send_message(
+            chat_id=reserver_id,
+            text=message_text,
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=True
+        )
+
+    results = await asyncio.gather(
+        *(notify_reserver(reserver_id, links) for reserver_id, links in links_by_reserver.items()),
+        return_exceptions=True
+    )
+    for reserver_id, result in zip(links_by_reserver, results):
+        if isinstance(result, Exception):
+            logger.error("Ошибка при уведомлении пользователя %s об удалении подарков: %s", reserver_id, result)
 
-    if query.data.startswith("delete:"):
-        gift_id = int(query.data.split("delete:")[1])
-        await delete_gift_by_id(gift_id)
-        await query.edit_message_text("Подарок удалён ✅")
+async def cancel_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text("Удаление отменено 👌")
 
 async def request_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"Received feedback request from user {update.effective_user.id}")
+    logger.info("Received feedback request from user %s", update.effective_user.id, extra={'sample': True})
     await update.message.reply_text(
         "Напиши свой отзыв или предложение по улучшению бота. "
         "Мы ценим каждое мнение! 😊\n\n"
@@ -616,45 +1098,34 @@ async def request_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.user_data.get('awaiting_feedback'):
+        links = extract_links(update.message)
+        if links:
+            await ingest_links(update, context, links)
         return
-    logger.info(f"Received media feedback from user {update.effective_user.id}")
+    logger.info("Received media feedback from user %s", update.effective_user.id, extra={'sample': True})
 
     user = update.effective_user
     caption = update.message.caption or "Без описания"
 
-    await add_feedback(user.id, user.username, caption)
+    if update.message.photo:
+        media_type, file_id = 'photo', update.message.photo[-1].file_id
+    elif update.message.document:
+        media_type, file_id = 'document', update.message.document.file_id
+    else:
+        media_type, file_id = None, None
+
+    # Админу отзыв уйдет в ближайшем дайджесте (deliver_feedback_digest)
+    await store.add_feedback(user.id, user.username, caption, media_type, file_id)
     await update.message.reply_text(
         "Спасибо за ваш отзыв с медиа! 💖 Мы обязательно его рассмотрим.",
         reply_markup=main_keyboard()
     )
 
-    try:
-        if update.message.photo:
-            photo = update.message.photo[-1].file_id
-            await context.bot.send_photo(
-                chat_id=ADMIN_ID,
-                photo=photo,
-                caption=f"📷 Отзыв от @{user.username} (id: {user.id}):\n\n{caption}"
-            )
-        elif update.message.document:
-            await context.bot.send_document(
-                chat_id=ADMIN_ID,
-                document=update.message.document.file_id,
-                caption=f"📄 Отзыв от @{user.username} (id: {user.id}):\n\n{caption}"
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=f"📦 Отзыв от @{user.username} (id: {user.id}):\n\n{caption}"
-            )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке медиа-отзыва админу: {e}")
-
     del context.user_data['awaiting_feedback']
 
 async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message.text
-    logger.info(f"Received text message: {message} from user {update.effective_user.id}")
+    logger.info("Received text message: %s from user %s", message, update.effective_user.id, extra={'sample': True})
 
     if message == '🏠 Главное меню':
         if 'awaiting_feedback' in context.user_data:
@@ -668,62 +1139,19 @@ async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYP
         if "http" in message.lower():
             await update.message.reply_text("Ссылки в отзывах запрещены.", reply_markup=main_keyboard())
             return
-        await add_feedback(user.id, user.username, message)
+        await store.add_feedback(user.id, user.username, message)
 
         await update.message.reply_text(
             "Спасибо за ваш отзыв! 💖 Мы обязательно его рассмотрим.",
             reply_markup=main_keyboard()
         )
 
-        feedback_text = (
-            f"📝 Новый отзыв от @{user.username} (id: {user.id}):\n\n"
-            f"{message}"
-        )
-
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=feedback_text
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при отправке отзыва админу: {e}")
-
         del context.user_data['awaiting_feedback']
         return
 
-    if message.startswith("http"):
-        try:
-            if await check_gift_limit(update.effective_user.id):
-                await update.message.reply_text(
-                    "🚫 Вы достигли лимита в 15 подарков в вашем списке!",
-                    reply_markup=main_keyboard()
-                )
-                return
-            gift_id = await add_link_to_wishlist(update.effective_user.id, message)
-            logger.info(f"Successfully added gift with id {gift_id} for user {update.effective_user.id}")
-            await update.message.reply_text("Подарок добавлен в твой список! 👍")
-        except asyncpg.UniqueViolationError as e:
-            logger.error(f"UniqueViolationError while adding link to wishlist: {e}")
-            pool = get_pool()
-            async with pool.acquire() as conn:
-                await conn.execute("SELECT setval('wishlist_id_seq', (SELECT MAX(id) FROM wishlist))")
-                logger.info("Synchronized wishlist_id_seq")
-                try:
-                    gift_id = await add_link_to_wishlist(update.effective_user.id, message)
-                    logger.info(f"Successfully added gift with id {gift_id} for user {update.effective_user.id} after sequence sync")
-                    await update.message.reply_text("Подарок добавлен в твой список! 👍")
-                except Exception as e:
-                    logger.error(f"Failed to add link to wishlist after sequence sync: {e}")
-                    await update.message.reply_text(
-                        "Произошла ошибка при добавлении подарка. Попробуйте позже.",
-                        reply_markup=main_keyboard()
-                    )
-        except Exception as e:
-            logger.error(f"Error while adding link to wishlist: {e}")
-            await update.message.reply_text(
-                "Произошла ошибка при добавлении подарка. Попробуйте позже.",
-                reply_markup=main_keyboard()
-            )
+    links = extract_links(update.message)
+    if links:
+        await ingest_links(update, context, links)
         return
 
     await handle_buttons(update, context)
@@ -732,25 +1160,142 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("Доступ запрещен.")
         return
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        users = await conn.fetch("SELECT id FROM users")
-    for user in users:
+    # Заблокировавшие бота исключаются запросом по частичному индексу, без попыток отправки
+    user_ids = await store.get_reachable_user_ids()
+    sent = 0
+    for user_id in user_ids:
         try:
-            await context.bot.send_message(chat_id=user['id'], text=" ".join(context.args))
+            await context.bot.send_message(chat_id=user_id, text=" ".join(context.args))
+            sent += 1
         except Exception as e:
-            logger.error(f"Ошибка отправки пользователю {user['id']}: {e}")
-    await update.message.reply_text("Сообщение отправлено всем пользователям!")
+            logger.error("Ошибка отправки пользователю %s: %s", user_id, e)
+    await update.message.reply_text(f"Сообщение отправлено {sent} из {len(user_ids)} доступных пользователей!")
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+
+    totals, daily = await store.get_stats(days=7)
+    lines = [
+        "📊 *Статистика*",
+        "",
+        f"👤 Пользователи: {totals.get('users', 0)}",
+        f"🎁 Подарки: {totals.get('gifts', 0)}",
+        f"🔒 Активные брони: {totals.get('reservations', 0)}",
+        f"📥 Запросы в друзья: {totals.get('pending_requests', 0)}",
+        f"👫 Пары друзей: {totals.get('friendships', 0)}",
+        f"📝 Отзывы: {totals.get('feedback', 0)}",
+        "",
+        "📈 *По дням* (активные · новые пользователи · подарки · брони · отзывы):"
+    ]
+    for day, metrics in sorted(daily.items(), reverse=True):
+        lines.append(
+            f"{day:%d.%m}: 🔥 {metrics.get('active_users', 0)} · "
+            f"👤 +{metrics.get('new_users', 0)} · "
+            f"🎁 +{metrics.get('new_gifts', 0)} · "
+            f"🔒 +{metrics.get('new_reservations', 0)} · "
+            f"📝 +{metrics.get('feedback', 0)}"
+        )
+    if not daily:
+        lines.append("Пока нет данных")
+
+    lines.append("")
+    lines.append(
+        f"🗂 Кэш списков: {len(wishlist_cache.entries)} записей, попаданий {wishlist_cache.hits}, "
+        f"промахов {wishlist_cache.misses}, LISTEN {'активен' if wishlist_cache.connected else 'отключен'}"
+    )
+
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text(f"Использование: /profile [секунды, до {PROFILE_MAX_SECONDS}]")
+        return
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+
+    if profiler.running:
+        await update.message.reply_text("Профилирование уже идет, дождитесь отчета.")
+        return
+
+    await update.message.reply_text(f"🔬 Профилирую {seconds} с...")
+    report, collapsed = await profiler.run(seconds)
+
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    await update.message.reply_document(
+        document=report.encode(),
+        filename=f"profile-{stamp}.txt",
+        caption="Отчет профилировщика"
+    )
+    if collapsed:
+        await update.message.reply_document(
+            document=collapsed.encode(),
+            filename=f"profile-{stamp}.collapsed",
+            caption="Стеки в формате collapsed (flamegraph.pl, speedscope)"
+        )
+
+async def metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    await update.message.reply_text(metrics_report())
+    await update.message.reply_text(store.query_report())
+
+# Общая для всех ботов процесса инициализация: пул БД и кэш списков
+async def startup():
+    await store.init([bot_id_from_token(token) for token in TELEGRAM_TOKENS])
+    try:
+        await store.sync_wishlist_sequence()
+        logger.info("Synchronized wishlist_id_seq at startup")
+    except Exception as e:
+        logger.error("Error synchronizing wishlist_id_seq at startup: %s", e)
+
+    store.add_wishlist_listener(wishlist_cache.invalidate)
+    wishlist_cache.start()
+
+async def shutdown():
+    await wishlist_cache.stop()
+    await store.close()
 
 async def post_init(application):
-    await init_db()
+    register_bot(application.bot.id, f"@{application.bot.username}")
+    # Задача планировщика наследует привязку к боту
+    bind_bot(application.bot.id)
+    notifier = OwnerNotifier(application.bot)
+    application.bot_data['owner_notifier'] = notifier
+    application.bot_data['link_collector'] = LinkCollector(application.bot, add_links_and_reply)
+    scheduler = ReservationScheduler(
+        on_remind=partial(send_reservation_reminder, application.bot),
+        on_expire=partial(handle_reservation_expiry, application.bot, notifier)
+    )
+    scheduler.start()
+    application.bot_data['reservation_scheduler'] = scheduler
+
+    last_update_id = await store.get_last_update_id()
+    application.resume_after(last_update_id)
+    application.bot_data['saved_update_id'] = last_update_id
+
+# Обработчики уже завершены, а клиент Bot API еще открыт - отправляем накопленные уведомления
+async def post_stop(application):
+    await application.bot_data['link_collector'].flush_all()
+    await application.bot_data['owner_notifier'].flush_all()
+
+async def post_shutdown(application):
+    scheduler = application.bot_data.get('reservation_scheduler')
+    if scheduler:
+        await scheduler.stop()
+    # app.stop() уже дождался всех обработчиков, поэтому граница окончательная
+    bind_bot(application.bot.id)
     try:
-        pool = get_pool()
-        async with pool.acquire() as conn:
-            await conn.execute("SELECT setval('wishlist_id_seq', (SELECT MAX(id) FROM wishlist))")
-            logger.info("Synchronized wishlist_id_seq at startup")
+        await save_update_offset(application)
     except Exception as e:
-        logger.error(f"Error synchronizing wishlist_id_seq at startup: {e}")
+        logger.error("Не удалось сохранить смещение обновлений при остановке: %s", e)
 
 async def notify_admin(context: ContextTypes.DEFAULT_TYPE, message: str):
     global LAST_NOTIFICATION_TIME
@@ -766,11 +1311,22 @@ async def notify_admin(context: ContextTypes.DEFAULT_TYPE, message: str):
         )
         LAST_NOTIFICATION_TIME = current_time
     except Exception as e:
-        logger.error(f"Failed to notify admin: {e}")
+        logger.error("Failed to notify admin: %s", e)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global RESTART_ATTEMPTS
-    logger.error(f"Update {update} caused error {context.error}")
+    logger.error("Update %s caused error %s", getattr(update, 'update_id', None), context.error, exc_info=context.error)
+    if isinstance(update, Update):
+        record_update_error(context.bot.id)
+
+    # Обработчик не дождался базы (или автомат защиты разомкнут) - отвечаем сразу, без уведомления админа
+    if isinstance(context.error, DatabaseUnavailable):
+        if isinstance(update, Update) and update.effective_message:
+            try:
+                await update.effective_message.reply_text(DB_UNAVAILABLE_TEXT)
+            except Exception as e:
+                logger.error("Не удалось ответить о недоступности базы: %s", e)
+        return
 
     if isinstance(context.error, Conflict):
         logger.warning("Conflict detected: another bot instance is running. Attempting to recover...")
@@ -780,81 +1336,173 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             os._exit(0)  # Завершаем процесс, чтобы Render перезапустил
         RESTART_ATTEMPTS += 1
         try:
-            await context.bot.delete_webhook()
+            await context.bot.delete_webhook(drop_pending_updates=False)
             logger.info("Webhook deleted successfully")
-            await context.application.stop()
-            logger.info("Application stopped")
             await asyncio.sleep(5)
             RESTART_ATTEMPTS = 0
             logger.info("Attempting to restart polling...")
-            await context.application.start()
-            await context.application.run_polling(
-                drop_pending_updates=True,
-                poll_interval=2.0,  # Увеличен интервал
-                timeout=30
-            )
+            await restart_updates(context.application)
         except Exception as e:
-            logger.error(f"Failed to recover from Conflict: {e}")
+            logger.error("Failed to recover from Conflict: %s", e)
             await notify_admin(context, f"⚠️ Ошибка: конфликт getUpdates. Не удалось перезапустить: {e}")
             os._exit(0)  # Завершаем процесс, чтобы Render перезапустил
     elif isinstance(context.error, TimedOut):
         logger.warning("TimedOut detected. Retrying in 10 seconds...")
         try:
             await asyncio.sleep(10)
-            await context.application.start()
-            await context.application.run_polling(
-                drop_pending_updates=True,
-                poll_interval=2.0,
-                timeout=30
-            )
+            await restart_updates(context.application)
         except Exception as e:
-            logger.error(f"Failed to recover from TimedOut: {e}")
+            logger.error("Failed to recover from TimedOut: %s", e)
             await notify_admin(context, f"⚠️ Ошибка: TimedOut при запросе к Telegram API. Попытка переподключения не удалась: {e}")
             os._exit(0)
 
+# Перезапуск только получения обновлений: app.stop() здесь дожидался бы и самого error_handler.
+# Очередь не сбрасывается - накопленное догружается так же, как при запуске.
+async def restart_updates(application):
+    if application.updater.running:
+        await application.updater.stop()
+    await start_updates(application, application.bot_data['index'])
+
+def build_application(token: str, request, updates_request, is_primary: bool, index: int):
+    app = ApplicationBuilder() \
+        .application_class(MeteredApplication) \
+        .token(token) \
+        .request(request) \
+        .base_url(BOT_API_BASE_URL) \
+        .post_init(post_init) \
+        .post_stop(post_stop) \
+        .post_shutdown(post_shutdown) \
+        .concurrent_updates(True) \
+        .get_updates_request(updates_request) \
+        .build()
+    app.bot_data['index'] = index
+
+    app.add_handler(TypeHandler(Update, bind_log_context), group=-2)
+    app.add_handler(TypeHandler(Update, track_activity), group=-1)
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("terms", terms))
+    app.add_handler(CommandHandler("search", search))
+    app.add_handler(CommandHandler("occasion", add_occasion_command))
+    app.add_handler(CommandHandler("occasions", list_occasions))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_messages))
+    app.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL, handle_media))
+    app.add_handler(CallbackQueryHandler(handle_callback))
+    app.add_handler(MessageHandler(filters.StatusUpdate.USER_SHARED, handle_user_shared))
+    app.add_handler(ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    app.add_handler(CommandHandler("broadcast", broadcast))
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("feedback", feedback_report))
+    app.add_handler(CommandHandler("profile", profile))
+    app.add_handler(CommandHandler("metrics", metrics))
+    app.add_error_handler(error_handler)
+
+    app.job_queue.run_repeating(
+        callback=check_reservations_periodically,
+        interval=86400,
+        first=10
+    )
+    app.job_queue.run_repeating(
+        callback=refresh_stats_periodically,
+        interval=86400,
+        first=3600
+    )
+    app.job_queue.run_repeating(
+        callback=deliver_feedback_digest,
+        interval=FEEDBACK_DIGEST_INTERVAL,
+        first=30
+    )
+    app.job_queue.run_repeating(
+        callback=deliver_occasions_periodically,
+        interval=OCCASION_CHECK_INTERVAL,
+        first=60
+    )
+    app.job_queue.run_repeating(
+        callback=save_update_offset_periodically,
+        interval=UPDATE_OFFSET_SAVE_INTERVAL,
+        first=UPDATE_OFFSET_SAVE_INTERVAL
+    )
+    # Реплика общая для процесса, проверяем ее из одного бота
+    if is_primary:
+        app.job_queue.run_repeating(
+            callback=check_replica_periodically,
+            interval=REPLICA_CHECK_INTERVAL,
+            first=REPLICA_CHECK_INTERVAL
+        )
+    return app
+
+# Перед запуском получения обрабатывается очередь, накопившаяся за время простоя;
+# поэтому drop_pending_updates не используется
+async def start_updates(app, index: int):
+    bind_bot(app.bot.id)
+    count, seconds = await catch_up(app, on_batch=partial(save_update_offset, app))
+    record_catch_up(app.bot.id, count, seconds)
+    logger.info("Бот @%s: обработано накопленных обновлений %s за %.1f с", app.bot.username, count, seconds)
+
+    if WEBHOOK_URL:
+        # Один бот работает как раньше; при нескольких у каждого свой порт и путь
+        single = len(TELEGRAM_TOKENS) == 1
+        await app.updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT + index,
+            url_path='' if single else str(app.bot.id),
+            webhook_url=WEBHOOK_URL if single else f"{WEBHOOK_URL.rstrip('/')}/{app.bot.id}",
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=False
+        )
+    else:
+        await app.updater.start_polling(
+            drop_pending_updates=False,
+            poll_interval=2.0,  # Увеличен интервал
+            timeout=30,
+            # Как в run_polling: ошибки getUpdates (Conflict, TimedOut) попадают в error_handler
+            error_callback=lambda exc: app.create_task(app.process_error(error=exc, update=None))
+        )
+
+# Таблица маршрутизации общая: обработчики получают бота из context
+def register_callback_routes():
+    callback_router.add(SHOW_WISHLIST, show_friend_wishlist)
+    callback_router.add(REMOVE_FRIEND, remove_friend_callback)
+    callback_router.add(RESERVE, reserve_callback)
+    callback_router.add(CANCEL_RESERVE, cancel_reserve_callback)
+    callback_router.add(DELETE_TOGGLE, toggle_delete_callback)
+    callback_router.add(DELETE_CONFIRM, confirm_delete_callback)
+    callback_router.add(DELETE_CANCEL, cancel_delete_callback)
+    callback_router.add(FRIEND_REQUEST, handle_friend_request_response)
+    callback_router.add(SEARCH_MORE, search_more_callback)
+    callback_router.add(OCCASION_DELETE, delete_occasion_callback)
+
 def main():
+    setup_logging()
+    # До первого asyncio.run: политика event loop действует на создаваемые после нее циклы
+    event_loop, json_codec = apply_runtime_profile(RUNTIME_PROFILE)
+    logger.info("Профиль выполнения %s: event loop %s, JSON %s", RUNTIME_PROFILE, event_loop, json_codec)
     try:
-        http_request = HTTPXRequest(
-            connection_pool_size=50,
+        # Все боты процесса используют общие HTTP-клиенты: один для вызовов методов,
+        # второй для долгих опросов getUpdates (по соединению на бота)
+        request = SharedRequest(connection_pool_size=256)
+        updates_request = SharedRequest(
+            connection_pool_size=len(TELEGRAM_TOKENS) + 2,
             read_timeout=30.0,
             write_timeout=10.0,
             connect_timeout=10.0,
             pool_timeout=30.0
         )
 
-        app = ApplicationBuilder() \
-            .token(TELEGRAM_TOKEN) \
-            .post_init(post_init) \
-            .concurrent_updates(True) \
-            .get_updates_request(http_request) \
-            .build()
-
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("terms", terms))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_messages))
-        app.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL, handle_media))
-        app.add_handler(CallbackQueryHandler(handle_delete_callback, pattern="^delete:"))
-        app.add_handler(CallbackQueryHandler(handle_friend_callback, pattern="^(show_wishlist|remove_friend|reserve|cancel_reserve):"))
-        app.add_handler(CallbackQueryHandler(handle_friend_request_response, pattern="^friend_request:"))
-        app.add_handler(MessageHandler(filters.StatusUpdate.USER_SHARED, handle_user_shared))
-        app.add_handler(CommandHandler("broadcast", broadcast))
-        app.add_error_handler(error_handler)
+        register_callback_routes()
+        if STORAGE == 'memory':
+            use_storage(MemoryStorage())
+            logger.warning("Хранилище в памяти: данные не сохраняются и не видны другим процессам")
 
-        app.job_queue.run_repeating(
-            callback=check_reservations_periodically,
-            interval=86400,
-            first=10
-        )
+        applications = [
+            build_application(token, request, updates_request, is_primary=index == 0, index=index)
+            for index, token in enumerate(TELEGRAM_TOKENS)
+        ]
 
-        logger.info("Запуск бота с Polling...")
-        app.run_polling(
-            drop_pending_updates=True,
-            poll_interval=2.0,  # Увеличен интервал
-            timeout=30
-        )
+        logger.info("Запуск ботов (%s) с %s...", len(applications), "Webhook" if WEBHOOK_URL else "Polling")
+        asyncio.run(run_bots(applications, start_updates, startup, shutdown))
 
     except Exception as e:
-        logger.error(f"Критическая ошибка: {e}")
+        logger.error("Критическая ошибка: %s", e)
         asyncio.run(notify_admin(None, f"⚠️ Критическая ошибка при запуске бота: {e}"))
         asyncio.run(asyncio.sleep(10))
         os._exit(0)
@@ -0,0 +1,574 @@
+# Хранилище в памяти процесса с семантикой PostgresStorage: те же проверки, счетчики /stats
+# и уведомления слушателей списков. Таблицы - словари с индексами, повторяющими индексы схемы
+# в db.py (по боту и владельцу, по сроку брони, по очереди и дате отзывов), поэтому операции
+# не перебирают данные других пользователей и ботов. Исключения, как и COUNT(*) в db.py, -
+# пересчет счетчиков (refresh_stats) и /stats: они проходят таблицы целиком.
+# Строки - словари с теми же именами столбцов, что и в запросах db.py.
+# Для тестов (test_storage.py) и нагрузочного стенда (bench_handlers.py); данные не сохраняются.
+import itertools
+import math
+from bisect import bisect_left, bisect_right, insort
+from datetime import date, datetime, time, timedelta
+
+from db import current_bot_id, DELIVERY_OK, RESERVATION_DAYS
+from occasions import date_in_year
+from storage import Storage
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.users = {}  # id -> {id, username, first_name}
+        self.bot_users = {}  # bot_id -> {user_id: delivery_status}
+        self.gifts = {}  # id -> строка wishlist
+        self.gifts_by_owner = {}  # (bot_id, user_id) -> {id подарка: None} по возрастанию id
+        self.reservations = {}  # gift_id -> строка reservations
+        self.reservation_gifts = {}  # id брони -> gift_id
+        self.reservations_by_expiry = {}  # bot_id -> [(expires_at, id брони)] по возрастанию
+        self.friends = {}  # (bot_id, user_id) -> {friend_id: None}
+        self.requests = {}  # (bot_id, from_user_id, to_user_id) -> строка friend_requests
+        self.incoming = {}  # (bot_id, to_user_id) -> {from_user_id: None}
+        self.feedback = {}  # id -> строка feedback
+        self.feedback_by_created = {}  # bot_id -> [(created_at, id отзыва)] по возрастанию
+        self.undelivered_feedback = {}  # bot_id -> {id отзыва: None} с delivered_at IS NULL по возрастанию id
+        self.counters = {}  # (bot_id, metric) -> value
+        self.daily = {}  # (bot_id, day, metric) -> value
+        self.activity = set()  # (bot_id, day, user_id)
+        self.occasions = {}  # id -> строка occasions
+        self.occasions_by_owner = {}  # (bot_id, user_id) -> {id события: None}
+        self.reminders = {}  # bot_id -> {id события: None} с remind_at IS NOT NULL
+        self.last_update_ids = {}  # bot_id -> last_update_id
+        self.listeners = []
+        self.sequences = {table: itertools.count(1) for table in ('wishlist', 'reservations', 'friend_requests', 'feedback', 'occasions')}
+
+    def _bot(self) -> int:
+        return current_bot_id.get()
+
+    def _next_id(self, table: str) -> int:
+        return next(self.sequences[table])
+
+    def _bump_stats(self, totals: dict, daily: dict = None):
+        bot_id = self._bot()
+        for metric, delta in totals.items():
+            if delta:
+                self.counters[bot_id, metric] = self.counters.get((bot_id, metric), 0) + delta
+        today = date.today()
+        for metric, delta in (daily or {}).items():
+            if delta:
+                self.daily[bot_id, today, metric] = self.daily.get((bot_id, today, metric), 0) + delta
+
+    def _notify_wishlist_changed(self, *owner_ids):
+        bot_id = self._bot()
+        for owner_id in set(owner_ids):
+            for callback in self.listeners:
+                callback(bot_id, owner_id)
+
+    def _own_gift(self, gift_id: int):
+        gift = self.gifts.get(gift_id)
+        return gift if gift and gift['bot_id'] == self._bot() else None
+
+    def _delete_reservation(self, gift_id: int):
+        reservation = self.reservations.pop(gift_id)
+        del self.reservation_gifts[reservation['id']]
+        expiry = self.reservations_by_expiry[self.gifts[gift_id]['bot_id']]
+        del expiry[bisect_left(expiry, (reservation['expires_at'], reservation['id']))]
+        return reservation
+
+    # Брони бота со сроком в (after, until], по возрастанию срока; after = None - с начала
+    def _reservations_expiring(self, after, until) -> list:
+        expiry = self.reservations_by_expiry.get(self._bot(), [])
+        start = 0 if after is None else bisect_right(expiry, (after, math.inf))
+        end = bisect_right(expiry, (until, math.inf))
+        return [self.reservations[self.reservation_gifts[reservation_id]] for _, reservation_id in expiry[start:end]]
+
+    def _are_friends(self, user_id1: int, user_id2: int) -> bool:
+        bot_id = self._bot()
+        return user_id2 in self.friends.get((bot_id, user_id1), ()) or user_id1 in self.friends.get((bot_id, user_id2), ())
+
+    def _delete_request(self, key):
+        request = self.requests.pop(key)
+        incoming = self.incoming[key[0], key[2]]
+        del incoming[key[1]]
+        if not incoming:
+            del self.incoming[key[0], key[2]]
+        return request
+
+    async def init(self, bot_ids: list):
+        pass
+
+    async def close(self):
+        pass
+
+    def add_wishlist_listener(self, callback):
+        self.listeners.append(callback)
+
+    # Данные не разделяются с другими процессами: все изменения приходят через add_wishlist_listener
+    async def connect_listener(self, callback):
+        return None
+
+    # Хранилище в памяти всегда доступно и DatabaseUnavailable не бросает: откладывать нечего
+    def queue_write(self, write) -> bool:
+        return False
+
+    async def check_replica(self):
+        return None
+
+    def query_report(self) -> str:
+        return "Хранилище в памяти: запросов к базе нет."
+
+    async def register_user(self, user):
+        self.users.setdefault(user.id, {'id': user.id, 'username': user.username, 'first_name': user.first_name})
+        members = self.bot_users.setdefault(self._bot(), {})
+        if user.id not in members:
+            members[user.id] = DELIVERY_OK
+            self._bump_stats({'users': 1}, {'new_users': 1})
+        else:
+            members[user.id] = DELIVERY_OK
+
+    async def record_user_activity(self, user_id: int):
+        key = (self._bot(), date.today(), user_id)
+        if key not in self.activity:
+            self.activity.add(key)
+            self._bump_stats({}, {'active_users': 1})
+
+    async def get_user_by_id(self, user_id: int):
+        status = self.bot_users.get(self._bot(), {}).get(user_id)
+        if status is None:
+            return None
+        return {**self.users[user_id], 'delivery_status': status}
+
+    async def set_delivery_status(self, user_id: int, status: str, bot_id: int = None) -> bool:
+        members = self.bot_users.get(bot_id or self._bot(), {})
+        if user_id not in members or members[user_id] == status:
+            return False
+        members[user_id] = status
+        return True
+
+    async def get_reachable_user_ids(self) -> list:
+        return [user_id for user_id, status in self.bot_users.get(self._bot(), {}).items() if status == DELIVERY_OK]
+
+    async def filter_reachable(self, user_ids) -> set:
+        members = self.bot_users.get(self._bot(), {})
+        return {user_id for user_id in user_ids if members.get(user_id) == DELIVERY_OK}
+
+    async def get_last_update_id(self) -> int:
+        return self.last_update_ids.get(self._bot(), 0)
+
+    async def save_last_update_id(self, update_id: int):
+        bot_id = self._bot()
+        self.last_update_ids[bot_id] = max(self.last_update_ids.get(bot_id, update_id), update_id)
+
+    async def add_link_to_wishlist(self, user_id: int, link: str) -> int:
+        gift_id = self._next_id('wishlist')
+        self.gifts[gift_id] = {'id': gift_id, 'bot_id': self._bot(), 'user_id': user_id, 'link': link, 'title': None}
+        self.gifts_by_owner.setdefault((self._bot(), user_id), {})[gift_id] = None
+        self._bump_stats({'gifts': 1}, {'new_gifts': 1})
+        self._notify_wishlist_changed(user_id)
+        return gift_id
+
+    async def add_links_to_wishlist(self, user_id: int, links: list, limit: int):
+        links = list(dict.fromkeys(links))
+        owned = self.gifts_by_owner.get((self._bot(), user_id), {})
+        known = {self.gifts[gift_id]['link'] for gift_id in owned}
+        duplicates = [link for link in links if link in known]
+        fresh = [link for link in links if link not in known]
+        room = max(limit - len(owned), 0)
+        added = []
+        for link in fresh[:room]:
+            gift_id = self._next_id('wishlist')
+            self.gifts[gift_id] = {'id': gift_id, 'bot_id': self._bot(), 'user_id': user_id, 'link': link, 'title': None}
+            self.gifts_by_owner.setdefault((self._bot(), user_id), {})[gift_id] = None
+            added.append({'id': gift_id, 'link': link})
+        if added:
+            self._bump_stats({'gifts': len(added)}, {'new_gifts': len(added)})
+            self._notify_wishlist_changed(user_id)
+        return added, duplicates, fresh[room:]
+
+    async def count_user_gifts(self, user_id: int) -> int:
+        return len(self.gifts_by_owner.get((self._bot(), user_id), ()))
+
+    # Идентификаторы выдаются счетчиком в памяти, выравнивать нечего
+    async def sync_wishlist_sequence(self):
+        pass
+
+    async def get_user_wishlist(self, user_id: int):
+        return [
+            {'id': gift_id, 'link': self.gifts[gift_id]['link']}
+            for gift_id in self.gifts_by_owner.get((self._bot(), user_id), ())
+        ]
+
+    async def get_wishlist_snapshot(self, owner_id: int):
+        return [
+            {'id': gift_id, 'link': self.gifts[gift_id]['link'], 'reserved_by': self._reserved_by(gift_id)}
+            for gift_id in self.gifts_by_owner.get((self._bot(), owner_id), ())
+        ]
+
+    def _reserved_by(self, gift_id: int):
+        reservation = self.reservations.get(gift_id)
+        return reservation['reserved_by'] if reservation else None
+
+    async def delete_gifts(self, user_id: int, gift_ids: list):
+        owned = self.gifts_by_owner.get((self._bot(), user_id), {})
+        deleted = []
+        for gift_id in dict.fromkeys(gift_ids):
+            if gift_id not in owned:
+                continue
+            del owned[gift_id]
+            reserved_by = self._delete_reservation(gift_id)['reserved_by'] if gift_id in self.reservations else None
+            gift = self.gifts.pop(gift_id)
+            deleted.append({'id': gift_id, 'link': gift['link'], 'reserved_by': reserved_by})
+        reserved = sum(1 for row in deleted if row['reserved_by'])
+        self._bump_stats({'gifts': -len(deleted), 'reservations': -reserved})
+        if deleted:
+            self._notify_wishlist_changed(user_id)
+        return deleted
+
+    # ILIKE по подстроке: экранирование шаблона не нужно
+    async def search_gifts(self, user_id: int, text: str, after_id: int = 0, limit: int = 5):
+        bot_id = self._bot()
+        needle = text.lower()
+        owners = [user_id, *self.friends.get((bot_id, user_id), ())]
+        candidates = sorted(
+            gift_id
+            for owner_id in owners
+            for gift_id in self.gifts_by_owner.get((bot_id, owner_id), ())
+            if gift_id > after_id
+        )
+        rows = []
+        for gift_id in candidates:
+            gift = self.gifts[gift_id]
+            if needle not in f"{gift['link']} {gift['title'] or ''}".lower():
+                continue
+            rows.append({
+                'id': gift_id, 'link': gift['link'], 'title': gift['title'], 'owner_id': gift['user_id'],
+                'owner_name': self.users[gift['user_id']]['first_name'], 'reserved_by': self._reserved_by(gift_id)
+            })
+            if len(rows) == limit:
+                break
+        return rows
+
+    async def get_gift_info(self, gift_id: int):
+        gift = self._own_gift(gift_id)
+        if not gift:
+            return None
+        status = self.bot_users.get(gift['bot_id'], {}).get(gift['user_id'])
+        if status is None:
+            return None
+        return {
+            'link': gift['link'], 'owner_id': gift['user_id'],
+            'first_name': self.users[gift['user_id']]['first_name'], 'owner_reachable': status == DELIVERY_OK
+        }
+
+    async def get_friends(self, user_id: int):
+        return [
+            {key: self.users[friend_id][key] for key in ('id', 'username', 'first_name')}
+            for friend_id in self.friends.get((self._bot(), user_id), ())
+        ]
+
+    async def get_friends_of_users(self, user_ids: list):
+        bot_id = self._bot()
+        members = self.bot_users.get(bot_id, {})
+        return [
+            {'user_id': user_id, 'friend_id': friend_id}
+            for user_id in dict.fromkeys(user_ids)
+            for friend_id in self.friends.get((bot_id, user_id), ())
+            if members.get(friend_id) == DELIVERY_OK
+        ]
+
+    async def remove_friend(self, user_id: int, friend_id: int):
+        bot_id = self._bot()
+        friends_deleted = 0
+        for left, right in ((user_id, friend_id), (friend_id, user_id)):
+            friends = self.friends.get((bot_id, left), {})
+            if right in friends:
+                del friends[right]
+                friends_deleted += 1
+        pending_deleted = 0
+        for key in ((bot_id, user_id, friend_id), (bot_id, friend_id, user_id)):
+            if key in self.requests and self._delete_request(key)['status'] == 'pending':
+                pending_deleted += 1
+        self._bump_stats({'friendships': -(friends_deleted // 2), 'pending_requests': -pending_deleted})
+
+    async def check_friendship(self, user_id1: int, user_id2: int) -> bool:
+        return self._are_friends(user_id1, user_id2)
+
+    async def create_friend_request(self, from_user_id: int, to_user_id: int) -> bool:
+        bot_id = self._bot()
+        if (bot_id, from_user_id, to_user_id) in self.requests or (bot_id, to_user_id, from_user_id) in self.requests \
+                or self._are_friends(from_user_id, to_user_id):
+            return False
+        self.requests[bot_id, from_user_id, to_user_id] = {
+            'id': self._next_id('friend_requests'), 'from_user_id': from_user_id, 'to_user_id': to_user_id,
+            'status': 'pending', 'created_at': datetime.now()
+        }
+        self.incoming.setdefault((bot_id, to_user_id), {})[from_user_id] = None
+        self._bump_stats({'pending_requests': 1}, {'friend_requests': 1})
+        return True
+
+    async def update_friend_request(self, from_user_id: int, to_user_id: int, status: str) -> bool:
+        bot_id = self._bot()
+        key = (bot_id, from_user_id, to_user_id)
+        request = self.requests.get(key)
+        if not request or request['status'] != 'pending':
+            return False
+        accepted = 0
+        if status == 'accept':
+            inserted = 0
+            for left, right in ((from_user_id, to_user_id), (to_user_id, from_user_id)):
+                friends = self.friends.setdefault((bot_id, left), {})
+                if right not in friends:
+                    friends[right] = None
+                    inserted += 1
+            accepted = 1 if inserted == 2 else 0
+        self._delete_request(key)
+        self._bump_stats({'pending_requests': -1, 'friendships': accepted}, {'new_friendships': accepted})
+        return True
+
+    async def has_pending_request(self, from_user_id: int, to_user_id: int) -> bool:
+        request = self.requests.get((self._bot(), from_user_id, to_user_id))
+        return bool(request) and request['status'] == 'pending'
+
+    async def delete_pending_request(self, from_user_id: int, to_user_id: int):
+        key = (self._bot(), from_user_id, to_user_id)
+        request = self.requests.get(key)
+        if request and request['status'] == 'pending':
+            self._delete_request(key)
+            self._bump_stats({'pending_requests': -1})
+
+    async def get_pending_requests(self, to_user_id: int):
+        bot_id = self._bot()
+        rows = []
+        for from_user_id in self.incoming.get((bot_id, to_user_id), ()):
+            if self.requests[bot_id, from_user_id, to_user_id]['status'] != 'pending':
+                continue
+            user = self.users[from_user_id]
+            rows.append({'from_user_id': from_user_id, 'username': user['username'], 'first_name': user['first_name']})
+        return rows
+
+    async def reserve_gift(self, gift_id: int, user_id: int) -> bool:
+        gift = self._own_gift(gift_id)
+        if not gift or gift['user_id'] == user_id or gift_id in self.reservations:
+            return False
+        now = datetime.now()
+        reservation_id = self._next_id('reservations')
+        expires_at = now + timedelta(days=RESERVATION_DAYS)
+        self.reservations[gift_id] = {
+            'id': reservation_id, 'gift_id': gift_id, 'reserved_by': user_id, 'reserved_at': now,
+            'expires_at': expires_at, 'reminded': False
+        }
+        self.reservation_gifts[reservation_id] = gift_id
+        insort(self.reservations_by_expiry.setdefault(gift['bot_id'], []), (expires_at, reservation_id))
+        self._bump_stats({'reservations': 1}, {'new_reservations': 1})
+        self._notify_wishlist_changed(gift['user_id'])
+        return True
+
+    async def cancel_reservation(self, gift_id: int, user_id: int) -> bool:
+        gift = self._own_gift(gift_id)
+        reservation = self.reservations.get(gift_id)
+        if not gift or not reservation or reservation['reserved_by'] != user_id:
+            return False
+        self._delete_reservation(gift_id)
+        self._bump_stats({'reservations': -1})
+        self._notify_wishlist_changed(gift['user_id'])
+        return True
+
+    async def get_reserved_gifts(self, owner_id: int, reserver_id: int):
+        return [
+            {'id': gift_id, 'link': self.gifts[gift_id]['link']}
+            for gift_id in self.gifts_by_owner.get((self._bot(), owner_id), ())
+            if self._reserved_by(gift_id) == reserver_id
+        ]
+
+    async def get_reservation_info(self, gift_id: int):
+        reservation = self.reservations.get(gift_id)
+        if not reservation:
+            return None
+        user = self.users[reservation['reserved_by']]
+        return {**reservation, 'first_name': user['first_name'], 'username': user['username']}
+
+    async def check_old_reservations(self, grace_seconds: int = 3600) -> int:
+        deadline = datetime.now() - timedelta(seconds=grace_seconds)
+        owners = [
+            self.gifts[self._delete_reservation(reservation['gift_id'])['gift_id']]['user_id']
+            for reservation in self._reservations_expiring(None, deadline)
+        ]
+        self._bump_stats({'reservations': -len(owners)}, {'expired_reservations': len(owners)})
+        self._notify_wishlist_changed(*owners)
+        return len(owners)
+
+    async def get_db_time(self):
+        return datetime.now()
+
+    async def get_expiring_reservations(self, after, until):
+        members = self.bot_users.get(self._bot(), {})
+        rows = []
+        for reservation in self._reservations_expiring(after, until):
+            gift = self.gifts[reservation['gift_id']]
+            rows.append({
+                'id': reservation['id'], 'gift_id': reservation['gift_id'], 'reserved_by': reservation['reserved_by'],
+                'expires_at': reservation['expires_at'], 'reminded': reservation['reminded'],
+                'link': gift['link'], 'owner_id': gift['user_id'],
+                'reserver_reachable': members.get(reservation['reserved_by']) == DELIVERY_OK
+            })
+        return rows
+
+    async def mark_reservation_reminded(self, reservation_id: int) -> bool:
+        gift_id = self.reservation_gifts.get(reservation_id)
+        if gift_id is None or self.reservations[gift_id]['reminded']:
+            return False
+        self.reservations[gift_id]['reminded'] = True
+        return True
+
+    async def expire_reservation(self, reservation_id: int) -> bool:
+        gift_id = self.reservation_gifts.get(reservation_id)
+        if gift_id is None or self.reservations[gift_id]['expires_at'] > datetime.now():
+            return False
+        self._delete_reservation(gift_id)
+        self._bump_stats({'reservations': -1}, {'expired_reservations': 1})
+        self._notify_wishlist_changed(self.gifts[gift_id]['user_id'])
+        return True
+
+    async def add_occasion(self, user_id: int, title: str, base_date, next_date, yearly: bool,
+                           days_before: int, remind_hour: int) -> int:
+        bot_id = self._bot()
+        occasion_id = self._next_id('occasions')
+        self.occasions[occasion_id] = {
+            'id': occasion_id, 'bot_id': bot_id, 'user_id': user_id, 'title': title, 'base_date': base_date,
+            'next_date': next_date, 'yearly': yearly,
+            'remind_at': datetime.combine(next_date - timedelta(days=days_before), time(remind_hour)),
+            'claimed_at': None
+        }
+        self.occasions_by_owner.setdefault((bot_id, user_id), {})[occasion_id] = None
+        self.reminders.setdefault(bot_id, {})[occasion_id] = None
+        return occasion_id
+
+    async def get_user_occasions(self, user_id: int):
+        today = date.today()
+        rows = [
+            {key: occasion[key] for key in ('id', 'title', 'next_date', 'yearly')}
+            for occasion in map(self.occasions.get, self.occasions_by_owner.get((self._bot(), user_id), ()))
+            if occasion['yearly'] or occasion['next_date'] >= today
+        ]
+        rows.sort(key=lambda row: (row['next_date'], row['id']))
+        return rows
+
+    async def delete_occasion(self, user_id: int, occasion_id: int) -> bool:
+        bot_id = self._bot()
+        owned = self.occasions_by_owner.get((bot_id, user_id), {})
+        if occasion_id not in owned:
+            return False
+        del owned[occasion_id]
+        del self.occasions[occasion_id]
+        self.reminders.get(bot_id, {}).pop(occasion_id, None)
+        return True
+
+    async def claim_due_occasions(self, limit: int, lease_seconds: int = 3600):
+        now = datetime.now()
+        expired = now - timedelta(seconds=lease_seconds)
+        reminders = self.reminders.get(self._bot(), {})
+        due = sorted(
+            (
+                occasion for occasion in map(self.occasions.get, reminders)
+                if occasion['remind_at'] <= now and (occasion['claimed_at'] is None or occasion['claimed_at'] <= expired)
+            ),
+            key=lambda occasion: occasion['remind_at']
+        )[:limit]
+        rows = []
+        for occasion in due:
+            occasion['claimed_at'] = now
+            user = self.users[occasion['user_id']]
+            rows.append({
+                'id': occasion['id'], 'user_id': occasion['user_id'], 'title': occasion['title'],
+                'occasion_date': occasion['next_date'], 'first_name': user['first_name'], 'username': user['username']
+            })
+        return rows
+
+    async def complete_occasions(self, occasion_ids: list, days_before: int, remind_hour: int):
+        bot_id = self._bot()
+        reminders = self.reminders.get(bot_id, {})
+        for occasion_id in occasion_ids:
+            occasion = self.occasions.get(occasion_id)
+            if not occasion or occasion['bot_id'] != bot_id or occasion['claimed_at'] is None:
+                continue
+            occasion['claimed_at'] = None
+            if occasion['yearly']:
+                base_date = occasion['base_date']
+                occasion['next_date'] = date_in_year(occasion['next_date'].year + 1, base_date.month, base_date.day)
+                occasion['remind_at'] = datetime.combine(occasion['next_date'] - timedelta(days=days_before), time(remind_hour))
+            else:
+                occasion['remind_at'] = None
+                del reminders[occasion_id]
+
+    async def add_feedback(self, user_id: int, username: str, text: str, media_type: str = None, file_id: str = None):
+        bot_id = self._bot()
+        feedback_id = self._next_id('feedback')
+        created_at = datetime.now()
+        self.feedback[feedback_id] = {
+            'id': feedback_id, 'bot_id': bot_id, 'user_id': user_id, 'username': username, 'text': text,
+            'media_type': media_type, 'file_id': file_id, 'created_at': created_at, 'claimed_at': None, 'delivered_at': None
+        }
+        insort(self.feedback_by_created.setdefault(bot_id, []), (created_at, feedback_id))
+        self.undelivered_feedback.setdefault(bot_id, {})[feedback_id] = None
+        self._bump_stats({'feedback': 1}, {'feedback': 1})
+
+    async def claim_feedback_batch(self, limit: int, lease_seconds: int = 900):
+        now = datetime.now()
+        expired = now - timedelta(seconds=lease_seconds)
+        rows = []
+        for feedback_id in self.undelivered_feedback.get(self._bot(), ()):
+            if len(rows) == limit:
+                break
+            item = self.feedback[feedback_id]
+            if item['claimed_at'] is not None and item['claimed_at'] > expired:
+                continue
+            item['claimed_at'] = now
+            rows.append({key: item[key] for key in ('id', 'user_id', 'username', 'text', 'media_type', 'file_id', 'created_at')})
+        return rows
+
+    async def mark_feedback_delivered(self, feedback_ids: list):
+        now = datetime.now()
+        for feedback_id in feedback_ids:
+            item = self.feedback.get(feedback_id)
+            if item:
+                item.update(delivered_at=now, claimed_at=None)
+                self.undelivered_feedback[item['bot_id']].pop(feedback_id, None)
+
+    async def release_feedback(self, feedback_ids: list):
+        for feedback_id in feedback_ids:
+            item = self.feedback.get(feedback_id)
+            if item and item['delivered_at'] is None:
+                item['claimed_at'] = None
+
+    async def get_feedback_between(self, start, end, after: tuple = None, limit: int = 50):
+        created = self.feedback_by_created.get(self._bot(), [])
+        first = bisect_right(created, after or (start, 0))
+        last = min(bisect_left(created, (end, 0)), first + limit)
+        return [
+            {key: self.feedback[feedback_id][key] for key in ('id', 'user_id', 'username', 'text', 'media_type', 'created_at')}
+            for _, feedback_id in created[first:last]
+        ]
+
+    async def get_stats(self, days: int = 7):
+        bot_id = self._bot()
+        since = date.today() - timedelta(days=days)
+        totals = {metric: value for (counter_bot, metric), value in self.counters.items() if counter_bot == bot_id}
+        daily = {}
+        for (counter_bot, day, metric), value in sorted(self.daily.items(), key=lambda item: item[0][1]):
+            if counter_bot == bot_id and day > since:
+                daily.setdefault(day, {})[metric] = value
+        return totals, daily
+
+    async def refresh_stats(self, keep_activity_days: int = 30):
+        bot_id = self._bot()
+        totals = {
+            'users': len(self.bot_users.get(bot_id, ())),
+            'gifts': sum(1 for gift in self.gifts.values() if gift['bot_id'] == bot_id),
+            'reservations': len(self.reservations_by_expiry.get(bot_id, ())),
+            'pending_requests': sum(
+                1 for key, request in self.requests.items() if key[0] == bot_id and request['status'] == 'pending'
+            ),
+            'friendships': sum(len(friends) for (friends_bot, _), friends in self.friends.items() if friends_bot == bot_id) // 2,
+            'feedback': len(self.feedback_by_created.get(bot_id, ())),
+        }
+        for metric, value in totals.items():
+            self.counters[bot_id, metric] = value
+        oldest = date.today() - timedelta(days=keep_activity_days)
+        self.activity = {key for key in self.activity if key[0] != bot_id or key[1] >= oldest}
@@ -0,0 +1,94 @@
+# Метрики ботов, работающих в одном процессе.
+# Счетчики обновляются в event loop без блокировок; отчет оценивает, сколько ботов
+# выдержит одно ядро, по доле процессорного времени, приходящейся на каждый бот.
+import os
+import time
+
+class BotMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.updates = 0
+        self.update_errors = 0
+        self.update_seconds = 0.0
+        self.update_max = 0.0
+        self.api_calls = 0
+        self.api_errors = 0
+        self.api_seconds = 0.0
+        self.backlog_updates = 0
+        self.backlog_seconds = 0.0
+
+_bots = {}  # bot_id -> BotMetrics
+_gauges = {}  # имя -> функция, возвращающая текущее значение (общие для процесса)
+_started_wall = time.monotonic()
+_started_cpu = time.process_time()
+
+def register_bot(bot_id: int, name: str):
+    if bot_id in _bots:
+        _bots[bot_id].name = name
+    else:
+        _bots[bot_id] = BotMetrics(name)
+
+def _for_bot(bot_id: int) -> BotMetrics:
+    metrics = _bots.get(bot_id)
+    if metrics is None:
+        metrics = _bots[bot_id] = BotMetrics(str(bot_id))
+    return metrics
+
+def register_gauge(name: str, read):
+    _gauges[name] = read
+
+def record_update(bot_id: int, seconds: float):
+    metrics = _for_bot(bot_id)
+    metrics.updates += 1
+    metrics.update_seconds += seconds
+    metrics.update_max = max(metrics.update_max, seconds)
+
+# Исключения обработчиков PTB передает в error_handler, а не наружу из process_update
+def record_update_error(bot_id: int):
+    _for_bot(bot_id).update_errors += 1
+
+def record_api_call(bot_id: int, seconds: float, failed: bool = False):
+    metrics = _for_bot(bot_id)
+    metrics.api_calls += 1
+    metrics.api_seconds += seconds
+    if failed:
+        metrics.api_errors += 1
+
+def record_catch_up(bot_id: int, updates: int, seconds: float):
+    metrics = _for_bot(bot_id)
+    metrics.backlog_updates = updates
+    metrics.backlog_seconds = seconds
+
+def report() -> str:
+    uptime = max(time.monotonic() - _started_wall, 1e-9)
+    cpu = time.process_time() - _started_cpu
+    total_updates = sum(metrics.updates for metrics in _bots.values())
+    # Процессорное время делится между ботами пропорционально числу обновлений
+    cpu_per_update = cpu / total_updates if total_updates else 0.0
+
+    lines = [
+        f"Процесс {os.getpid()}: работает {uptime / 60:.0f} мин, CPU {cpu:.1f} с ({cpu / uptime:.1%} ядра), "
+        f"ботов {len(_bots)}",
+    ]
+    if _gauges:
+        lines.append(", ".join(f"{name}={read()}" for name, read in _gauges.items()))
+    lines.append("")
+    for bot_id, metrics in sorted(_bots.items()):
+        rate = metrics.updates / uptime
+        mean = metrics.update_seconds / metrics.updates if metrics.updates else 0.0
+        api_mean = metrics.api_seconds / metrics.api_calls if metrics.api_calls else 0.0
+        core_share = rate * cpu_per_update
+        lines.append(
+            f"{metrics.name} ({bot_id}): обновлений {metrics.updates} ({rate:.2f}/с), "
+            f"ошибок {metrics.update_errors}, обработка {mean * 1000:.0f} мс (макс. {metrics.update_max * 1000:.0f} мс), "
+            f"Bot API {metrics.api_calls} вызовов по {api_mean * 1000:.0f} мс, ошибок {metrics.api_errors}, "
+            f"доля ядра {core_share:.2%}, "
+            f"очередь при запуске {metrics.backlog_updates} за {metrics.backlog_seconds:.1f} с"
+        )
+
+    if total_updates and _bots:
+        mean_share = cpu / uptime / len(_bots)
+        if mean_share > 0:
+            lines.append("")
+            lines.append(f"При текущей нагрузке одно ядро выдержит примерно {1 / mean_share:.0f} таких ботов")
+    return "\n".join(lines)
@@ -0,0 +1,128 @@
+# События пользователей (дни рождения и т.п.) и напоминания о них друзьям.
+# Периодическая задача бота забирает наступившие напоминания пачками по индексу occasions(bot_id, remind_at),
+# друзей всех владельцев пачки получает одним запросом и рассылает сообщения параллельно,
+# не превышая лимит Bot API. Опроса по каждому пользователю нет.
+import asyncio
+import html
+import logging
+import re
+import time
+from datetime import date
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+
+from callbacks import encode_callback, SHOW_WISHLIST
+from storage import store
+
+logger = logging.getLogger(__name__)
+
+REMIND_DAYS_BEFORE = 3
+REMIND_HOUR = 10  # часов, время сервера БД
+CLAIM_BATCH_SIZE = 500
+CLAIM_LEASE_SECONDS = 3600  # рассылка пачки укладывается с запасом; после сбоя пачка повторится
+SENDS_PER_SECOND = 25  # Telegram допускает около 30 сообщений в секунду на бота
+MAX_CONCURRENT_SENDS = 16
+TITLE_LIMIT = 100
+
+# ДД.ММ - ежегодное событие, ДД.ММ.ГГГГ - разовое
+DATE_PATTERN = re.compile(r"^(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?$")
+# Год для даты ежегодного события: високосный, чтобы 29.02 было допустимо
+YEARLY_BASE_YEAR = 2000
+
+# Дата в году; 29 февраля в невисокосный год переносится на 28-е (как при сложении дат в PostgreSQL)
+def date_in_year(year: int, month: int, day: int) -> date:
+    try:
+        return date(year, month, day)
+    except ValueError:
+        if month == 2 and day == 29:
+            return date(year, 2, 28)
+        raise
+
+# Возвращает (base_date, next_date, yearly) или None, если дата некорректна или уже прошла
+def parse_occasion_date(text: str, today: date):
+    match = DATE_PATTERN.match(text)
+    if not match:
+        return None
+    day, month = int(match.group(1)), int(match.group(2))
+    try:
+        if match.group(3):
+            occasion_date = date(int(match.group(3)), month, day)
+            return (occasion_date, occasion_date, False) if occasion_date >= today else None
+        base_date = date(YEARLY_BASE_YEAR, month, day)
+    except ValueError:
+        return None
+    next_date = date_in_year(today.year, month, day)
+    if next_date < today:
+        next_date = date_in_year(today.year + 1, month, day)
+    return base_date, next_date, True
+
+def format_date(value: date) -> str:
+    return value.strftime("%d.%m.%Y")
+
+# Не более rate отправок в секунду с равномерными интервалами
+class RateLimiter:
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+def reminder_text(occasion) -> str:
+    name = html.escape(occasion['first_name'] or occasion['username'] or "Ваш друг")
+    days_left = (occasion['occasion_date'] - date.today()).days
+    when = "сегодня" if days_left <= 0 else "завтра" if days_left == 1 else f"через {days_left} дн. ({format_date(occasion['occasion_date'])})"
+    return (
+        f"📅 <b>{name}: {html.escape(occasion['title'])} — {when}</b>\n\n"
+        "Загляните в список желаний, чтобы выбрать подарок 🎁"
+    )
+
+# Рассылает все наступившие напоминания бота; возвращает (событий, отправлено сообщений)
+async def deliver_due_occasions(bot) -> tuple:
+    limiter = RateLimiter(SENDS_PER_SECOND)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+    occasions_total = sent = 0
+
+    async def send(friend_id, occasion):
+        nonlocal sent
+        async with semaphore:
+            await limiter.wait()
+            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(
+                "🎁 Открыть список желаний",
+                callback_data=encode_callback(SHOW_WISHLIST, occasion['user_id'], user_id=friend_id, bot_id=bot.id)
+            )]])
+            try:
+                await bot.send_message(
+                    chat_id=friend_id,
+                    text=reminder_text(occasion),
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=keyboard
+                )
+                sent += 1
+            except Exception as e:
+                logger.error("Не удалось отправить напоминание о событии %s пользователю %s: %s", occasion['id'], friend_id, e)
+
+    while True:
+        occasions = await store.claim_due_occasions(CLAIM_BATCH_SIZE, CLAIM_LEASE_SECONDS)
+        if not occasions:
+            break
+        occasions_total += len(occasions)
+        by_owner = {}
+        for occasion in occasions:
+            by_owner.setdefault(occasion['user_id'], []).append(occasion)
+        friendships = await store.get_friends_of_users(list(by_owner))
+        await asyncio.gather(*(
+            send(row['friend_id'], occasion)
+            for row in friendships
+            for occasion in by_owner[row['user_id']]
+        ))
+        # Только после рассылки: при сбое посреди нее пачка повторится по истечении аренды
+        await store.complete_occasions([occasion['id'] for occasion in occasions], REMIND_DAYS_BEFORE, REMIND_HOUR)
+        if len(occasions) < CLAIM_BATCH_SIZE:
+            break
+    return occasions_total, sent
@@ -0,0 +1,128 @@
+# Объединение уведомлений владельцам об изменениях броней их подарков.
+# События копятся по владельцу: окно продлевается каждым новым событием на DEBOUNCE_SECONDS,
+# но не дольше MAX_DELAY_SECONDS от первого. По каждому подарку важен только итог окна:
+# бронь и отмена подряд взаимно уничтожаются, остальное уходит одним сообщением.
+# Сами брони к этому моменту уже записаны; при падении процесса теряются только неотправленные уведомления.
+import asyncio
+import html
+import logging
+
+from telegram.constants import ParseMode
+
+from metrics import register_gauge
+from storage import bind_bot, DatabaseUnavailable, store
+
+logger = logging.getLogger(__name__)
+
+DEBOUNCE_SECONDS = 20
+MAX_DELAY_SECONDS = 90
+
+# События
+RESERVED = 'reserved'
+CANCELLED = 'cancelled'  # бронировавший передумал
+EXPIRED = 'expired'  # истек срок брони
+UNFRIENDED = 'unfriended'  # бронь снята при удалении из друзей
+
+# Текст отдельного уведомления: (заголовок, пояснение)
+SINGLE_TEXTS = {
+    RESERVED: ("🎉 <b>Кто-то хочет подарить вам этот подарок!</b>", "Теперь другие не смогут его забронировать!"),
+    CANCELLED: ("😢 <b>Кто-то передумал дарить вам этот подарок</b>", "Теперь его снова можно забронировать!"),
+    EXPIRED: ("⌛ <b>Бронь вашего подарка истекла</b>", "Теперь его снова можно забронировать!"),
+    UNFRIENDED: ("💔 <b>Бронь вашего подарка снята: вы больше не друзья</b>", "Теперь его снова можно забронировать!"),
+}
+# Строка сводки по нескольким подаркам
+SUMMARY_LABELS = {
+    RESERVED: "🎉 Забронирован",
+    CANCELLED: "😢 Бронь отменена",
+    EXPIRED: "⌛ Бронь истекла",
+    UNFRIENDED: "💔 Бронь снята (удаление из друзей)",
+}
+
+# Общие для процесса счетчики
+stats = {'events': 0, 'cancelled_out': 0, 'sent': 0}
+register_gauge('owner_notify_events', lambda: stats['events'])
+register_gauge('owner_notify_cancelled_out', lambda: stats['cancelled_out'])
+register_gauge('owner_notify_sent', lambda: stats['sent'])
+
+def gift_link(link: str) -> str:
+    return f"<a href=\"{html.escape(link)}\">Ссылка на товар</a>"
+
+def format_changes(changes: list) -> str:
+    if len(changes) == 1:
+        event, link = changes[0]
+        title, note = SINGLE_TEXTS[event]
+        return f"{title}\n\n🔗 {gift_link(link)}\n\n{note}"
+    lines = ["🎁 <b>Изменения броней ваших подарков</b>", ""]
+    lines += [f"{SUMMARY_LABELS[event]}: {gift_link(link)}" for event, link in changes]
+    return "\n".join(lines)
+
+class OwnerNotifier:
+    def __init__(self, bot):
+        self.bot = bot
+        self.pending = {}  # owner_id -> {gift_id: [был ли забронирован до окна, последнее событие, ссылка]}
+        self.window_started = {}  # owner_id -> время первого события окна
+        self.timers = {}  # owner_id -> TimerHandle
+        self.tasks = set()
+
+    def add(self, owner_id: int, gift_id: int, link: str, event: str):
+        stats['events'] += 1
+        gifts = self.pending.setdefault(owner_id, {})
+        change = gifts.get(gift_id)
+        if change is None:
+            # Бронь появляется только у свободного подарка, остальные события - у забронированного
+            gifts[gift_id] = [event != RESERVED, event, link]
+        else:
+            change[1] = event
+            change[2] = link
+        self._schedule(owner_id)
+
+    def _schedule(self, owner_id: int):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        started = self.window_started.setdefault(owner_id, now)
+        timer = self.timers.pop(owner_id, None)
+        if timer:
+            timer.cancel()
+        delay = max(0.0, min(DEBOUNCE_SECONDS, started + MAX_DELAY_SECONDS - now))
+        self.timers[owner_id] = loop.call_later(delay, self._start_flush, owner_id)
+
+    def _start_flush(self, owner_id: int):
+        self.timers.pop(owner_id, None)
+        task = asyncio.get_running_loop().create_task(self._flush(owner_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _flush(self, owner_id: int):
+        self.window_started.pop(owner_id, None)
+        gifts = self.pending.pop(owner_id, {})
+        changes = [
+            (event, link) for was_reserved, event, link in gifts.values()
+            if was_reserved != (event == RESERVED)
+        ]
+        stats['cancelled_out'] += len(gifts) - len(changes)
+        if not changes:
+            return
+
+        bind_bot(self.bot.id)
+        try:
+            if not await store.filter_reachable([owner_id]):
+                return
+        except DatabaseUnavailable:
+            pass  # статус доставки неизвестен - пробуем отправить
+        try:
+            await self.bot.send_message(
+                chat_id=owner_id,
+                text=format_changes(changes),
+                parse_mode=ParseMode.HTML,
+                disable_web_page_preview=len(changes) > 1
+            )
+            stats['sent'] += 1
+        except Exception as e:
+            logger.error("Ошибка при уведомлении владельца %s: %s", owner_id, e)
+
+    # При остановке бота накопленное отправляется сразу
+    async def flush_all(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        await asyncio.gather(*(self._flush(owner_id) for owner_id in list(self.pending)), *self.tasks)
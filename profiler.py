@@ -0,0 +1,180 @@
+# Профилирование работающего процесса по команде администратора.
+# Пока профилирование выключено, ничего не установлено: ни потока, ни хуков, ни режима отладки.
+# Во время сеанса:
+#   - отдельный поток с заданной частотой снимает стек потока event loop (sys._current_frames);
+#   - loop переводится в режим отладки, предупреждения asyncio о медленных колбэках собираются;
+#   - периодически снимается список задач, чтобы оценить время жизни корутин.
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.005  # секунд между снимками стека
+TASK_SCAN_INTERVAL = 0.05  # секунд между снимками списка задач
+SLOW_CALLBACK_DURATION = 0.05  # секунд, порог предупреждения asyncio в режиме отладки
+MAX_STACK_DEPTH = 64
+TOP_N = 25
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def is_project_code(code) -> bool:
+    return code.co_filename.startswith(PROJECT_DIR)
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    if is_project_code(code):
+        filename = os.path.relpath(filename, PROJECT_DIR)
+    else:
+        filename = os.path.basename(filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+def is_idle(frame) -> bool:
+    # Loop ждет событий внутри селектора - это не нагрузка
+    return frame.f_code.co_name == 'select' and frame.f_code.co_filename.endswith('selectors.py')
+
+def task_label(task) -> str:
+    # Задачи обработчиков PTB имеют одинаковую внешнюю корутину, поэтому ищем
+    # самую внешнюю корутину проекта в цепочке ожидания
+    coro = task.get_coro()
+    outer = getattr(coro, '__qualname__', repr(coro))
+    depth = 0
+    while coro is not None and depth < MAX_STACK_DEPTH:
+        code = getattr(coro, 'cr_code', None) or getattr(coro, 'gi_code', None)
+        if code is not None and is_project_code(code):
+            return coro.__qualname__
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+        depth += 1
+    return outer
+
+class _SlowCallbackHandler(logging.Handler):
+    # asyncio пишет 'Executing %s took %.3f seconds'; группируем по описанию колбэка
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.callbacks = {}  # описание -> (количество, суммарно, максимум)
+
+    def emit(self, record):
+        if not record.msg.startswith('Executing') or len(record.args) != 2:
+            return
+        handle, duration = record.args
+        handle = str(handle).split(' wait_for=')[0][:300]
+        count, total, longest = self.callbacks.get(handle, (0, 0.0, 0.0))
+        self.callbacks[handle] = (count + 1, total + duration, max(longest, duration))
+
+class Profiler:
+    def __init__(self):
+        self.running = False
+
+    async def run(self, seconds: float) -> tuple:
+        if self.running:
+            raise RuntimeError("Профилирование уже запущено")
+        self.running = True
+        loop = asyncio.get_running_loop()
+        loop_thread_id = threading.get_ident()
+
+        stacks = Counter()
+        project_labels = set()
+        samples = {'total': 0, 'idle': 0}
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(SAMPLE_INTERVAL):
+                frame = sys._current_frames().get(loop_thread_id)
+                if frame is None:
+                    continue
+                samples['total'] += 1
+                if is_idle(frame):
+                    samples['idle'] += 1
+                    continue
+                labels = []
+                while frame is not None and len(labels) < MAX_STACK_DEPTH:
+                    label = frame_label(frame)
+                    if is_project_code(frame.f_code):
+                        project_labels.add(label)
+                    labels.append(label)
+                    frame = frame.f_back
+                stacks[';'.join(reversed(labels))] += 1
+
+        slow_callbacks = _SlowCallbackHandler()
+        asyncio_logger = logging.getLogger('asyncio')
+        was_debug = loop.get_debug()
+        old_duration = loop.slow_callback_duration
+
+        task_spans = {}  # задача -> (метка, первый снимок, последний снимок)
+        sampler = threading.Thread(target=sample, name='profiler-sampler', daemon=True)
+        started = time.perf_counter()
+        try:
+            asyncio_logger.addHandler(slow_callbacks)
+            loop.slow_callback_duration = SLOW_CALLBACK_DURATION
+            loop.set_debug(True)
+            sampler.start()
+
+            deadline = loop.time() + seconds
+            current = asyncio.current_task()
+            while loop.time() < deadline:
+                now = time.perf_counter()
+                for task in asyncio.all_tasks(loop):
+                    if task is current:
+                        continue
+                    span = task_spans.get(task)
+                    task_spans[task] = (span[0] if span else task_label(task), span[1] if span else now, now)
+                await asyncio.sleep(TASK_SCAN_INTERVAL)
+        finally:
+            stop.set()
+            sampler.join()
+            loop.set_debug(was_debug)
+            loop.slow_callback_duration = old_duration
+            asyncio_logger.removeHandler(slow_callbacks)
+            self.running = False
+
+        elapsed = time.perf_counter() - started
+        report = self._report(elapsed, samples, stacks, project_labels, slow_callbacks.callbacks, task_spans)
+        collapsed = '\n'.join(f"{stack} {count}" for stack, count in stacks.most_common())
+        return report, collapsed
+
+    def _report(self, elapsed, samples, stacks, project_labels, slow_callbacks, task_spans) -> str:
+        total = samples['total'] or 1
+        busy = samples['total'] - samples['idle']
+        lines = [
+            f"Длительность: {elapsed:.1f} с, снимков стека: {samples['total']}",
+            f"Загрузка event loop: {busy / total:.1%} (ожидание событий: {samples['idle'] / total:.1%})",
+            "",
+        ]
+
+        self_time = Counter()
+        inclusive = Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            self_time[frames[-1]] += count
+            for label in set(frames):
+                inclusive[label] += count
+
+        lines.append(f"Функции по собственному времени (топ {TOP_N}):")
+        for label, count in self_time.most_common(TOP_N):
+            lines.append(f"  {count / total:6.1%}  {label}")
+        lines.append("")
+
+        lines.append(f"Функции проекта по полному времени (топ {TOP_N}):")
+        project = Counter({label: count for label, count in inclusive.items() if label in project_labels})
+        for label, count in project.most_common(TOP_N):
+            lines.append(f"  {count / total:6.1%}  {label}")
+        lines.append("")
+
+        by_coroutine = {}
+        for label, first_seen, last_seen in task_spans.values():
+            count, wall, longest = by_coroutine.get(label, (0, 0.0, 0.0))
+            duration = last_seen - first_seen
+            by_coroutine[label] = (count + 1, wall + duration, max(longest, duration))
+        lines.append(f"Корутины по времени выполнения (топ {TOP_N}; задач, суммарно, максимум):")
+        for label, (count, wall, longest) in sorted(by_coroutine.items(), key=lambda item: item[1][1], reverse=True)[:TOP_N]:
+            lines.append(f"  {count:5}  {wall:8.2f} с  {longest:7.2f} с  {label}")
+        lines.append("")
+
+        slow_total = sum(count for count, _, _ in slow_callbacks.values())
+        lines.append(f"Медленные колбэки (> {SLOW_CALLBACK_DURATION * 1000:.0f} мс): {slow_total} (раз, суммарно, максимум):")
+        for handle, (count, wall, longest) in sorted(slow_callbacks.items(), key=lambda item: item[1][1], reverse=True)[:TOP_N]:
+            lines.append(f"  {count:5}  {wall:8.2f} с  {longest:7.3f} с  {handle}")
+        return '\n'.join(lines)
@@ -0,0 +1,96 @@
+# Планировщик напоминаний и истечения броней.
+# Ближайшие события подгружаются из БД по индексу reservations(expires_at) окнами
+# и хранятся в куче; каждое окно начинается там, где закончилось предыдущее,
+# поэтому после перезапуска таблица не сканируется целиком.
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import timedelta
+
+from storage import store
+
+logger = logging.getLogger(__name__)
+
+REMIND_BEFORE = timedelta(days=2)
+LOAD_HORIZON = timedelta(hours=1)
+REFILL_INTERVAL = 15 * 60  # секунд, меньше LOAD_HORIZON
+RETRY_INTERVAL = 60
+
+REMIND = 'remind'
+EXPIRE = 'expire'
+
+class ReservationScheduler:
+    def __init__(self, on_remind, on_expire):
+        self.on_remind = on_remind
+        self.on_expire = on_expire
+        self.heap = []
+        self.counter = itertools.count()
+        self.loaded_until = None
+        self.next_refill = 0
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    def _push(self, due: float, kind: str, reservation):
+        heapq.heappush(self.heap, (due, next(self.counter), kind, reservation))
+
+    async def refill(self):
+        loop = asyncio.get_running_loop()
+        db_now = await store.get_db_time()
+        until = db_now + LOAD_HORIZON + REMIND_BEFORE
+        rows = await store.get_expiring_reservations(self.loaded_until, until)
+
+        base = loop.time()
+        for row in rows:
+            expires_in = (row['expires_at'] - db_now).total_seconds()
+            if not row['reminded'] and expires_in > 0:
+                remind_in = expires_in - REMIND_BEFORE.total_seconds()
+                self._push(base + max(remind_in, 0), REMIND, row)
+            self._push(base + max(expires_in, 0), EXPIRE, row)
+
+        self.loaded_until = until
+        self.next_refill = base + REFILL_INTERVAL
+        if rows:
+            logger.info("Загружено броней в планировщик: %s (в очереди событий: %s)", len(rows), len(self.heap))
+
+    async def _fire(self, kind: str, reservation):
+        try:
+            if kind == REMIND:
+                await self.on_remind(reservation)
+            else:
+                await self.on_expire(reservation)
+        except Exception as e:
+            logger.error("Ошибка при обработке события брони %s (%s): %s", reservation['id'], kind, e)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now >= self.next_refill:
+                try:
+                    await self.refill()
+                except Exception as e:
+                    logger.error("Ошибка при загрузке броней в планировщик: %s", e)
+                    self.next_refill = now + RETRY_INTERVAL
+
+            while self.heap and self.heap[0][0] <= loop.time():
+                _, _, kind, reservation = heapq.heappop(self.heap)
+                await self._fire(kind, reservation)
+
+            wake_at = self.next_refill
+            if self.heap:
+                wake_at = min(wake_at, self.heap[0][0])
+            await asyncio.sleep(max(wake_at - loop.time(), 0))
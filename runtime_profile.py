@@ -0,0 +1,72 @@
+# Профиль выполнения процесса (RUNTIME_PROFILE в config.py).
+# default - стандартные asyncio и json; fast - event loop uvloop и JSON запросов и ответов Bot API
+# через orjson. Обе библиотеки необязательны (pip install uvloop orjson): если какой-то нет,
+# соответствующая часть остается стандартной. Сравнение профилей - bench_runtime.py.
+# Тела входящих webhook-запросов PTB разбирает сам стандартным json, профиль их не затрагивает.
+import asyncio
+import logging
+
+from telegram.request import BaseRequest
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+PROFILES = ('default', 'fast')
+
+_fast_json = False
+
+# Включает профиль для циклов событий, создаваемых после вызова (asyncio.run).
+# Возвращает (event loop, JSON) - что фактически используется.
+def apply(profile: str) -> tuple:
+    global _fast_json
+    if profile not in PROFILES:
+        logger.warning("Неизвестный профиль выполнения %r, используется default", profile)
+        profile = 'default'
+    fast = profile == 'fast'
+    if fast and uvloop is None:
+        logger.warning("uvloop не установлен, используется стандартный event loop")
+    if fast and orjson is None:
+        logger.warning("orjson не установлен, используется стандартный json")
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy() if fast and uvloop else None)
+    _fast_json = fast and orjson is not None
+    return ('uvloop' if fast and uvloop else 'asyncio'), ('orjson' if _fast_json else 'json')
+
+# Замена BaseRequest.parse_json_payload
+def parse_json_payload(payload: bytes) -> dict:
+    if _fast_json:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            pass  # например, некорректный UTF-8: стандартный разбор заменит символы или сообщит об ошибке
+    return BaseRequest.parse_json_payload(payload)
+
+# Параметры запроса, заранее закодированные orjson. HTTPXRequest.do_request (PTB 20.7)
+# берет из RequestData только json_parameters и multipart_data.
+class _EncodedRequestData:
+    __slots__ = ('json_parameters', 'multipart_data')
+
+    def __init__(self, json_parameters: dict, multipart_data):
+        self.json_parameters = json_parameters
+        self.multipart_data = multipart_data
+
+def encode_request_data(request_data):
+    if not _fast_json or request_data is None:
+        return request_data
+    try:
+        json_parameters = {
+            name: value if isinstance(value, str) else orjson.dumps(value).decode()
+            for name, value in request_data.parameters.items()
+        }
+    except TypeError:
+        return request_data  # значение, которое orjson не кодирует (например, число больше 64 бит)
+    return _EncodedRequestData(json_parameters, request_data.multipart_data)
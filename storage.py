@@ -0,0 +1,335 @@
+# Интерфейс хранилища данных бота. Операции выполняются от имени бота, привязанного
+# к текущей задаче (db.bind_bot), и возвращают строки с доступом по имени столбца.
+# PostgresStorage - рабочая реализация (функции db.py); MemoryStorage (memory_storage.py) -
+# та же семантика в памяти процесса для тестов и нагрузочного стенда.
+# Код бота обращается к хранилищу через store, реализация подменяется use_storage().
+# Реализация, в которой не хватает операции, не создается (TypeError при конструировании).
+# Только у PostgreSQL есть реплика чтения, очередь записей на время недоступности базы,
+# LISTEN/NOTIFY между процессами и статистика запросов; в MemoryStorage эти операции пустые.
+from abc import ABC, abstractmethod
+
+import db
+# Общие для всех реализаций привязка к боту, ошибка недоступности и статусы доставки
+from db import (
+    bind_bot,
+    current_bot_id,
+    DatabaseUnavailable,
+    DELIVERY_OK,
+    DELIVERY_BLOCKED,
+    DELIVERY_DEACTIVATED,
+    DELIVERY_NOT_FOUND
+)
+
+class Storage(ABC):
+    @abstractmethod
+    async def init(self, bot_ids: list):
+        ...
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+    # callback(bot_id, owner_id) вызывается после каждого изменения списка подарков владельца
+    @abstractmethod
+    def add_wishlist_listener(self, callback):
+        ...
+
+    # Подписка на изменения списков от других процессов: соединение asyncpg, на котором
+    # callback(bot_id, owner_id) вызывается по NOTIFY. None - других процессов у хранилища
+    # нет, все изменения приходят через add_wishlist_listener
+    @abstractmethod
+    async def connect_listener(self, callback):
+        ...
+
+    # Откладывает запись (фабрику корутины) до восстановления хранилища после
+    # DatabaseUnavailable; False - запись не отложена
+    @abstractmethod
+    def queue_write(self, write) -> bool:
+        ...
+
+    # Проверка реплики чтения; возвращает отставание в секундах или None без реплики
+    @abstractmethod
+    async def check_replica(self):
+        ...
+
+    # Текстовый отчет о времени запросов для /metrics
+    @abstractmethod
+    def query_report(self) -> str:
+        ...
+
+    # Пользователи и доставка
+
+    @abstractmethod
+    async def register_user(self, user):
+        ...
+
+    @abstractmethod
+    async def record_user_activity(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def get_user_by_id(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def set_delivery_status(self, user_id: int, status: str, bot_id: int = None) -> bool:
+        ...
+
+    @abstractmethod
+    async def get_reachable_user_ids(self) -> list:
+        ...
+
+    @abstractmethod
+    async def filter_reachable(self, user_ids) -> set:
+        ...
+
+    @abstractmethod
+    async def get_last_update_id(self) -> int:
+        ...
+
+    @abstractmethod
+    async def save_last_update_id(self, update_id: int):
+        ...
+
+    # Списки подарков
+
+    @abstractmethod
+    async def add_link_to_wishlist(self, user_id: int, link: str) -> int:
+        ...
+
+    # Возвращает (добавленные строки id, link; дубликаты; не поместившиеся в лимит)
+    @abstractmethod
+    async def add_links_to_wishlist(self, user_id: int, links: list, limit: int):
+        ...
+
+    @abstractmethod
+    async def count_user_gifts(self, user_id: int) -> int:
+        ...
+
+    @abstractmethod
+    async def sync_wishlist_sequence(self):
+        ...
+
+    @abstractmethod
+    async def get_user_wishlist(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def get_wishlist_snapshot(self, owner_id: int):
+        ...
+
+    @abstractmethod
+    async def delete_gifts(self, user_id: int, gift_ids: list):
+        ...
+
+    @abstractmethod
+    async def search_gifts(self, user_id: int, text: str, after_id: int = 0, limit: int = 5):
+        ...
+
+    @abstractmethod
+    async def get_gift_info(self, gift_id: int):
+        ...
+
+    # Друзья
+
+    @abstractmethod
+    async def get_friends(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def get_friends_of_users(self, user_ids: list):
+        ...
+
+    @abstractmethod
+    async def remove_friend(self, user_id: int, friend_id: int):
+        ...
+
+    @abstractmethod
+    async def check_friendship(self, user_id1: int, user_id2: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def create_friend_request(self, from_user_id: int, to_user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def update_friend_request(self, from_user_id: int, to_user_id: int, status: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def has_pending_request(self, from_user_id: int, to_user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def delete_pending_request(self, from_user_id: int, to_user_id: int):
+        ...
+
+    @abstractmethod
+    async def get_pending_requests(self, to_user_id: int):
+        ...
+
+    # Брони
+
+    @abstractmethod
+    async def reserve_gift(self, gift_id: int, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def cancel_reservation(self, gift_id: int, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def get_reserved_gifts(self, owner_id: int, reserver_id: int):
+        ...
+
+    @abstractmethod
+    async def get_reservation_info(self, gift_id: int):
+        ...
+
+    @abstractmethod
+    async def check_old_reservations(self, grace_seconds: int = 3600) -> int:
+        ...
+
+    @abstractmethod
+    async def get_db_time(self):
+        ...
+
+    @abstractmethod
+    async def get_expiring_reservations(self, after, until):
+        ...
+
+    @abstractmethod
+    async def mark_reservation_reminded(self, reservation_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def expire_reservation(self, reservation_id: int) -> bool:
+        ...
+
+    # События
+
+    @abstractmethod
+    async def add_occasion(self, user_id: int, title: str, base_date, next_date, yearly: bool,
+                           days_before: int, remind_hour: int) -> int:
+        ...
+
+    @abstractmethod
+    async def get_user_occasions(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def delete_occasion(self, user_id: int, occasion_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def claim_due_occasions(self, limit: int, lease_seconds: int = 3600):
+        ...
+
+    @abstractmethod
+    async def complete_occasions(self, occasion_ids: list, days_before: int, remind_hour: int):
+        ...
+
+    # Отзывы и статистика
+
+    @abstractmethod
+    async def add_feedback(self, user_id: int, username: str, text: str, media_type: str = None, file_id: str = None):
+        ...
+
+    @abstractmethod
+    async def claim_feedback_batch(self, limit: int, lease_seconds: int = 900):
+        ...
+
+    @abstractmethod
+    async def mark_feedback_delivered(self, feedback_ids: list):
+        ...
+
+    @abstractmethod
+    async def release_feedback(self, feedback_ids: list):
+        ...
+
+    @abstractmethod
+    async def get_feedback_between(self, start, end, after: tuple = None, limit: int = 50):
+        ...
+
+    @abstractmethod
+    async def get_stats(self, days: int = 7):
+        ...
+
+    @abstractmethod
+    async def refresh_stats(self, keep_activity_days: int = 30):
+        ...
+
+class PostgresStorage(Storage):
+    init = staticmethod(db.init_db)
+    close = staticmethod(db.close_db)
+    add_wishlist_listener = staticmethod(db.add_wishlist_listener)
+    connect_listener = staticmethod(db.connect_listener)
+    queue_write = staticmethod(db.queue_write)
+    check_replica = staticmethod(db.check_replica)
+    query_report = staticmethod(db.query_report)
+
+    register_user = staticmethod(db.register_user)
+    record_user_activity = staticmethod(db.record_user_activity)
+    get_user_by_id = staticmethod(db.get_user_by_id)
+    set_delivery_status = staticmethod(db.set_delivery_status)
+    get_reachable_user_ids = staticmethod(db.get_reachable_user_ids)
+    filter_reachable = staticmethod(db.filter_reachable)
+    get_last_update_id = staticmethod(db.get_last_update_id)
+    save_last_update_id = staticmethod(db.save_last_update_id)
+
+    add_link_to_wishlist = staticmethod(db.add_link_to_wishlist)
+    add_links_to_wishlist = staticmethod(db.add_links_to_wishlist)
+    count_user_gifts = staticmethod(db.count_user_gifts)
+    sync_wishlist_sequence = staticmethod(db.sync_wishlist_sequence)
+    get_user_wishlist = staticmethod(db.get_user_wishlist)
+    get_wishlist_snapshot = staticmethod(db.get_wishlist_snapshot)
+    delete_gifts = staticmethod(db.delete_gifts)
+    search_gifts = staticmethod(db.search_gifts)
+    get_gift_info = staticmethod(db.get_gift_info)
+
+    get_friends = staticmethod(db.get_friends)
+    get_friends_of_users = staticmethod(db.get_friends_of_users)
+    remove_friend = staticmethod(db.remove_friend)
+    check_friendship = staticmethod(db.check_friendship)
+    create_friend_request = staticmethod(db.create_friend_request)
+    update_friend_request = staticmethod(db.update_friend_request)
+    has_pending_request = staticmethod(db.has_pending_request)
+    delete_pending_request = staticmethod(db.delete_pending_request)
+    get_pending_requests = staticmethod(db.get_pending_requests)
+
+    reserve_gift = staticmethod(db.reserve_gift)
+    cancel_reservation = staticmethod(db.cancel_reservation)
+    get_reserved_gifts = staticmethod(db.get_reserved_gifts)
+    get_reservation_info = staticmethod(db.get_reservation_info)
+    check_old_reservations = staticmethod(db.check_old_reservations)
+    get_db_time = staticmethod(db.get_db_time)
+    get_expiring_reservations = staticmethod(db.get_expiring_reservations)
+    mark_reservation_reminded = staticmethod(db.mark_reservation_reminded)
+    expire_reservation = staticmethod(db.expire_reservation)
+
+    add_occasion = staticmethod(db.add_occasion)
+    get_user_occasions = staticmethod(db.get_user_occasions)
+    delete_occasion = staticmethod(db.delete_occasion)
+    claim_due_occasions = staticmethod(db.claim_due_occasions)
+    complete_occasions = staticmethod(db.complete_occasions)
+
+    add_feedback = staticmethod(db.add_feedback)
+    claim_feedback_batch = staticmethod(db.claim_feedback_batch)
+    mark_feedback_delivered = staticmethod(db.mark_feedback_delivered)
+    release_feedback = staticmethod(db.release_feedback)
+    get_feedback_between = staticmethod(db.get_feedback_between)
+    get_stats = staticmethod(db.get_stats)
+    refresh_stats = staticmethod(db.refresh_stats)
+
+# Текущее хранилище процесса; модули импортируют store один раз, подмена видна всем
+class _CurrentStorage:
+    def __init__(self, backend: Storage):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+store = _CurrentStorage(PostgresStorage())
+
+def use_storage(backend: Storage):
+    store.backend = backend
@@ -0,0 +1,72 @@
+# Тесты объединения уведомлений владельцам (owner_notifications.py). Хранилище - фикстура run
+# из conftest.py, вместо Bot API - бот, запоминающий отправленные сообщения.
+import asyncio
+from types import SimpleNamespace
+
+import owner_notifications
+from owner_notifications import CANCELLED, RESERVED, OwnerNotifier
+from storage import current_bot_id
+
+OWNER = SimpleNamespace(id=5_000_000_001, username="owner", first_name="Owner")
+
+class FakeBot:
+    def __init__(self):
+        self.id = current_bot_id.get()
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+# scenario(notifier, bot) для зарегистрированного у бота владельца OWNER
+def notifier_scenario(scenario):
+    async def wrapped(storage):
+        await storage.register_user(OWNER)
+        bot = FakeBot()
+        await scenario(OwnerNotifier(bot), bot)
+    return wrapped
+
+def test_reserve_then_cancel_sends_nothing(run):
+    async def scenario(notifier, bot):
+        notifier.add(OWNER.id, 1, "https://example.com/1", RESERVED)
+        notifier.add(OWNER.id, 1, "https://example.com/1", CANCELLED)
+        await notifier.flush_all()
+        assert bot.sent == []
+    run(notifier_scenario(scenario))
+
+def test_cancel_then_reserve_sends_nothing(run):
+    async def scenario(notifier, bot):
+        notifier.add(OWNER.id, 1, "https://example.com/1", CANCELLED)
+        notifier.add(OWNER.id, 1, "https://example.com/1", RESERVED)
+        await notifier.flush_all()
+        assert bot.sent == []
+    run(notifier_scenario(scenario))
+
+def test_two_gifts_reserved_in_one_summary(run):
+    async def scenario(notifier, bot):
+        notifier.add(OWNER.id, 1, "https://example.com/1", RESERVED)
+        notifier.add(OWNER.id, 2, "https://example.com/2", RESERVED)
+        await notifier.flush_all()
+        assert len(bot.sent) == 1
+        chat_id, text = bot.sent[0]
+        assert chat_id == OWNER.id
+        assert "Изменения броней" in text
+        assert "https://example.com/1" in text and "https://example.com/2" in text
+    run(notifier_scenario(scenario))
+
+def test_flush_all_sends_pending(run):
+    async def scenario(notifier, bot):
+        notifier.add(OWNER.id, 1, "https://example.com/1", RESERVED)
+        assert bot.sent == [] and notifier.timers
+        await notifier.flush_all()
+        assert len(bot.sent) == 1 and "https://example.com/1" in bot.sent[0][1]
+        assert not notifier.pending and not notifier.timers
+    run(notifier_scenario(scenario))
+
+def test_window_sends_after_debounce(run, monkeypatch):
+    monkeypatch.setattr(owner_notifications, 'DEBOUNCE_SECONDS', 0.01)
+    async def scenario(notifier, bot):
+        notifier.add(OWNER.id, 1, "https://example.com/1", RESERVED)
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*notifier.tasks)
+        assert len(bot.sent) == 1
+    run(notifier_scenario(scenario))
@@ -0,0 +1,359 @@
+# Общие тесты реализаций хранилища (storage.py): одна и та же семантика в памяти и в PostgreSQL.
+# Реализации и окружение задает conftest.py (фикстура run).
+import random
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from memory_storage import MemoryStorage
+from db import RESERVATION_DAYS
+from storage import bind_bot, current_bot_id, DELIVERY_BLOCKED, Storage
+
+def new_id() -> int:
+    return random.randrange(10 ** 11, 10 ** 12)
+
+def make_user(first_name: str):
+    return SimpleNamespace(id=new_id(), username=first_name.lower(), first_name=first_name)
+
+async def register(storage, *names):
+    users = [make_user(name) for name in names]
+    for user in users:
+        await storage.register_user(user)
+    return users
+
+async def befriend(storage, user, friend):
+    assert await storage.create_friend_request(user.id, friend.id)
+    assert await storage.update_friend_request(user.id, friend.id, 'accept')
+
+# Реализация без одной из операций не создается, а не падает при первом вызове
+def test_backend_without_operation_is_rejected():
+    operations = {name: getattr(MemoryStorage, name) for name in Storage.__abstractmethods__ if name != 'search_gifts'}
+    with pytest.raises(TypeError, match='search_gifts'):
+        type('Incomplete', (Storage,), operations)()
+
+def test_register_user_and_delivery_status(run):
+    async def scenario(storage):
+        alice, = await register(storage, "Alice")
+        await storage.register_user(alice)
+        row = await storage.get_user_by_id(alice.id)
+        assert (row['id'], row['first_name'], row['delivery_status']) == (alice.id, "Alice", 'ok')
+        assert await storage.get_user_by_id(new_id()) is None
+
+        assert await storage.set_delivery_status(alice.id, DELIVERY_BLOCKED)
+        assert not await storage.set_delivery_status(alice.id, DELIVERY_BLOCKED)
+        assert await storage.filter_reachable([alice.id]) == set()
+        assert alice.id not in await storage.get_reachable_user_ids()
+
+        # Повторный /start снова открывает доставку, но не считается новым пользователем
+        await storage.register_user(alice)
+        assert await storage.filter_reachable([alice.id]) == {alice.id}
+        totals, daily = await storage.get_stats()
+        assert totals['users'] == 1
+        assert daily[date.today()]['new_users'] == 1
+
+        await storage.record_user_activity(alice.id)
+        await storage.record_user_activity(alice.id)
+        _, daily = await storage.get_stats()
+        assert daily[date.today()]['active_users'] == 1
+    run(scenario)
+
+def test_wishlist(run):
+    async def scenario(storage):
+        alice, bob = await register(storage, "Alice", "Bob")
+        changes = []
+        storage.add_wishlist_listener(lambda bot_id, owner_id: changes.append(owner_id))
+
+        first = await storage.add_link_to_wishlist(alice.id, "https://a.example/1")
+        second = await storage.add_link_to_wishlist(alice.id, "https://a.example/2")
+        foreign = await storage.add_link_to_wishlist(bob.id, "https://b.example/1")
+        assert first < second
+        assert await storage.count_user_gifts(alice.id) == 2
+        assert [dict(row) for row in await storage.get_user_wishlist(alice.id)] == [
+            {'id': first, 'link': "https://a.example/1"},
+            {'id': second, 'link': "https://a.example/2"},
+        ]
+        assert [row['reserved_by'] for row in await storage.get_wishlist_snapshot(alice.id)] == [None, None]
+        assert changes.count(alice.id) == 2
+
+        deleted = await storage.delete_gifts(alice.id, [first, foreign])
+        assert [(row['id'], row['reserved_by']) for row in deleted] == [(first, None)]
+        assert await storage.count_user_gifts(alice.id) == 1
+        assert await storage.count_user_gifts(bob.id) == 1
+        assert await storage.delete_gifts(alice.id, [first]) == []
+        totals, daily = await storage.get_stats()
+        assert totals['gifts'] == 2
+        assert daily[date.today()]['new_gifts'] == 3
+    run(scenario)
+
+def test_add_links_in_bulk(run):
+    async def scenario(storage):
+        alice, = await register(storage, "Alice")
+        changes = []
+        storage.add_wishlist_listener(lambda bot_id, owner_id: changes.append(owner_id))
+        await storage.add_link_to_wishlist(alice.id, "https://a.example/0")
+
+        links = [f"https://a.example/{index}" for index in range(20)]
+        added, duplicates, over_limit = await storage.add_links_to_wishlist(alice.id, links + links[1:3], 15)
+        assert [row['link'] for row in added] == links[1:15]
+        assert [row['id'] for row in added] == sorted(row['id'] for row in added)
+        assert duplicates == links[:1]
+        assert over_limit == links[15:]
+        assert changes == [alice.id, alice.id]
+        assert await storage.count_user_gifts(alice.id) == 15
+
+        assert await storage.add_links_to_wishlist(alice.id, ["https://a.example/new"], 15) == ([], [], ["https://a.example/new"])
+        totals, daily = await storage.get_stats()
+        assert totals['gifts'] == 15
+        assert daily[date.today()]['new_gifts'] == 15
+    run(scenario)
+
+def test_friend_requests(run):
+    async def scenario(storage):
+        alice, bob, carol = await register(storage, "Alice", "Bob", "Carol")
+        assert await storage.create_friend_request(alice.id, bob.id)
+        assert not await storage.create_friend_request(alice.id, bob.id)
+        assert not await storage.create_friend_request(bob.id, alice.id)
+        assert await storage.has_pending_request(alice.id, bob.id)
+        assert not await storage.has_pending_request(bob.id, alice.id)
+        assert [(row['from_user_id'], row['first_name']) for row in await storage.get_pending_requests(bob.id)] == [
+            (alice.id, "Alice")
+        ]
+
+        assert await storage.update_friend_request(alice.id, bob.id, 'accept')
+        assert not await storage.update_friend_request(alice.id, bob.id, 'accept')
+        assert await storage.check_friendship(bob.id, alice.id)
+        assert [row['id'] for row in await storage.get_friends(alice.id)] == [bob.id]
+        assert await storage.get_pending_requests(bob.id) == []
+        assert not await storage.create_friend_request(bob.id, alice.id)
+
+        assert await storage.create_friend_request(carol.id, alice.id)
+        assert await storage.update_friend_request(carol.id, alice.id, 'decline')
+        assert not await storage.check_friendship(alice.id, carol.id)
+        assert await storage.create_friend_request(carol.id, alice.id)
+        await storage.delete_pending_request(carol.id, alice.id)
+        assert not await storage.has_pending_request(carol.id, alice.id)
+
+        totals, _ = await storage.get_stats()
+        assert (totals['friendships'], totals['pending_requests']) == (1, 0)
+
+        await storage.remove_friend(bob.id, alice.id)
+        assert not await storage.check_friendship(alice.id, bob.id)
+        assert await storage.get_friends(alice.id) == []
+        totals, _ = await storage.get_stats()
+        assert totals['friendships'] == 0
+    run(scenario)
+
+def test_friends_of_users_skips_unreachable(run):
+    async def scenario(storage):
+        alice, bob, carol = await register(storage, "Alice", "Bob", "Carol")
+        await befriend(storage, alice, bob)
+        await befriend(storage, alice, carol)
+        await storage.set_delivery_status(carol.id, DELIVERY_BLOCKED)
+        rows = await storage.get_friends_of_users([alice.id, bob.id])
+        assert sorted((row['user_id'], row['friend_id']) for row in rows) == sorted([(alice.id, bob.id), (bob.id, alice.id)])
+    run(scenario)
+
+def test_reservations(run):
+    async def scenario(storage):
+        alice, bob, carol = await register(storage, "Alice", "Bob", "Carol")
+        gift = await storage.add_link_to_wishlist(alice.id, "https://a.example/1")
+        changes = []
+        storage.add_wishlist_listener(lambda bot_id, owner_id: changes.append(owner_id))
+
+        assert not await storage.reserve_gift(gift, alice.id)
+        assert not await storage.reserve_gift(gift + 1000000, bob.id)
+        assert await storage.reserve_gift(gift, bob.id)
+        assert not await storage.reserve_gift(gift, carol.id)
+        assert changes == [alice.id]
+
+        info = await storage.get_gift_info(gift)
+        assert (info['link'], info['owner_id'], info['first_name'], info['owner_reachable']) == (
+            "https://a.example/1", alice.id, "Alice", True
+        )
+        reservation = await storage.get_reservation_info(gift)
+        assert (reservation['reserved_by'], reservation['first_name'], reservation['reminded']) == (bob.id, "Bob", False)
+        assert [row['id'] for row in await storage.get_reserved_gifts(alice.id, bob.id)] == [gift]
+        assert await storage.get_reserved_gifts(alice.id, carol.id) == []
+        assert [row['reserved_by'] for row in await storage.get_wishlist_snapshot(alice.id)] == [bob.id]
+
+        now = await storage.get_db_time()
+        rows = await storage.get_expiring_reservations(None, reservation['expires_at'])
+        assert [(row['id'], row['owner_id'], row['reserver_reachable']) for row in rows] == [(reservation['id'], alice.id, True)]
+        assert await storage.get_expiring_reservations(reservation['expires_at'], reservation['expires_at'] + timedelta(days=1)) == []
+        assert await storage.get_expiring_reservations(None, now) == []
+        assert await storage.mark_reservation_reminded(reservation['id'])
+        assert not await storage.mark_reservation_reminded(reservation['id'])
+        assert not await storage.expire_reservation(reservation['id'])
+        assert await storage.check_old_reservations() == 0
+
+        assert not await storage.cancel_reservation(gift, carol.id)
+        assert await storage.cancel_reservation(gift, bob.id)
+        assert not await storage.cancel_reservation(gift, bob.id)
+        assert await storage.get_reservation_info(gift) is None
+        totals, daily = await storage.get_stats()
+        assert totals['reservations'] == 0
+        assert daily[date.today()]['new_reservations'] == 1
+    run(scenario)
+
+# Просроченные брони снимаются только у своего бота; отрицательный запас - "через столько секунд"
+def test_overdue_reservations_are_released_per_bot(run):
+    async def scenario(storage):
+        alice, bob = await register(storage, "Alice", "Bob")
+        gifts = [await storage.add_link_to_wishlist(alice.id, f"https://a.example/{index}") for index in range(3)]
+        for gift in gifts:
+            assert await storage.reserve_gift(gift, bob.id)
+        bot_id = current_bot_id.get()
+
+        bind_bot(new_id())
+        assert await storage.check_old_reservations(-RESERVATION_DAYS * 86400 - 60) == 0
+
+        bind_bot(bot_id)
+        assert await storage.check_old_reservations() == 0
+        assert await storage.check_old_reservations(-RESERVATION_DAYS * 86400 - 60) == 3
+        assert [await storage.get_reservation_info(gift) for gift in gifts] == [None] * 3
+        assert await storage.get_expiring_reservations(None, datetime.max) == []
+        totals, daily = await storage.get_stats()
+        assert (totals['reservations'], daily[date.today()]['expired_reservations']) == (0, 3)
+    run(scenario)
+
+def test_deleting_reserved_gift_drops_reservation(run):
+    async def scenario(storage):
+        alice, bob = await register(storage, "Alice", "Bob")
+        gift = await storage.add_link_to_wishlist(alice.id, "https://a.example/1")
+        assert await storage.reserve_gift(gift, bob.id)
+        deleted = await storage.delete_gifts(alice.id, [gift])
+        assert [row['reserved_by'] for row in deleted] == [bob.id]
+        assert await storage.get_reservation_info(gift) is None
+        totals, _ = await storage.get_stats()
+        assert (totals['gifts'], totals['reservations']) == (0, 0)
+    run(scenario)
+
+def test_search_gifts(run):
+    async def scenario(storage):
+        alice, bob, carol = await register(storage, "Alice", "Bob", "Carol")
+        await befriend(storage, alice, bob)
+        own = await storage.add_link_to_wishlist(alice.id, "https://shop.example/Lego-100%")
+        friend = await storage.add_link_to_wishlist(bob.id, "https://shop.example/lego-city")
+        await storage.add_link_to_wishlist(carol.id, "https://shop.example/lego-star")
+
+        rows = await storage.search_gifts(alice.id, "LEGO")
+        assert [(row['id'], row['owner_id'], row['owner_name']) for row in rows] == [(own, alice.id, "Alice"), (friend, bob.id, "Bob")]
+        assert [row['id'] for row in await storage.search_gifts(alice.id, "lego", limit=1)] == [own]
+        assert [row['id'] for row in await storage.search_gifts(alice.id, "lego", after_id=own)] == [friend]
+        # Спецсимволы LIKE ищутся буквально
+        assert [row['id'] for row in await storage.search_gifts(alice.id, "100%")] == [own]
+        assert await storage.search_gifts(alice.id, "_") == []
+    run(scenario)
+
+def test_bots_are_isolated(run):
+    async def scenario(storage):
+        alice, bob = await register(storage, "Alice", "Bob")
+        gift = await storage.add_link_to_wishlist(alice.id, "https://a.example/1")
+        await befriend(storage, alice, bob)
+
+        bind_bot(new_id())
+        assert await storage.get_user_by_id(alice.id) is None
+        assert await storage.count_user_gifts(alice.id) == 0
+        assert await storage.get_gift_info(gift) is None
+        assert not await storage.check_friendship(alice.id, bob.id)
+        assert not await storage.reserve_gift(gift, bob.id)
+        assert await storage.get_last_update_id() == 0
+    run(scenario)
+
+def test_update_offset_only_grows(run):
+    async def scenario(storage):
+        assert await storage.get_last_update_id() == 0
+        await storage.save_last_update_id(10)
+        await storage.save_last_update_id(7)
+        assert await storage.get_last_update_id() == 10
+    run(scenario)
+
+def test_occasions(run):
+    async def scenario(storage):
+        alice, = await register(storage, "Alice")
+        today = date.today()
+        yearly = await storage.add_occasion(alice.id, "День рождения", date(2000, today.month, 1), today, True, 3, 0)
+        once = await storage.add_occasion(alice.id, "Новоселье", today, today, False, 3, 0)
+        # 29 февраля переносится на 28-е в невисокосный год и возвращается в високосный
+        leap = await storage.add_occasion(alice.id, "Високосный", date(2000, 2, 29), date(2024, 2, 29), True, 3, 0)
+        later = await storage.add_occasion(alice.id, "Потом", today + timedelta(days=30), today + timedelta(days=30), False, 3, 0)
+
+        claimed = await storage.claim_due_occasions(10)
+        assert sorted(row['id'] for row in claimed) == sorted([yearly, once, leap])
+        by_id = {row['id']: row for row in claimed}
+        assert (by_id[once]['occasion_date'], by_id[once]['first_name']) == (today, "Alice")
+        assert by_id[leap]['occasion_date'] == date(2024, 2, 29)
+        # До завершения напоминания в аренде; по ее истечении (процесс упал посреди рассылки) выбираются снова
+        assert await storage.claim_due_occasions(10) == []
+        assert len(await storage.claim_due_occasions(10, lease_seconds=0)) == 3
+
+        await storage.complete_occasions([row['id'] for row in claimed], 3, 0)
+        await storage.complete_occasions([row['id'] for row in claimed], 3, 0)  # повтор ничего не сдвигает
+        assert [row['id'] for row in await storage.claim_due_occasions(10)] == [leap]  # 2025-02-28 тоже уже прошло
+
+        upcoming = {row['id']: row for row in await storage.get_user_occasions(alice.id)}
+        assert set(upcoming) == {yearly, once, leap, later}
+        assert upcoming[once]['next_date'] == today
+        assert upcoming[yearly]['next_date'].year == today.year + 1
+
+        assert await storage.delete_occasion(alice.id, later)
+        assert not await storage.delete_occasion(alice.id, later)
+        assert later not in {row['id'] for row in await storage.get_user_occasions(alice.id)}
+    run(scenario)
+
+def test_occasions_claimed_in_batches(run):
+    async def scenario(storage):
+        alice, = await register(storage, "Alice")
+        today = date.today()
+        for index in range(5):
+            await storage.add_occasion(alice.id, f"Событие {index}", today, today, False, 0, 0)
+        assert len(await storage.claim_due_occasions(3)) == 3
+        assert len(await storage.claim_due_occasions(3)) == 2
+        assert await storage.claim_due_occasions(3) == []
+    run(scenario)
+
+def test_feedback_queue(run):
+    async def scenario(storage):
+        alice, = await register(storage, "Alice")
+        for index in range(3):
+            await storage.add_feedback(alice.id, alice.username, f"отзыв {index}")
+        batch = await storage.claim_feedback_batch(2)
+        assert [row['text'] for row in batch] == ["отзыв 0", "отзыв 1"]
+        await storage.mark_feedback_delivered([batch[0]['id']])
+        await storage.release_feedback([batch[1]['id']])
+        batch = await storage.claim_feedback_batch(10)
+        assert [row['text'] for row in batch] == ["отзыв 1", "отзыв 2"]
+        assert await storage.claim_feedback_batch(10) == []
+
+        # Не подтвержденные к сроку аренды (процесс упал до отправки) выбираются снова, доставленные - нет
+        await storage.mark_feedback_delivered([batch[0]['id']])
+        await storage.release_feedback([batch[0]['id']])
+        assert [row['text'] for row in await storage.claim_feedback_batch(10, lease_seconds=0)] == ["отзыв 2"]
+
+        now = await storage.get_db_time()
+        start, end = now - timedelta(hours=1), now + timedelta(hours=1)
+        rows = await storage.get_feedback_between(start, end, limit=2)
+        assert [row['text'] for row in rows] == ["отзыв 0", "отзыв 1"]
+        rows = await storage.get_feedback_between(start, end, (rows[-1]['created_at'], rows[-1]['id']), limit=2)
+        assert [row['text'] for row in rows] == ["отзыв 2"]
+        totals, _ = await storage.get_stats()
+        assert totals['feedback'] == 3
+    run(scenario)
+
+def test_refresh_stats_matches_counters(run):
+    async def scenario(storage):
+        alice, bob, carol = await register(storage, "Alice", "Bob", "Carol")
+        await befriend(storage, alice, bob)
+        await storage.create_friend_request(carol.id, alice.id)
+        gift = await storage.add_link_to_wishlist(alice.id, "https://a.example/1")
+        await storage.add_link_to_wishlist(bob.id, "https://b.example/1")
+        await storage.reserve_gift(gift, bob.id)
+        await storage.add_feedback(carol.id, carol.username, "отзыв")
+
+        counted, _ = await storage.get_stats()
+        await storage.refresh_stats()
+        refreshed, _ = await storage.get_stats()
+        metrics = ('users', 'gifts', 'reservations', 'pending_requests', 'friendships', 'feedback')
+        assert [refreshed[metric] for metric in metrics] == [counted[metric] for metric in metrics] == [3, 2, 1, 1, 1, 1]
+    run(scenario)
@@ -0,0 +1,114 @@
+# Кэш списков подарков по (бот, владелец), согласованный между экземплярами бота.
+# Записи сбрасываются по NOTIFY из db.py (отдельное соединение с LISTEN, store.connect_listener).
+# Пока слушатель отключен, записи живут не дольше FALLBACK_TTL. Хранилищу в памяти LISTEN
+# не нужен: его изменения приходят только через store.add_wishlist_listener.
+# Сброшенная или устаревшая запись остается как снимок, который отдается, пока база недоступна.
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from storage import DatabaseUnavailable, current_bot_id, store
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = 3600  # секунд, при работающем LISTEN - страховка от потерянных уведомлений
+FALLBACK_TTL = 30  # секунд, пока LISTEN недоступен
+MAX_ENTRIES = 10000
+RECONNECT_DELAY = 5
+KEEPALIVE_INTERVAL = 30
+
+class WishlistCache:
+    def __init__(self, loader):
+        self.loader = loader
+        self.entries = OrderedDict()  # (bot_id, owner_id) -> (время загрузки или None, если сброшена; строки)
+        self.generations = {}  # (bot_id, owner_id) -> номер сброса, защищает от записи устаревшей загрузки
+        self.connected = False
+        self.task = None
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    # Список владельца у бота, к которому привязана текущая задача
+    async def get(self, owner_id: int):
+        key = (current_bot_id.get(), owner_id)
+        entry = self.entries.get(key)
+        ttl = CACHE_TTL if self.connected else FALLBACK_TTL
+        if entry and entry[0] is not None and time.monotonic() - entry[0] < ttl:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        generation = self.generations.get(key, 0)
+        try:
+            rows = await self.loader(owner_id)
+        except DatabaseUnavailable:
+            if entry is None:
+                raise
+            self.stale_hits += 1
+            return entry[1]
+        if self.generations.get(key, 0) == generation:
+            self.entries[key] = (time.monotonic(), rows)
+            self.entries.move_to_end(key)
+            while len(self.entries) > MAX_ENTRIES:
+                evicted, _ = self.entries.popitem(last=False)
+                self.generations.pop(evicted, None)
+        return rows
+
+    def invalidate(self, bot_id: int, owner_id: int):
+        key = (bot_id, owner_id)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries[key] = (None, entry[1])
+        self.generations[key] = self.generations.get(key, 0) + 1
+        if len(self.generations) > MAX_ENTRIES * 2:
+            self.generations = {key: value for key, value in self.generations.items() if key in self.entries}
+
+    def clear(self):
+        for bot_id, owner_id in list(self.entries):
+            self.invalidate(bot_id, owner_id)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _listen(self):
+        while True:
+            conn = None
+            terminated = asyncio.Event()
+            try:
+                conn = await store.connect_listener(self.invalidate)
+                if conn is None:
+                    self.connected = True
+                    await asyncio.get_running_loop().create_future()  # до stop()
+                conn.add_termination_listener(lambda _: terminated.set())
+                # Уведомления, пропущенные без соединения, не восстановить - начинаем с пустого кэша
+                self.clear()
+                self.connected = True
+                logger.info("Кэш списков подписан на изменения списков")
+                while not terminated.is_set():
+                    try:
+                        await asyncio.wait_for(terminated.wait(), KEEPALIVE_INTERVAL)
+                    except asyncio.TimeoutError:
+                        await conn.fetchval('SELECT 1', timeout=5)
+                logger.warning("Соединение LISTEN закрыто, кэш работает по TTL")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Слушатель изменений списков отключен, кэш работает по TTL: %s", e)
+            finally:
+                self.connected = False
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            await asyncio.sleep(RECONNECT_DELAY)